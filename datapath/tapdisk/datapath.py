@@ -6,7 +6,7 @@ import sys
 import xapi
 import xapi.storage.api.datapath
 import xapi.storage.api.volume
-from xapi.storage.libs import tapdisk, image
+from xapi.storage.libs import tapdisk, tapdiskpool, tapdiskstats, image
 from xapi.storage import log
 
 
@@ -43,8 +43,9 @@ class Implementation(xapi.storage.api.datapath.Datapath_skeleton):
 
     def attach(self, dbg, uri, domain):
         u = urlparse.urlparse(uri)
-        tap = tapdisk.create(dbg)
+        tap = tapdiskpool.create(dbg)
         tapdisk.save_tapdisk_metadata(dbg, u.path, tap)
+        tapdiskstats.ensure_running(dbg)
         return {
             'domain_uuid': '0',
             'implementation': ['Tapdisk3', tap.block_device()],
@@ -0,0 +1,144 @@
+import os
+import errno
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+from xapi.storage import log
+
+"""
+Wait for device nodes to appear without polling.
+
+udev creates the /dev/disk/by-id/* symlinks some time after the kernel
+has announced a new block device. Rather than sleeping and re-stat'ing
+we ask inotify to tell us whenever an entry is created in (or renamed
+into) the directory holding the links, and re-check only then.
+"""
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+# struct inotify_event { int wd; uint32 mask; uint32 cookie; uint32 len; }
+INOTIFY_EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+# Used when inotify cannot be set up at all
+POLL_INTERVAL = 0.1
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+class Inotify(object):
+
+    """A minimal inotify instance watching one or more directories
+       for new entries"""
+
+    def __init__(self):
+        self.fd = _get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=IN_CREATE | IN_MOVED_TO):
+        wd = _get_libc().inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def wait(self, timeout):
+        """Block until at least one event arrives or [timeout] seconds
+           pass. Returns the names of the entries which changed."""
+        try:
+            ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, READ_SIZE)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        # An event with an empty name (e.g. IN_Q_OVERFLOW) still counts
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            names.append(buf[offset:offset + length].rstrip('\0'))
+            offset += length
+        return names
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _missing(paths):
+    return set(path for path in paths if not os.path.exists(path))
+
+
+def _poll_for_paths(dbg, missing, deadline):
+    while missing and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        missing = _missing(missing)
+    return missing
+
+
+def wait_for_paths(dbg, paths, timeout):
+    """Wait until every path in [paths] exists, or [timeout] seconds
+       have passed. Returns the set of paths which are still missing
+       (empty on success)."""
+    deadline = time.time() + timeout
+    # The watches must be in place before the first check, otherwise
+    # a node created between the check and the watch would be missed
+    try:
+        notifier = Inotify()
+    except OSError as exc:
+        log.debug("%s: inotify unavailable (%s), polling instead" %
+                  (dbg, exc))
+        return _poll_for_paths(dbg, _missing(paths), deadline)
+
+    with notifier:
+        for dirname in set(os.path.dirname(path) for path in paths):
+            try:
+                notifier.add_watch(dirname)
+            except OSError as exc:
+                # e.g. /dev/disk/by-id does not exist yet because this
+                # is the first disk udev has seen
+                log.debug("%s: cannot watch %s (%s), polling instead" %
+                          (dbg, dirname, exc))
+                return _poll_for_paths(dbg, _missing(paths), deadline)
+
+        missing = _missing(paths)
+        while missing:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # Re-check everything on any event: the queue may have
+            # overflowed, and a stat per missing path is cheap
+            if notifier.wait(remaining):
+                missing = _missing(missing)
+        return missing
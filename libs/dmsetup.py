@@ -55,10 +55,11 @@ def table(base_device):
 
 class DeviceMapper:
 
-    def __init__(self, dbg, base_device):
+    def __init__(self, dbg, base_device, existing=None):
         self.name = name_of_device(base_device)
         t = table(base_device)
-        existing = call(dbg, ["dmsetup", "table", self.name]).strip()
+        if existing is None:
+            existing = call(dbg, ["dmsetup", "table", self.name]).strip()
         if existing != t:
             message = ("Device mapper device %s has table %s, expected %s" %
                        (self.name, existing, t))
@@ -89,6 +90,32 @@ def find(dbg, base_device):
         return None
 
 
+def _tables(dbg):
+    """Return {name: table} for every device mapper device"""
+    tables = {}
+    for line in call(dbg, ["dmsetup", "table"]).split("\n"):
+        if ": " in line:
+            name, t = line.split(": ", 1)
+            tables[name] = t.strip()
+    return tables
+
+
+def find_all(dbg, base_devices):
+    """Return {base device: DeviceMapper} for those of [base_devices]
+       which have a device mapper device, from a single scan"""
+    tables = _tables(dbg)
+    result = {}
+    for base_device in base_devices:
+        existing = tables.get(name_of_device(base_device))
+        if existing is None:
+            continue
+        try:
+            result[base_device] = DeviceMapper(dbg, base_device, existing)
+        except:
+            pass
+    return result
+
+
 def create(dbg, base_device):
     try:
         return DeviceMapper(dbg, base_device)
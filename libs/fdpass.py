@@ -0,0 +1,117 @@
+import os
+import ctypes
+import ctypes.util
+
+"""
+Pass file descriptors over a unix domain socket (SCM_RIGHTS).
+
+python-fdsend is not available in dom0 and python 2's socket module has
+no sendmsg(), so call the C library directly.
+"""
+
+SOL_SOCKET = 1
+SCM_RIGHTS = 1
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _cmsghdr(ctypes.Structure):
+    _fields_ = [("cmsg_len", ctypes.c_size_t),
+                ("cmsg_level", ctypes.c_int),
+                ("cmsg_type", ctypes.c_int)]
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def _cmsg_align(length):
+    align = ctypes.sizeof(ctypes.c_size_t)
+    return (length + align - 1) & ~(align - 1)
+
+
+def sendfds(sock, message, fds):
+    """Send [message] (which must not be empty) over the connected unix
+       socket [sock] together with the file descriptors [fds]"""
+    if not message:
+        raise ValueError("a message is needed to carry the descriptors")
+    fd_bytes = ctypes.sizeof(ctypes.c_int) * len(fds)
+    header = ctypes.sizeof(_cmsghdr)
+    control = ctypes.create_string_buffer(
+        _cmsg_align(header) + _cmsg_align(fd_bytes))
+    cmsg = _cmsghdr.from_buffer(control)
+    cmsg.cmsg_len = _cmsg_align(header) + fd_bytes
+    cmsg.cmsg_level = SOL_SOCKET
+    cmsg.cmsg_type = SCM_RIGHTS
+    fd_array = (ctypes.c_int * len(fds)).from_buffer(
+        control, _cmsg_align(header))
+    for i, fd in enumerate(fds):
+        fd_array[i] = fd if isinstance(fd, (int, long)) else fd.fileno()
+
+    data = ctypes.create_string_buffer(message, len(message))
+    iov = _iovec(ctypes.cast(data, ctypes.c_void_p), len(message))
+    msg = _msghdr()
+    msg.msg_iov = ctypes.pointer(iov)
+    msg.msg_iovlen = 1
+    msg.msg_control = ctypes.cast(control, ctypes.c_void_p)
+    msg.msg_controllen = len(control)
+
+    sent = _get_libc().sendmsg(sock.fileno(), ctypes.byref(msg), 0)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "sendmsg: " + os.strerror(err))
+    return sent
+
+
+def recvfds(sock, size, maxfds):
+    """Receive at most [size] bytes from the connected unix socket
+       [sock], with at most [maxfds] file descriptors sent along with
+       them. Returns (message, [fds])."""
+    fd_bytes = ctypes.sizeof(ctypes.c_int) * maxfds
+    header = ctypes.sizeof(_cmsghdr)
+    control = ctypes.create_string_buffer(
+        _cmsg_align(header) + _cmsg_align(fd_bytes))
+
+    data = ctypes.create_string_buffer(size)
+    iov = _iovec(ctypes.cast(data, ctypes.c_void_p), size)
+    msg = _msghdr()
+    msg.msg_iov = ctypes.pointer(iov)
+    msg.msg_iovlen = 1
+    msg.msg_control = ctypes.cast(control, ctypes.c_void_p)
+    msg.msg_controllen = len(control)
+
+    received = _get_libc().recvmsg(sock.fileno(), ctypes.byref(msg), 0)
+    if received < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "recvmsg: " + os.strerror(err))
+
+    fds = []
+    if msg.msg_controllen >= header:
+        cmsg = _cmsghdr.from_buffer(control)
+        count = (cmsg.cmsg_len - _cmsg_align(header)) // \
+            ctypes.sizeof(ctypes.c_int)
+        if cmsg.cmsg_level == SOL_SOCKET and cmsg.cmsg_type == SCM_RIGHTS \
+           and count > 0:
+            fds = list((ctypes.c_int * count).from_buffer(
+                control, _cmsg_align(header)))
+    return (data.raw[:received], fds)
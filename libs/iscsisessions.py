@@ -0,0 +1,156 @@
+import os
+import glob
+import sqlite3
+from contextlib import contextmanager
+
+"""
+Host-local registry of the iSCSI sessions we have logged in and of the
+references (SRs, probes) holding each target logged in.
+
+Everything is looked up by primary key, and the session ids recorded
+here are checked against sysfs, so that deciding whether to log in,
+rescan or log out needs neither a scan of the references nor a fork
+of 'iscsiadm -m session'.
+"""
+
+SYSFS_SESSION_ROOT = "/sys/class/iscsi_session"
+SYSFS_CONNECTION_ROOT = "/sys/class/iscsi_connection"
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as fd:
+            return fd.read().strip()
+    except IOError:
+        return None
+
+
+def session_is_live(session_id, iqn):
+    """True if the kernel still has session [session_id] to [iqn]"""
+    return _read_sysfs(os.path.join(
+        SYSFS_SESSION_ROOT, "session%d" % session_id, "targetname")) == iqn
+
+
+def find_live_session(iqn, portal):
+    """Find the kernel's session to [iqn] on [portal] ('ip:port') by
+       reading sysfs; returns the session id or None"""
+    (address, port) = portal.rsplit(':', 1)
+    for session in glob.glob(os.path.join(SYSFS_SESSION_ROOT, "session*")):
+        if _read_sysfs(os.path.join(session, "targetname")) != iqn:
+            continue
+        session_id = int(os.path.basename(session)[len("session"):])
+        conn = os.path.join(SYSFS_CONNECTION_ROOT,
+                            "connection%d:0" % session_id)
+        if (_read_sysfs(os.path.join(conn, "persistent_address")) == address
+                and _read_sysfs(os.path.join(conn, "persistent_port")) == port):
+            return session_id
+    return None
+
+
+def rescan_session(session_id):
+    """Ask the SCSI host of [session_id] to look for new LUNs, the sysfs
+       equivalent of 'iscsiadm -m session -r <id> --rescan'"""
+    # /sys/class/iscsi_session/sessionN/device -> .../hostM/sessionN
+    device = os.path.realpath(os.path.join(
+        SYSFS_SESSION_ROOT, "session%d" % session_id, "device"))
+    host = os.path.basename(os.path.dirname(device))
+    with open("/sys/class/scsi_host/%s/scan" % host, "w") as fd:
+        fd.write("- - -\n")
+
+
+class ISCSISessionStore(object):
+
+    def __init__(self, path):
+        self.__path = path
+        self.__connect()
+        self.create()
+
+    def __connect(self):
+        # Transactions are started explicitly, see write_context()
+        self._conn = sqlite3.connect(
+            self.__path,
+            timeout=3600,
+            isolation_level=None
+        )
+
+        self._conn.row_factory = sqlite3.Row
+
+    def create(self):
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS session(
+                iqn        TEXT    NOT NULL,
+                portal     TEXT    NOT NULL,
+                session_id INTEGER,
+                PRIMARY KEY(iqn, portal)
+            )"""
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ref(
+                iqn TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                PRIMARY KEY(iqn, ref)
+            )"""
+        )
+
+    def get_session_id(self, iqn, portal):
+        res = self._conn.execute("""
+            SELECT session_id
+              FROM session
+             WHERE iqn = :iqn AND portal = :portal""",
+            {"iqn": iqn, "portal": portal}
+        )
+        row = res.fetchone()
+        if row:
+            return row['session_id']
+        return None
+
+    def set_session_id(self, iqn, portal, session_id):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO session(iqn, portal, session_id)
+            VALUES (:iqn, :portal, :session_id)""",
+            {"iqn": iqn, "portal": portal, "session_id": session_id}
+        )
+
+    def delete_sessions(self, iqn):
+        self._conn.execute(
+            "DELETE FROM session WHERE iqn = :iqn", {"iqn": iqn})
+
+    def add_ref(self, iqn, ref):
+        self._conn.execute(
+            "INSERT OR IGNORE INTO ref(iqn, ref) VALUES (:iqn, :ref)",
+            {"iqn": iqn, "ref": ref}
+        )
+
+    def remove_ref(self, iqn, ref):
+        """Drop [ref] on [iqn]; returns the number of remaining refs"""
+        self._conn.execute(
+            "DELETE FROM ref WHERE iqn = :iqn AND ref = :ref",
+            {"iqn": iqn, "ref": ref}
+        )
+        return self.get_refcount(iqn)
+
+    def get_refs(self, iqn):
+        res = self._conn.execute(
+            "SELECT ref FROM ref WHERE iqn = :iqn", {"iqn": iqn})
+        return [row[0] for row in res]
+
+    def get_refcount(self, iqn):
+        res = self._conn.execute(
+            "SELECT COUNT(*) FROM ref WHERE iqn = :iqn", {"iqn": iqn})
+        return res.fetchone()[0]
+
+    @contextmanager
+    def write_context(self):
+        # Take the write lock up front, so that reading and updating
+        # the refs is atomic. Keep it short: the store is shared by
+        # every target, see libiscsi._lock_target
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def close(self):
+        self._conn.close()
@@ -4,6 +4,7 @@ import os, sys
 import time
 import urlparse
 import stat
+import xapi.storage.api.volume
 from xapi.storage.common import call
 from xapi.storage import log
 import xapi.storage.libs.poolhelper
@@ -13,10 +14,69 @@ import socket
 import scsiutil
 import fcntl
 from xapi.storage.libs import util
+from xapi.storage.libs import devwait
+from xapi.storage.libs import multipath
+from xapi.storage.libs import iscsisessions
 
 DEFAULT_PORT = 3260
 ISCSI_REFDIR = '/var/run/sr-ref'
+ISCSI_SESSION_DB = 'iscsi-sessions.db'
 DEV_PATH_ROOT = '/dev/disk/by-id/scsi-'
+BY_PATH_ROOT = '/dev/disk/by-path/'
+# Used to be 'udevadm settle' followed by up to 9s of polling; now the
+# wait returns as soon as the nodes appear, so allow slow udev more time
+DEVICE_WAIT_TIMEOUT = 30 # seconds
+
+# Tuning profiles, selected with iscsi://...?tuning_profile=<name> or the
+# 'tuning_profile' SR configuration key. 'session' values are written to
+# the node records before login; 'queue' values go to
+# /sys/block/<dev>/queue/ once the device has appeared. Profiles do not
+# set node.session.nr_sessions: sessions are tracked, and paths found,
+# one per portal (see login() and getLUNPathDevices()). The profile of
+# each LUN is recorded in the pool's other-config under
+# TUNING_POOL_KEY, so that every host knows it before logging in.
+DEFAULT_TUNING_PROFILE = 'default'
+TUNING_PROFILES = {
+    # Leave everything as open-iscsi and the kernel set it
+    'default': {
+        'session': {},
+        'queue': {}
+    },
+    # Dozens of VMs doing small random I/O on one LUN
+    'dense': {
+        'session': {
+            'node.session.cmds_max': '1024',
+            'node.session.queue_depth': '128',
+            'node.conn[0].iscsi.MaxRecvDataSegmentLength': '262144',
+            'node.session.iscsi.FirstBurstLength': '262144'
+        },
+        'queue': {
+            'nr_requests': '1024',
+            'read_ahead_kb': '128',
+            'max_sectors_kb': '512'
+        }
+    },
+    # Few VMs streaming large sequential I/O
+    'throughput': {
+        'session': {
+            'node.session.cmds_max': '512',
+            'node.session.queue_depth': '64',
+            'node.conn[0].iscsi.MaxRecvDataSegmentLength': '262144',
+            'node.session.iscsi.FirstBurstLength': '524288'
+        },
+        'queue': {
+            'nr_requests': '256',
+            'read_ahead_kb': '4096',
+            'max_sectors_kb': '1024'
+        }
+    }
+}
+
+TUNING_POOL_KEY = "iscsi_tuning_profile_%s"  # SCSI id
+
+# Reported by getTuning() whatever the profile
+TUNING_SESSION_KEYS = sorted(TUNING_PROFILES['dense']['session'].keys())
+TUNING_QUEUE_KEYS = sorted(TUNING_PROFILES['dense']['queue'].keys())
 
 def queryLUN(dbg, path, id):
     vendor = scsiutil.getmanufacturer(dbg, path)
@@ -96,7 +156,7 @@ def discoverIQN(dbg, keys, interfaceArray=["default"]):
     return parse_node_output(stdout)
 
 
-def set_chap_settings(dbg, portal, target, username, password):
+def set_chap_settings(dbg, portal, iqn, username, password):
     cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T", iqn, "--portal", 
            portal, "--op", "update", "-n", "node.session.auth.authmethod", 
            "-v", "CHAP"]
@@ -116,104 +176,360 @@ def set_chap_settings(dbg, portal, target, username, password):
 
 def get_device_path(dbg, uri):
     keys = decomposeISCSIuri(dbg, uri)
+    # Prefer the multipath map if the LUN is reached over several portals
+    mp = multipath.find(dbg, keys['scsiid'])
+    if mp:
+        return mp.block_device()
     dev_path = DEV_PATH_ROOT + keys['scsiid']
     return dev_path
 
 
-def login(dbg, ref_str, keys):
+def getPortals(dbg, keys):
+    """Return the portals (ip:port) through which the target
+       keys['iqn'] can be reached, in discovery order"""
     iqn_map = discoverIQN(dbg, keys)
-    output = iqn_map[0] 
-    # FIXME: only take the first one returned. 
-    # This might not always be the one we want.
-    log.debug("%s: output = %s" % (dbg, output))
-    portal = output[0]
+    portals = []
+    for (portal, tpgt, iqn) in iqn_map:
+        if iqn == keys['iqn'] and portal not in portals:
+            portals.append(portal)
+    if not portals and iqn_map:
+        # Keep the old behaviour if the target didn't report the IQN
+        log.debug("%s: %s not in discovery output %s, using first portal" %
+                  (dbg, keys['iqn'], iqn_map))
+        portals.append(iqn_map[0][0])
+    return portals
+
+
+def applySessionTuning(dbg, portal, iqn, profile):
+    """Update the node record of [iqn] on [portal] with the session
+       parameters of tuning [profile]; takes effect at the next login"""
+    for name, value in sorted(TUNING_PROFILES[profile]['session'].items()):
+        cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T", iqn, "--portal",
+               portal, "--op", "update", "-n", name, "-v", value]
+        call(dbg, cmd)
+
+
+def applyQueueTuning(dbg, dev_path, profile):
+    """Write the block queue settings of tuning [profile] to [dev_path]"""
+    queue_dir = "/sys/block/%s/queue" % (
+                os.path.basename(os.path.realpath(dev_path)))
+    for name, value in sorted(TUNING_PROFILES[profile]['queue'].items()):
+        try:
+            with open(os.path.join(queue_dir, name), "w") as fd:
+                fd.write("%s\n" % value)
+        except IOError as e:
+            # e.g. max_sectors_kb above what the hardware allows
+            log.debug("%s: cannot set %s=%s on %s: %s" %
+                      (dbg, name, value, dev_path, e))
+
+
+def applyTuning(dbg, uri, profile):
+    """Apply tuning [profile] to an already zoned-in LUN: the queue
+       settings immediately, the session ones from the next login"""
+    keys = decomposeISCSIuri(dbg, urlparse.urlparse(uri))
+    for portal in getPortals(dbg, keys):
+        applySessionTuning(dbg, portal, keys['iqn'], profile)
+    dev_path = get_device_path(dbg, urlparse.urlparse(uri))
+    applyQueueTuning(dbg, dev_path, profile)
+    if dev_path.startswith(multipath.MAPPER_ROOT):
+        for path_dev in multipath.find(dbg, keys['scsiid']).slaves(dbg):
+            applyQueueTuning(dbg, "/dev/" + path_dev, profile)
+
+
+def getPoolTuningProfile(dbg, scsiid):
+    """Return the tuning profile recorded in the pool for the LUN
+       [scsiid], or None"""
+    def get(session):
+        pool = session.xenapi.pool.get_all()[0]
+        return session.xenapi.pool.get_other_config(pool).get(
+            TUNING_POOL_KEY % scsiid)
+    try:
+        profile = xapi.storage.libs.poolhelper.with_session(dbg, get)
+    except Exception:
+        log.error("%s: cannot read the tuning profile of %s: %s" %
+                  (dbg, scsiid, sys.exc_info()[1]))
+        return None
+    if profile is not None and profile not in TUNING_PROFILES:
+        log.error("%s: ignoring unknown tuning profile %s of %s" %
+                  (dbg, profile, scsiid))
+        return None
+    return profile
+
+
+def setPoolTuningProfile(dbg, scsiid, profile):
+    """Record in the pool that the LUN [scsiid] uses tuning [profile]"""
+    def put(session):
+        pool = session.xenapi.pool.get_all()[0]
+        session.xenapi.pool.remove_from_other_config(
+            pool, TUNING_POOL_KEY % scsiid)
+        session.xenapi.pool.add_to_other_config(
+            pool, TUNING_POOL_KEY % scsiid, profile)
+    try:
+        xapi.storage.libs.poolhelper.with_session(dbg, put)
+    except Exception:
+        # The other hosts will apply it when they next log in
+        log.error("%s: cannot record tuning profile %s of %s: %s" %
+                  (dbg, profile, scsiid, sys.exc_info()[1]))
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as fd:
+            return fd.read().strip()
+    except IOError:
+        return None
+
+
+def getTuning(dbg, keys):
+    """Return the effective tuning of the LUN described by [keys]: the
+       session parameters recorded for each portal and the queue
+       settings of the device(s) currently in use"""
+    sessions = {}
+    for portal in keys['portals']:
+        cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T", keys['iqn'],
+               "--portal", portal]
+        record = {}
+        for line in call(dbg, cmd, error=False).split('\n'):
+            if ' = ' in line:
+                (name, value) = line.split(' = ', 1)
+                if name.strip() in TUNING_SESSION_KEYS:
+                    record[name.strip()] = value.strip()
+        sessions[portal] = record
+
+    dev_path = DEV_PATH_ROOT + keys['scsiid']
+    mp = multipath.find(dbg, keys['scsiid'])
+    devs = [os.path.basename(os.path.realpath(dev_path))]
+    if mp:
+        devs = [os.path.basename(os.path.realpath(mp.block_device()))] + \
+               mp.slaves(dbg)
+    queues = {}
+    for dev in devs:
+        queue = {}
+        for name in TUNING_QUEUE_KEYS:
+            queue[name] = _read_sysfs("/sys/block/%s/queue/%s" % (dev, name))
+        queue['queue_depth'] = _read_sysfs(
+            "/sys/block/%s/device/queue_depth" % dev)
+        queues[dev] = queue
+
+    return {
+        'profile': keys['tuning_profile'],
+        'sessions': sessions,
+        'queues': queues
+    }
+
+
+def login(dbg, ref_str, keys):
+    # Log in to every portal of the target, so that dm-multipath can
+    # spread the I/O over one session (and NIC) per portal
+    portals = getPortals(dbg, keys)
+    log.debug("%s: portals for %s = %s" % (dbg, keys['iqn'], portals))
+    keys['portals'] = portals
     # FIXME: error handling
 
    # Provide authentication details if necessary
     if keys['username'] != None:
-        set_chap_settings(dbg, portal, keys['target'], 
-                          keys['username'], keys['password'])
-
-    # Lock refcount file before login
-    if not os.path.exists(ISCSI_REFDIR):
-        os.mkdir(ISCSI_REFDIR)
-    filename = os.path.join(ISCSI_REFDIR, keys['iqn'])
-
-    f = util.lock_file(dbg, filename, "a+")
-
-    current_sessions = listSessions(dbg)
-    log.debug("%s: current iSCSI sessions are %s" % (dbg, current_sessions))
-    sessionid = findMatchingSession(dbg, portal, keys['iqn'], current_sessions)
-    if sessionid:
-        # If there's an existing session, rescan it 
-        # in case new LUNs have appeared in it
-        log.debug("%s: rescanning session %d for %s on %s" % 
-                   (dbg, sessionid, keys['iqn'], keys['target']))
-        rescanSession(dbg, sessionid)
-    else:
-        # Otherwise, perform a fresh login
-        cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T", keys['iqn'], 
-               "--portal", portal, "-l"]
-        output = call(dbg, cmd)
-        log.debug("%s: output = %s" % (dbg, output))
-        # FIXME: check for success
-
-   # Increment refcount
-    found = False
-    for line in f.readlines():
-        if line.find(ref_str) != -1:
-            found = True
-    if not found:
-        f.write("%s\n" % ref_str)
-
-    util.unlock_file(dbg, f)
+        for portal in portals:
+            set_chap_settings(dbg, portal, keys['iqn'],
+                              keys['username'], keys['password'])
+
+    # Session parameters must be in the node records before login
+    for portal in portals:
+        applySessionTuning(dbg, portal, keys['iqn'], keys['tuning_profile'])
+
+    # Only logins and logouts of the same target wait for each other;
+    # iscsiadm may take as long as the login timeout, so it must not
+    # run inside a transaction of the store shared by every target
+    lock = _lock_target(dbg, keys['iqn'])
+    try:
+        store = openSessionStore(dbg)
+        try:
+            with store.write_context():
+                _import_legacy_refs(dbg, store, keys['iqn'])
+                recorded = dict([(portal, store.get_session_id(
+                    keys['iqn'], portal)) for portal in portals])
+
+            sessionids = {}
+            for portal in portals:
+                sessionid = recorded[portal]
+                if sessionid is not None and \
+                   not iscsisessions.session_is_live(sessionid, keys['iqn']):
+                    sessionid = None
+                if sessionid is None:
+                    # Logged in by someone else, or before the store existed
+                    sessionid = iscsisessions.find_live_session(
+                        keys['iqn'], portal)
+                if sessionid is not None:
+                    # If there's an existing session, rescan it
+                    # in case new LUNs have appeared in it
+                    log.debug("%s: rescanning session %d for %s on %s" %
+                               (dbg, sessionid, keys['iqn'], portal))
+                    iscsisessions.rescan_session(sessionid)
+                else:
+                    # Otherwise, perform a fresh login
+                    cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T",
+                           keys['iqn'], "--portal", portal, "-l"]
+                    output = call(dbg, cmd)
+                    log.debug("%s: output = %s" % (dbg, output))
+                    # FIXME: check for success
+                    sessionid = iscsisessions.find_live_session(
+                        keys['iqn'], portal)
+                sessionids[portal] = sessionid
+
+            with store.write_context():
+                for portal in portals:
+                    store.set_session_id(keys['iqn'], portal,
+                                         sessionids[portal])
+                # Increment refcount
+                store.add_ref(keys['iqn'], ref_str)
+        finally:
+            store.close()
+    finally:
+        util.unlock_file(dbg, lock)
 
     waitForDevice(dbg, keys)
 
     # Return path to logged in target
-    target_path = "/dev/iscsi/%s/%s" % (keys['iqn'], portal)
+    target_path = "/dev/iscsi/%s/%s" % (keys['iqn'], portals[0])
     return target_path
 
 
-def logout(dbg, ref_str, iqn):
+def _ref_scsiid(dbg, ref_str):
+    # Refs taken by zoneInLUN are the SR's URI; others, e.g. those of
+    # probes, are not for any particular LUN
+    try:
+        return decomposeISCSIuri(dbg, urlparse.urlparse(ref_str))['scsiid']
+    except Exception:
+        return None
+
+
+def logout(dbg, ref_str, iqn, scsiid=None):
+    """Drop [ref_str] on [iqn], logging out of it with the last ref. The
+       multipath map of the LUN [scsiid] goes with the last ref to it."""
+    lock = _lock_target(dbg, iqn)
+    try:
+        store = openSessionStore(dbg)
+        try:
+            with store.write_context():
+                _import_legacy_refs(dbg, store, iqn)
+                refcount = store.remove_ref(iqn, ref_str)
+                remaining = store.get_refs(iqn)
+                if not refcount:
+                    store.delete_sessions(iqn)
+        finally:
+            store.close()
+
+        if scsiid is not None and scsiid not in \
+           [_ref_scsiid(dbg, ref) for ref in remaining]:
+            # The map must go before the sessions do, or it would
+            # queue I/O
+            mp = multipath.find(dbg, scsiid)
+            if mp:
+                mp.destroy(dbg)
+        if not refcount:
+            cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T", iqn, "-u"]
+            call(dbg, cmd)
+    finally:
+        util.unlock_file(dbg, lock)
+
+
+def _lock_target(dbg, iqn):
+    # Not the file named after the IQN: that is a legacy refcount file
+    if not os.path.exists(ISCSI_REFDIR):
+        os.mkdir(ISCSI_REFDIR)
+    return util.lock_file(dbg, os.path.join(ISCSI_REFDIR, iqn + ".lock"))
+
+
+def openSessionStore(dbg):
+    if not os.path.exists(ISCSI_REFDIR):
+        os.mkdir(ISCSI_REFDIR)
+    return iscsisessions.ISCSISessionStore(
+        os.path.join(ISCSI_REFDIR, ISCSI_SESSION_DB))
+
+
+def _import_legacy_refs(dbg, store, iqn):
+    # Refcounts used to be kept as lines in /var/run/sr-ref/<iqn>
     filename = os.path.join(ISCSI_REFDIR, iqn)
     if not os.path.exists(filename):
-        return 
-
-    f = util.lock_file(dbg, filename, "r+")
-
-    refcount = 0
-    file_content = f.readlines()
-    f.seek(0,0)
-    for line in file_content:
-        if line.find(ref_str) == -1:
-            f.write(line)
-            refcount += 1
-    f.truncate()
-
-    if not refcount:
-        os.unlink(filename)
-        cmd = ["/usr/sbin/iscsiadm", "-m", "node", "-T", iqn, "-u"]
-        call(dbg, cmd)
+        return
+    with open(filename) as f:
+        for line in f.readlines():
+            if line.strip():
+                store.add_ref(iqn, line.strip())
+    log.debug("%s: imported legacy refcount file %s" % (dbg, filename))
+    os.unlink(filename)
 
-    util.unlock_file(dbg, f)
-        
 
 def waitForDevice(dbg, keys):
     # Wait for new device(s) to appear
-    cmd = ["/usr/sbin/udevadm", "settle"]
-    call(dbg, cmd)
+    if keys['scsiid'] != None:
+        missing = waitForDevices(dbg, [keys['scsiid']])
+        if missing:
+            # Fail here rather than later, on a path that isn't there
+            raise xapi.storage.api.volume.Unimplemented(
+                "Devices did not appear within %ds: %s" %
+                (DEVICE_WAIT_TIMEOUT, ", ".join(missing)))
+    else:
+        # No particular LUN to wait for (e.g. probing a target):
+        # just let udev finish creating whatever appeared
+        cmd = ["/usr/sbin/udevadm", "settle"]
+        call(dbg, cmd)
+
+
+def waitForDevices(dbg, scsiids, timeout=DEVICE_WAIT_TIMEOUT):
+    """Wait until udev has created the by-id node of every SCSI id in
+       [scsiids]. Returns as soon as the last one appears; returns the
+       list of ids still missing once [timeout] seconds have passed."""
+    paths = [DEV_PATH_ROOT + scsiid for scsiid in scsiids]
+    missing = devwait.wait_for_paths(dbg, paths, timeout)
+    if missing:
+        log.debug("%s: devices did not appear within %ds: %s" %
+                  (dbg, timeout, sorted(missing)))
+    return [path[len(DEV_PATH_ROOT):] for path in sorted(missing)]
+
+
+def getLUNPathDevices(dbg, keys, timeout=DEVICE_WAIT_TIMEOUT):
+    """Return the block devices (e.g. /dev/sdb), one per portal in
+       keys['portals'], through which the LUN keys['scsiid'] can be
+       reached. Waits for the paths of freshly logged in sessions."""
+    dev = os.path.basename(os.path.realpath(DEV_PATH_ROOT + keys['scsiid']))
+    if dev.startswith("dm-"):
+        # Already aggregated, e.g. by multipathd
+        return ["/dev/" + slave for slave in
+                sorted(os.listdir("/sys/block/%s/slaves" % dev))]
+
+    # /sys/block/sdb/device -> .../target3:0:0/3:0:0:<lun>
+    hctl = os.path.basename(os.path.realpath("/sys/block/%s/device" % dev))
+    lun = hctl.split(':')[-1]
+
+    by_path = [BY_PATH_ROOT + "ip-%s-iscsi-%s-lun-%s" %
+               (portal, keys['iqn'], lun) for portal in keys['portals']]
+    missing = devwait.wait_for_paths(dbg, by_path, timeout)
+    if missing:
+        log.debug("%s: paths did not appear: %s" % (dbg, sorted(missing)))
+
+    devices = set(["/dev/" + dev])
+    for path in by_path:
+        if path not in missing:
+            devices.add(os.path.realpath(path))
+    return sorted(devices)
+
+
+def getPathStats(dbg, uri):
+    """Return per-path I/O counters for the LUN behind [uri], keyed by
+       path device, to check that the load is balanced"""
+    keys = decomposeISCSIuri(dbg, urlparse.urlparse(uri))
+    mp = multipath.find(dbg, keys['scsiid'])
+    if mp is None:
+        return {}
+    return mp.path_stats(dbg)
+
+
+def setScheduler(dbg, dev_path, scheduler="noop"):
+    sched_file = "/sys/block/%s/queue/scheduler" % (
+                 os.path.basename(os.path.realpath(dev_path)))
+    with open(sched_file, "w") as fd:
+        fd.write("%s\n" % scheduler)
 
-    # FIXME: For some reason, udevadm settle isn't sufficient 
-    # to ensure the device is present. Why not?
-    for i in range(1,10):
-        time.sleep(1)
-        if keys['scsiid'] != None:
-            try:
-                os.stat(DEV_PATH_ROOT + keys['scsiid'])
-                return
-            except:
-                log.debug("%s: Waiting for device to appear" % dbg)
 
 def listSessions(dbg):
     '''Return a list of (sessionid, portal, targetIQN) pairs 
@@ -313,7 +629,10 @@ def decomposeISCSIuri(dbg, uri):
            'iqn': None,
            'scsiid': None,
            'username': None,
-           'password': None
+           'password': None,
+           'path_selector': multipath.DEFAULT_PATH_SELECTOR,
+           'tuning_profile': DEFAULT_TUNING_PROFILE,
+           'portals': []
     }
 
     if uri.netloc:  
@@ -332,10 +651,30 @@ def decomposeISCSIuri(dbg, uri):
         [keys['username'], keys['password']] = keys['target'][0:atindex].split('%')
         keys['target'] = keys['target'][atindex+1:]
 
+    # Optional parameters, e.g. iscsi://<target>/<IQN>/<scsiID>?path_selector=
+    params = urlparse.parse_qs(uri.query)
+    if 'path_selector' in params:
+        keys['path_selector'] = params['path_selector'][0]
+        if keys['path_selector'] not in multipath.PATH_SELECTORS:
+            raise xapi.storage.api.volume.SR_does_not_exist(
+                  "Unknown path_selector '%s'; please use one of %s" %
+                  (keys['path_selector'],
+                   ", ".join(sorted(multipath.PATH_SELECTORS))))
+    if 'tuning_profile' in params:
+        keys['tuning_profile'] = params['tuning_profile'][0]
+        if keys['tuning_profile'] not in TUNING_PROFILES:
+            raise xapi.storage.api.volume.SR_does_not_exist(
+                  "Unknown tuning_profile '%s'; please use one of %s" %
+                  (keys['tuning_profile'],
+                   ", ".join(sorted(TUNING_PROFILES))))
+
     return keys
 
 
-def zoneInLUN(dbg, uri):
+def zoneInLUN(dbg, uri, tuning_profile=None):
+    """Log in to the LUN of [uri] and return its block device. Unless
+       [uri] names a tuning profile, the LUN is tuned according to
+       [tuning_profile], or else the profile recorded in the pool."""
     log.debug("%s: zoneInLUN uri=%s" % (dbg, uri))
 
     u = urlparse.urlparse(uri)
@@ -348,6 +687,12 @@ def zoneInLUN(dbg, uri):
                    iscsi://<target>/<targetIQN>/<lun>")
         log.debug("%s: target = '%s', iqn = '%s', scsiid = '%s'" % 
                   (dbg, keys['target'], keys['iqn'], keys['scsiid']))
+        if 'tuning_profile' not in urlparse.parse_qs(u.query):
+            keys['tuning_profile'] = \
+                tuning_profile or \
+                getPoolTuningProfile(dbg, keys['scsiid']) or \
+                DEFAULT_TUNING_PROFILE
+        log.debug("%s: tuning profile = '%s'" % (dbg, keys['tuning_profile']))
 
 
         usechap = False
@@ -361,6 +706,12 @@ def zoneInLUN(dbg, uri):
         login(dbg, uri, keys)
 
         dev_path = DEV_PATH_ROOT + keys['scsiid']
+        path_devs = getLUNPathDevices(dbg, keys)
+        log.debug("%s: paths to %s: %s" % (dbg, keys['scsiid'], path_devs))
+        if len(path_devs) > 1:
+            mp = multipath.create(dbg, keys['scsiid'], path_devs,
+                                  keys['path_selector'])
+            dev_path = mp.block_device()
     else:
         # FIXME: raise some sort of exception
         raise xapi.storage.api.volume.Unimplemented(
@@ -372,10 +723,12 @@ def zoneInLUN(dbg, uri):
             "Not a block device: %s" % dev_path)
 
     # Switch to 'noop' scheduler
-    sched_file = "/sys/block/%s/queue/scheduler" % (
-                 os.path.basename(os.readlink(dev_path)))
-    with open(sched_file, "w") as fd:
-        fd.write("noop\n")
+    setScheduler(dbg, dev_path)
+    applyQueueTuning(dbg, dev_path, keys['tuning_profile'])
+    if dev_path.startswith(multipath.MAPPER_ROOT):
+        for path_dev in path_devs:
+            setScheduler(dbg, path_dev)
+            applyQueueTuning(dbg, path_dev, keys['tuning_profile'])
 
     return dev_path
 
@@ -389,6 +742,6 @@ def zoneOutLUN(dbg, uri):
         keys = decomposeISCSIuri(dbg, u)
         log.debug("%s: iqn = %s" % (dbg, keys['iqn']))
 
-        logout(dbg, uri, keys['iqn'])
+        logout(dbg, uri, keys['iqn'], keys['scsiid'])
 
 
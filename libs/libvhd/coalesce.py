@@ -71,11 +71,17 @@ def find_leaves(vhd, db, leaf_accumulator):
         for child in children:
             find_leaves(child, db, leaf_accumulator)
 
-def tap_ctl_refresh(node, cb, opq):
-    if node.active_on:
-        node_path = cb.volumeGetPath(opq, str(node.vhd.id))
-        log.debug("VHD {} active on {}".format(node.vhd.id, node.active_on))
-        poolhelper.refresh_datapath_on_host(GC, node.active_on, node_path, node_path)
+def tap_ctl_refresh(nodes, cb, opq):
+    # One plugin call per host, however many leaves it has active
+    paths_by_host = {}
+    for node in nodes:
+        if node.active_on:
+            node_path = cb.volumeGetPath(opq, str(node.vhd.id))
+            log.debug("VHD {} active on {}".format(node.vhd.id, node.active_on))
+            paths_by_host.setdefault(node.active_on, []).append(
+                (node_path, node_path))
+    for host, paths in paths_by_host.iteritems():
+        poolhelper.refresh_datapaths_on_host(GC, host, paths)
 
 # def leaf_coalesce_snapshot(key, conn, cb, opq):
 #     log.debug("leaf_coalesce_snapshot key=%s" % key)
@@ -145,9 +151,11 @@ def non_leaf_coalesce(node, parent, uri, cb):
             log.debug(
                 ("Children {}: refreshing all "
                  "leaves: {}").format(child.id, leaves_to_refresh))
-            for leaf in leaves_to_refresh:
-                with db.write_context():
-                    tap_ctl_refresh(db.get_vdi_for_vhd(leaf.leaf_id), cb, opq)
+            tap_ctl_refresh(
+                [db.get_vdi_for_vhd(leaf.leaf_id) for leaf in leaves_to_refresh],
+                cb, opq)
+            with db.write_context():
+                for leaf in leaves_to_refresh:
                     db.remove_refresh_entry(leaf.leaf_id)
 
         # remove key
@@ -2,12 +2,13 @@ from __future__ import absolute_import
 import urlparse
 import sys
 
-from xapi.storage.libs import util, poolhelper, tapdisk, image
+from xapi.storage.libs import util, poolhelper, tapdisk, tapdiskpool, tapdiskstats, image
 from xapi.storage import log
 
 from .vhdutil import VHDUtil
 from .metabase import VHDMetabase
 from .lock import Lock
+from . import readcache
 
 def _parse_uri(uri):
     # uri will be like:
@@ -41,8 +42,9 @@ class VHDDatapath(object):
 
         vol_path = cb.volumeGetPath(opq, str(vdi.vhd.id))
         cb.volumeStopOperations(opq)
-        tap = tapdisk.create(dbg)
+        tap = tapdiskpool.create(dbg)
         tapdisk.save_tapdisk_metadata(dbg, vol_path, tap)
+        tapdiskstats.ensure_running(dbg)
         return {
             'domain_uuid': '0',
             'implementation': ['Tapdisk3', tap.block_device()],
@@ -63,7 +65,16 @@ class VHDDatapath(object):
                 vol_path = cb.volumeGetPath(opq, str(vdi.vhd.id))
                 img = image.Vhd(vol_path)
                 tap = tapdisk.load_tapdisk_metadata(dbg, vol_path)
-                tap.open(dbg, img)
+                cache_minor = None
+                # Backends without the callback do no read caching
+                read_caching = getattr(cb, "volumeReadCaching", None)
+                if vdi.vhd.parent_id is not None and \
+                   read_caching is not None and read_caching(opq):
+                    parent_path = cb.volumeGetPath(
+                        opq, str(vdi.vhd.parent_id))
+                    cache_minor = readcache.acquire(
+                        dbg, vol_path, parent_path)
+                tap.open(dbg, img, existing_parent=cache_minor)
                 tapdisk.save_tapdisk_metadata(dbg, vol_path, tap)
         db.close()
         cb.volumeStopOperations(opq)
@@ -82,6 +93,7 @@ class VHDDatapath(object):
                 vol_path = cb.volumeGetPath(opq, str(vdi.vhd.id))
                 tap = tapdisk.load_tapdisk_metadata(dbg, vol_path)
                 tap.close(dbg)
+                readcache.release(dbg, vol_path)
 
         db.close()
         cb.volumeStopOperations(opq)
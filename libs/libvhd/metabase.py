@@ -77,6 +77,7 @@ class VHDMetabase(object):
     def __init__(self, path):
         self.__path = path
         self.__connect()
+        self.__upgrade()
 
     def __connect(self):
         self._conn = sqlite3.connect(
@@ -87,6 +88,27 @@ class VHDMetabase(object):
 
         self._conn.row_factory = sqlite3.Row
 
+    def __create_pool(self):
+        # Empty VHDs created ahead of VHDVolume.create, see
+        # VHDVolume.fill_pool; [claim] is only set while one is being
+        # claimed
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pool(
+                vhd_id INTEGER PRIMARY KEY NOT NULL,
+                claim  TEXT,
+                FOREIGN KEY(vhd_id) REFERENCES vhd(id)
+            )"""
+        )
+
+    def __upgrade(self):
+        """Add the tables which SRs created by older versions lack"""
+        with self._conn:
+            tables = self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'")
+            names = [row['name'] for row in tables]
+            if 'vhd' in names and 'pool' not in names:
+                self.__create_pool()
+
     def create(self):
         with self._conn:
             self._conn.execute("""
@@ -133,6 +155,7 @@ class VHDMetabase(object):
                      FOREIGN KEY(leaf_id) REFERENCES vhd(id)
                  )"""
             )
+            self.__create_pool()
 
     def insert_vdi(self, name, description, uuid, vhd_id):
         res = self._conn.execute("""
@@ -281,6 +304,46 @@ class VHDMetabase(object):
 
         return None
 
+    def insert_pooled_vhd(self, vsize):
+        vhd = self.insert_new_vhd(vsize)
+        self._conn.execute("INSERT INTO pool(vhd_id) VALUES (:vhd_id)",
+                           {"vhd_id": vhd.id})
+        return vhd
+
+    def claim_pooled_vhd(self, vsize, claim):
+        """Take the largest pooled VHD no larger than [vsize] out of the
+           pool and return it, or None if there is none. [claim] must be
+           unique to the caller."""
+        # Marking the VHD is the first statement, so that claiming it
+        # is a single write rather than a read racing with other hosts
+        self._conn.execute("""
+            UPDATE pool
+               SET claim = :claim
+             WHERE vhd_id =
+                   (SELECT pool.vhd_id
+                      FROM pool
+                      JOIN vhd ON vhd.id = pool.vhd_id
+                     WHERE pool.claim IS NULL
+                       AND vhd.vsize <= :vsize
+                  ORDER BY vhd.vsize DESC
+                     LIMIT 1)""",
+            {"claim": claim, "vsize": vsize})
+        row = self._conn.execute("""
+            SELECT vhd.*
+              FROM pool
+              JOIN vhd ON vhd.id = pool.vhd_id
+             WHERE pool.claim = :claim""",
+            {"claim": claim}).fetchone()
+        if row is None:
+            return None
+        self._conn.execute("DELETE FROM pool WHERE claim = :claim",
+                           {"claim": claim})
+        return VHD.from_row(row)
+
+    def count_pooled_vhds(self):
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM pool WHERE claim IS NULL").fetchone()[0]
+
     def get_non_leaf_total_psize(self):
         """Returns the total psize of non-leaf VHDs"""
         total_psize = 0
@@ -335,7 +398,8 @@ class VHDMetabase(object):
         return vhds
 
     def get_garbage_vhds(self):
-        """ A garbage VHD is a leaf VHD with no associated VDI """
+        """ A garbage VHD is a leaf VHD with no associated VDI, which
+            is not in the pool either """
         res = self._conn.execute("""
             SELECT * FROM VHD
              WHERE id NOT IN
@@ -346,7 +410,10 @@ class VHDMetabase(object):
                 AND id NOT IN
                  (SELECT vhd_id 
                     FROM vdi
-                GROUP BY vhd_id)""")
+                GROUP BY vhd_id)
+                AND id NOT IN
+                 (SELECT vhd_id
+                    FROM pool)""")
 
         vhds = []
         for row in res:
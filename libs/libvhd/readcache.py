@@ -0,0 +1,234 @@
+from __future__ import absolute_import
+import os
+import re
+import sys
+import time
+import errno
+
+from xapi.storage.libs import tapdisk, tapdiskpool, image
+from xapi.storage.libs.util import lock_file, unlock_file, read_sysconfig
+from xapi.storage import log
+
+from .vhdutil import VHDUtil
+
+"""
+Host-local read cache of shared, read-only parent VHDs.
+
+Linked clones of a golden image all read the same parent blocks from
+the shared LUN. With read caching, a host-local VHD is made a child of
+the parent and opened in a tapdisk of its own with local caching
+('tap-ctl open -r'), which copies every block read through it to local
+disk; the tapdisks of the clones then read their parent through that
+tapdisk ('tap-ctl open -e') rather than from the LUN.
+
+Read caching is opt-in: the SR must have been created with read_caching
+and CONFIG_FILE must give the host a cache size. Caches nobody uses are
+evicted, least recently used first, to keep the cache directory within
+that size, and a cache is dropped once its parent is no longer the file
+it was made from, e.g. because something has been coalesced into it.
+"""
+
+CONFIG_FILE = "/etc/sysconfig/xapi-storage-read-cache"
+DEFAULT_CACHE_DIR = "/var/lib/xapi-storage/read-cache"
+CACHE_SUFFIX = ".vhdcache"
+
+LOCK_FILE = os.path.join(tapdisk.TD_PROC_METADATA_DIR, "readcache.lock")
+
+MEBIBYTE = 2**20
+
+
+def get_config(dbg):
+    """Return (cache directory, size limit in bytes) from CONFIG_FILE,
+       which may set READ_CACHE_DIR and READ_CACHE_SIZE_MIB. A size of
+       0, the default, disables read caching on this host."""
+    config = read_sysconfig(CONFIG_FILE)
+    cache_dir = config.get("READ_CACHE_DIR", DEFAULT_CACHE_DIR)
+    try:
+        size = int(config.get("READ_CACHE_SIZE_MIB", 0))
+    except ValueError:
+        log.error("%s: invalid READ_CACHE_SIZE_MIB in %s, read caching "
+                  "is disabled" % (dbg, CONFIG_FILE))
+        size = 0
+    return (cache_dir, max(size, 0) * MEBIBYTE)
+
+
+def identity(path):
+    """Identify the file behind [path]; a parent only changes when
+       something is coalesced into it"""
+    st = os.stat(path)
+    return "%d:%d:%r" % (st.st_ino, st.st_size, st.st_mtime)
+
+
+def cache_path(cache_dir, parent):
+    return os.path.join(
+        cache_dir,
+        re.sub(r'[^a-zA-Z0-9-]', '_', parent.strip('/')) + CACHE_SUFFIX)
+
+
+def _disk_usage(path):
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path, mode=0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _start(dbg, cache):
+    tap = tapdiskpool.create(dbg)
+    tap.open(dbg, image.Vhd(cache), lcache=True)
+    live = tapdisk.tap_ctl_list(dbg).get(tap.minor)
+    if live is None or not (live['args'] or '').endswith(cache):
+        tap.destroy(dbg)
+        raise Exception("cannot open read cache %s in %s" % (cache, tap))
+    tapdisk.save_tapdisk_metadata(dbg, cache, tap)
+    return tap
+
+
+def _find_running(dbg, cache):
+    tap = tapdisk.find_by_files(dbg, [cache]).get(cache)
+    if tap is None:
+        return None
+    live = tapdisk.tap_ctl_list(dbg).get(tap.minor)
+    if live is None or live['pid'] != tap.pid:
+        log.debug("%s: tapdisk %s of read cache %s has gone away" %
+                  (dbg, tap, cache))
+        tapdisk.forget_tapdisk_metadata(dbg, cache)
+        return None
+    return tap
+
+
+def _drop(dbg, registry, row):
+    """Stop the tapdisk of the cache in [row] and delete the cache"""
+    log.debug("%s: dropping read cache %s of %s" %
+              (dbg, row['cache'], row['parent']))
+    tap = tapdisk.find_by_files(dbg, [row['cache']]).get(row['cache'])
+    if tap is not None:
+        tap.destroy(dbg)
+        tapdisk.forget_tapdisk_metadata(dbg, row['cache'])
+    with registry.write_context():
+        registry.remove_read_cache(row['parent'])
+    _unlink(row['cache'])
+
+
+def _evict(dbg, registry, cache_dir, max_size):
+    """Drop the caches nobody uses, least recently used first, until the
+       cache directory fits within [max_size]; returns its size"""
+    known = set([row['cache'] for row in registry.get_read_caches()])
+    usage = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(CACHE_SUFFIX):
+            continue
+        path = os.path.join(cache_dir, name)
+        if path not in known:
+            # Left over from before a reboot: there is no telling which
+            # parent it was made from any more
+            log.debug("%s: deleting stale read cache %s" % (dbg, path))
+            _unlink(path)
+            continue
+        usage += _disk_usage(path)
+    for row in registry.get_idle_read_caches():
+        if usage <= max_size:
+            break
+        usage -= _disk_usage(row['cache'])
+        _drop(dbg, registry, row)
+    return usage
+
+
+def _acquire(dbg, registry, path, parent, cache_dir, max_size):
+    row = registry.get_read_cache(parent)
+    if row is not None and row['identity'] != identity(parent):
+        if registry.count_read_cache_users(parent) > 0:
+            log.debug("%s: %s has changed under its read cache, which "
+                      "is still in use" % (dbg, parent))
+            return None
+        _drop(dbg, registry, row)
+        row = None
+
+    if row is None:
+        _makedirs(cache_dir)
+        if _evict(dbg, registry, cache_dir, max_size) >= max_size:
+            log.debug("%s: read cache is full, not caching %s" %
+                      (dbg, parent))
+            return None
+        cache = cache_path(cache_dir, parent)
+        parent_identity = identity(parent)
+        _unlink(cache)
+        VHDUtil.snapshot(dbg, parent, cache)
+        if not os.path.exists(cache):
+            raise Exception("cannot create read cache %s" % cache)
+        with registry.write_context():
+            registry.put_read_cache(parent, cache, parent_identity,
+                                    time.time())
+        tap = None
+    else:
+        cache = row['cache']
+        tap = _find_running(dbg, cache)
+
+    if tap is None:
+        tap = _start(dbg, cache)
+    with registry.write_context():
+        registry.add_read_cache_user(path, parent)
+        registry.touch_read_cache(parent, time.time())
+    log.debug("%s: %s reads %s through read cache %s" %
+              (dbg, path, parent, tap))
+    return tap.minor
+
+
+def acquire(dbg, path, parent):
+    """Have the volume at [path] read its shared [parent] through this
+       host's read cache of it. Returns the minor of the tapdisk serving
+       the cache, to be passed to Tapdisk.open as existing_parent, or
+       None if [path] should read [parent] directly."""
+    (cache_dir, max_size) = get_config(dbg)
+    if max_size == 0:
+        return None
+    # Creates the directory holding LOCK_FILE
+    registry = tapdisk.get_registry()
+    lock = lock_file(dbg, LOCK_FILE)
+    try:
+        return _acquire(dbg, registry, os.path.realpath(path),
+                        os.path.realpath(parent), cache_dir, max_size)
+    except Exception:
+        # Caching must never stop a VM from starting
+        log.error("%s: cannot read %s through a read cache: %s" %
+                  (dbg, parent, sys.exc_info()[1]))
+        return None
+    finally:
+        unlock_file(dbg, lock)
+
+
+def release(dbg, path):
+    """Stop the volume at [path] using the read cache set up by
+       acquire(), if any, and evict whatever no longer fits"""
+    registry = tapdisk.get_registry()
+    lock = lock_file(dbg, LOCK_FILE)
+    try:
+        with registry.write_context():
+            parent = registry.remove_read_cache_user(os.path.realpath(path))
+            if parent is not None:
+                registry.touch_read_cache(parent, time.time())
+        if parent is None:
+            return
+        (cache_dir, max_size) = get_config(dbg)
+        if os.path.isdir(cache_dir):
+            _evict(dbg, registry, cache_dir, max_size)
+    except Exception:
+        log.error("%s: cannot evict read caches: %s" %
+                  (dbg, sys.exc_info()[1]))
+    finally:
+        unlock_file(dbg, lock)
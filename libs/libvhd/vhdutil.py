@@ -1,3 +1,5 @@
+import struct
+
 from xapi.storage.libs.util import call
 from xapi.storage import log
 
@@ -7,26 +9,40 @@ OPT_LOG_ERR = '--debug'
 
 VHD_UTIL_BIN = '/usr/bin/vhd-util'
 
-def __num_bits(val):
-    count = 0
-    while val:
-        count += val & 1
-        val = val >> 1
-    return count
-
-def __count_bits(bitmap):
-    count = 0
-    for i in range(len(bitmap)):
-        count += __num_bits(ord(bitmap[i]))
-    return count
+# On-disk format of a dynamic or differencing VHD: a copy of the footer
+# at the start, pointing at the dynamic header, which points at the
+# block allocation table (BAT). All fields are big-endian.
+VHD_FOOTER_SIZE = 512
+VHD_FOOTER_COOKIE = 'conectix'
+VHD_HEADER_SIZE = 1024
+VHD_HEADER_COOKIE = 'cxsparse'
+# A BAT entry of a block which has not been allocated
+VHD_BAT_UNUSED = '\xff\xff\xff\xff'
 
 class VHDUtil(object):
 
     @staticmethod
     def is_empty(dbg, vol_path):
-        cmd = [VHD_UTIL_BIN, 'read', OPT_LOG_ERR, '-B', '-n', vol_path]
-        ret = call(dbg, cmd)
-        return __count_bits(ret) == 0
+        """Whether no block of the VHD at [vol_path] has been allocated,
+           from its BAT rather than by running vhd-util"""
+        with open(vol_path, 'rb') as f:
+            footer = f.read(VHD_FOOTER_SIZE)
+            if footer[0:8] != VHD_FOOTER_COOKIE:
+                raise Exception("%s is not a VHD" % vol_path)
+            (header_offset,) = struct.unpack('>Q', footer[16:24])
+            f.seek(header_offset)
+            header = f.read(VHD_HEADER_SIZE)
+            if header[0:8] != VHD_HEADER_COOKIE:
+                raise Exception("%s is not a dynamic VHD" % vol_path)
+            (bat_offset,) = struct.unpack('>Q', header[16:24])
+            (bat_entries,) = struct.unpack('>I', header[28:32])
+            f.seek(bat_offset)
+            bat = f.read(bat_entries * len(VHD_BAT_UNUSED))
+        if len(bat) != bat_entries * len(VHD_BAT_UNUSED):
+            raise Exception("%s: BAT is truncated" % vol_path)
+        empty = bat == VHD_BAT_UNUSED * bat_entries
+        log.debug("%s: is_empty %s %s" % (dbg, vol_path, empty))
+        return empty
 
     @staticmethod
     def create(dbg, vol_path, size_mib):
@@ -51,13 +67,18 @@ class VHDUtil(object):
         return call(dbg, cmd)
 
     @staticmethod
-    def snapshot(dbg, vol_path, snap_path):
+    def snapshot(dbg, vol_path, snap_path, check_empty=True):
+        """Create the VHD [snap_path] as a child of [vol_path]. Unless
+           [check_empty] is False, vhd-util makes it a child of the
+           parent of [vol_path] instead if [vol_path] is empty."""
         cmd = [
             VHD_UTIL_BIN, 'snapshot',
             '-n', snap_path,
             '-p', vol_path,
             '-S', str(MSIZE_MIB)
         ]
+        if not check_empty:
+            cmd.append('-e')
         return call(dbg, cmd)
 
     @staticmethod
@@ -39,6 +39,26 @@ def _set_property(dbg, sr, key, field, value, cb):
     db.close()
     cb.volumeStopOperations(opq)
 
+def _freeze_for_clone(dbg, opq, db, vdi, vol_path, cb):
+    """Return (id, path, new leaf path) of a VHD which cannot change any
+    more and has the contents of [vdi], for clones to be children of.
+
+    If the leaf of [vdi] is empty, its parent will do and the new leaf
+    path is None. Otherwise the leaf is frozen by giving [vdi] a new,
+    empty leaf on top of it, to which the caller must refresh the
+    datapath of [vdi] once the metabase has been updated.
+    """
+    if vdi.vhd.parent_id is not None and VHDUtil.is_empty(dbg, vol_path):
+        return (vdi.vhd.parent_id,
+                cb.volumeGetPath(opq, str(vdi.vhd.parent_id)),
+                None)
+
+    leaf_vhd = db.insert_child_vhd(vdi.vhd.id, vdi.vhd.vsize)
+    leaf_path = cb.volumeCreate(opq, str(leaf_vhd.id), vdi.vhd.vsize)
+    VHDUtil.snapshot(dbg, vol_path, leaf_path, check_empty=False)
+    db.update_vdi_vhd_id(vdi.uuid, leaf_vhd.id)
+    return (vdi.vhd.id, vol_path, leaf_path)
+
 def _get_size_mib_and_vsize(size):
     # Calculate virtual size (round up size to nearest MiB)
     size_mib = (int(size) - 1) // MEBIBYTE + 1
@@ -63,12 +83,26 @@ class VHDVolume(object):
 
         db = VHDMetabase(meta_path)
         with db.write_context():
-            vhd = db.insert_new_vhd(vsize)
-            db.insert_vdi(name, description, vdi_uuid, vhd.id)
-            vhd_path = cb.volumeCreate(opq, str(vhd.id), vsize)
-            VHDUtil.create(dbg, vhd_path, size_mib)
+            vhd = db.claim_pooled_vhd(vsize, vdi_uuid)
+            if vhd is None:
+                vhd = db.insert_new_vhd(vsize)
+                db.insert_vdi(name, description, vdi_uuid, vhd.id)
+                vhd_path = cb.volumeCreate(opq, str(vhd.id), vsize)
+                VHDUtil.create(dbg, vhd_path, size_mib)
+                pooled_vsize = None
+            else:
+                db.insert_vdi(name, description, vdi_uuid, vhd.id)
+                pooled_vsize = vhd.vsize
+                if pooled_vsize != vsize:
+                    cb.volumeResize(opq, str(vhd.id), vsize)
+                    vhd_path = cb.volumeGetPath(opq, str(vhd.id))
+                    VHDUtil.resize(dbg, vhd_path, size_mib)
+                    db.update_vhd_vsize(vhd.id, vsize)
         db.close()
 
+        # Only some backends have space to allocate ahead of writes
+        if pooled_vsize != vsize and hasattr(cb, 'volumePreallocate'):
+            cb.volumePreallocate(opq, str(vhd.id), vsize)
         psize = cb.volumeGetPhysSize(opq, str(vhd.id))
         vdi_uri = cb.getVolumeUriPrefix(opq) + vdi_uuid
         cb.volumeStopOperations(opq)
@@ -85,6 +119,54 @@ class VHDVolume(object):
             'keys': {}
         }
 
+    @staticmethod
+    def fill_pool(dbg, sr, cb, db=None, limit=None):
+        """Create or destroy empty VHDs until the SR's pool holds as
+           many as cb.volumePoolConfig() asks for, at most [limit] of
+           them. Returns how many were created or destroyed.
+
+        create() claims a pooled VHD no larger than the volume and only
+        has to grow it, if that, instead of creating one. A caller
+        keeping the SR's metabase open may pass it as [db], in which
+        case it is used and left open.
+        """
+        opq = cb.volumeStartOperations(sr, 'w')
+        (count, pool_size) = cb.volumePoolConfig(opq)
+        size_mib, vsize = _get_size_mib_and_vsize(max(pool_size, 1))
+
+        own_db = db is None
+        if own_db:
+            db = VHDMetabase(cb.volumeMetadataGetPath(opq))
+
+        try:
+            missing = count - db.count_pooled_vhds()
+            if limit is not None:
+                missing = max(min(missing, limit), -limit)
+
+            for i in range(missing):
+                with db.write_context():
+                    vhd = db.insert_pooled_vhd(vsize)
+                    vhd_path = cb.volumeCreate(opq, str(vhd.id), vsize)
+                    VHDUtil.create(dbg, vhd_path, size_mib)
+                if hasattr(cb, 'volumePreallocate'):
+                    cb.volumePreallocate(opq, str(vhd.id), vsize)
+
+            # The pool has been made smaller
+            for i in range(-missing):
+                with db.write_context():
+                    vhd = db.claim_pooled_vhd(
+                        float('inf'), "fill_pool-" + str(uuid.uuid4()))
+                    if vhd is None:
+                        break
+                    cb.volumeDestroy(opq, str(vhd.id))
+                    db.delete_vhd(vhd.id)
+        finally:
+            if own_db:
+                db.close()
+            cb.volumeStopOperations(opq)
+
+        return abs(missing)
+
     @staticmethod
     def destroy(dbg, sr, key, cb):
         opq = cb.volumeStartOperations(sr, 'w')
@@ -123,62 +205,64 @@ class VHDVolume(object):
 
     @staticmethod
     def clone(dbg, sr, key, cb):
-        snap_uuid = str(uuid.uuid4())
-        need_extra_snap = False
+        return VHDVolume.clone_many(dbg, sr, key, 1, cb)[0]
+
+    @staticmethod
+    def clone_many(dbg, sr, key, count, cb):
+        """Clone the VDI [key] [count] times and return the new VDIs.
+
+        Every clone is a child of the same frozen parent (see
+        _freeze_for_clone), so the SR lock is taken, the VDI rebased
+        and its datapath refreshed at most once, and all the clones are
+        added to the metabase in a single transaction.
+        """
+        if count < 1:
+            return []
 
         opq = cb.volumeStartOperations(sr, 'w')
         meta_path = cb.volumeMetadataGetPath(opq)
 
+        snaps = []
         db = VHDMetabase(meta_path)
         with Lock(opq, 'gl', cb):
             with db.write_context():
                 vdi = db.get_vdi_by_id(key)
                 vol_path = cb.volumeGetPath(opq, str(vdi.vhd.id))
-                snap_vhd = db.insert_child_vhd(vdi.vhd.parent_id, vdi.vhd.vsize)
-                snap_path = cb.volumeCreate(opq, str(snap_vhd.id), vdi.vhd.vsize)
-                VHDUtil.snapshot(dbg, vol_path, snap_path)
-
-                # NB. As an optimisation, "vhd-util snapshot A->B" will check if
-                #     "A" is empty. If it is, it will set "B.parent" to "A.parent"
-                #     instead of "A" (provided "A" has a parent) and we are done.
-                #     If "B.parent" still points to "A", we need to rebase "A".
-
-                if VHDUtil.is_parent_pointing_to_path(dbg, snap_path, vol_path):
-                    need_extra_snap = True
-                    db.update_vhd_parent(snap_vhd.id, vdi.vhd.id)
-                    db.update_vdi_vhd_id(vdi.uuid, snap_vhd.id)
-                else:
+                parent_id, parent_path, leaf_path = _freeze_for_clone(
+                    dbg, opq, db, vdi, vol_path, cb)
+                for i in range(count):
+                    snap_uuid = str(uuid.uuid4())
+                    snap_vhd = db.insert_child_vhd(parent_id, vdi.vhd.vsize)
+                    snap_path = cb.volumeCreate(opq, str(snap_vhd.id), vdi.vhd.vsize)
+                    VHDUtil.snapshot(dbg, parent_path, snap_path, check_empty=False)
                     db.insert_vdi(vdi.name, vdi.description, snap_uuid, snap_vhd.id)
+                    snaps.append((snap_uuid, snap_vhd))
 
-            if need_extra_snap:
-                VHDDatapath.refresh(dbg, vdi, vol_path, snap_path)
+            if leaf_path is not None:
+                VHDDatapath.refresh(dbg, vdi, vol_path, leaf_path)
+                # Nothing writes to the old leaf any more
                 with db.write_context():
                     db.update_vhd_psize(vdi.vhd.id, cb.volumeGetPhysSize(opq, str(vdi.vhd.id)))
-                    snap_2_vhd = db.insert_child_vhd(vdi.vhd.id, vdi.vhd.vsize)
-                    snap_2_path = cb.volumeCreate(opq, str(snap_2_vhd.id), vdi.vhd.vsize)
-                    VHDUtil.snapshot(dbg, vol_path, snap_2_path)
-                    db.insert_vdi(vdi.name, vdi.description, snap_uuid, snap_2_vhd.id)
         db.close()
 
-        if need_extra_snap:
-            psize = cb.volumeGetPhysSize(opq, str(snap_2_vhd.id))
-        else:
+        results = []
+        for (snap_uuid, snap_vhd) in snaps:
             psize = cb.volumeGetPhysSize(opq, str(snap_vhd.id))
+            snap_uri = cb.getVolumeUriPrefix(opq) + snap_uuid
+            results.append({
+                'uuid': snap_uuid,
+                'key': snap_uuid,
+                'name': vdi.name,
+                'description': vdi.description,
+                'read_write': True,
+                'virtual_size': vdi.vhd.vsize,
+                'physical_utilisation': psize,
+                'uri': [DP_URI_PREFIX + snap_uri],
+                'keys': {}
+            })
 
-        snap_uri = cb.getVolumeUriPrefix(opq) + snap_uuid
         cb.volumeStopOperations(opq)
-
-        return {
-            'uuid': snap_uuid,
-            'key': snap_uuid,
-            'name': vdi.name,
-            'description': vdi.description,
-            'read_write': True,
-            'virtual_size': vdi.vhd.vsize,
-            'physical_utilisation': psize,
-            'uri': [DP_URI_PREFIX + snap_uri],
-            'keys': {}
-        }
+        return results
 
 
     @staticmethod
@@ -258,24 +342,31 @@ class VHDVolume(object):
         _set_property(dbg, sr, key, 'description', new_description, cb)
 
     @staticmethod
-    def get_sr_provisioned_size(sr, cb):
+    def get_sr_provisioned_size(sr, cb, db=None):
         """Returns tha max space the SR could end up using.
 
         This is the sum of the physical size of all snapshots,
         plus the virtual size of all VDIs.
+
+        A caller keeping the SR's metabase open may pass it as [db],
+        in which case it is used and left open.
         """
         opq = cb.volumeStartOperations(sr, 'w')
         meta_path = cb.volumeMetadataGetPath(opq)
 
-        db = VHDMetabase(meta_path)
+        own_db = db is None
+        if own_db:
+            db = VHDMetabase(meta_path)
 
-        provisioned_size = db.get_non_leaf_total_psize()
+        with db.write_context():
+            provisioned_size = db.get_non_leaf_total_psize()
 
-        for vdi in db.get_all_vdis():
-            _vdi_sanitize(vdi, opq, db, cb)
-            provisioned_size += vdi.vhd.vsize
+            for vdi in db.get_all_vdis():
+                _vdi_sanitize(vdi, opq, db, cb)
+                provisioned_size += vdi.vhd.vsize
 
-        db.close()
+        if own_db:
+            db.close()
         cb.volumeStopOperations(opq)
 
         return provisioned_size
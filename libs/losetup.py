@@ -19,11 +19,9 @@ class Loop:
         return self.loop
 
 
-def find(dbg, path):
-    """Return the active loop device associated with the given path"""
-    # The kernel loop driver will transparently follow symlinks, so
-    # we must too.
-    path = os.path.realpath(path)
+def _list(dbg):
+    """Return {backing file: loop device} for every active loop device"""
+    loops = {}
     for line in call(dbg, ["losetup", "-a"]).split("\n"):
         line = line.strip()
         if line != "":
@@ -32,9 +30,27 @@ def find(dbg, path):
             open_bracket = line.find('(')
             close_bracket = line.find(')')
             this_path = line[open_bracket + 1:close_bracket]
-            if this_path == path:
-                return Loop(path, loop)
-    return None
+            loops[this_path] = loop
+    return loops
+
+
+def find(dbg, path):
+    """Return the active loop device associated with the given path"""
+    return find_all(dbg, [path]).get(path)
+
+
+def find_all(dbg, paths):
+    """Return {path: Loop} for those of [paths] which have an active
+       loop device, from a single scan"""
+    loops = _list(dbg)
+    result = {}
+    for path in paths:
+        # The kernel loop driver will transparently follow symlinks, so
+        # we must too.
+        real_path = os.path.realpath(path)
+        if real_path in loops:
+            result[path] = Loop(real_path, loops[real_path])
+    return result
 
 
 def create(dbg, path):
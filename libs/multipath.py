@@ -0,0 +1,128 @@
+import os
+from xapi.storage import log
+from xapi.storage.common import call
+from dmsetup import blkgetsize64
+
+"""
+Use device-mapper multipath to aggregate several paths to one LUN
+"""
+
+MAPPER_ROOT = "/dev/mapper/"
+
+PATH_SELECTORS = frozenset(['round-robin', 'queue-length', 'service-time'])
+DEFAULT_PATH_SELECTOR = 'service-time'
+
+# dm-multipath tables are always expressed in 512 byte sectors
+DM_SECTOR_SIZE = 512
+
+# Fields of /sys/block/<dev>/stat, see Documentation/block/stat.txt
+STAT_FIELDS = ['read_ios', 'read_merges', 'read_sectors', 'read_ticks',
+               'write_ios', 'write_merges', 'write_sectors', 'write_ticks',
+               'in_flight', 'io_ticks', 'time_in_queue']
+
+
+def dev_t(path):
+    stats = os.stat(path)
+    return "%d:%d" % (os.major(stats.st_rdev), os.minor(stats.st_rdev))
+
+
+def table(paths, path_selector=DEFAULT_PATH_SELECTOR):
+    """Compute a single priority group multipath table spreading I/O
+       over all of [paths] with [path_selector]"""
+    if path_selector not in PATH_SELECTORS:
+        raise ValueError(
+            "'path_selector' = '{}' not one of '{}'".format(
+                path_selector, ', '.join(sorted(PATH_SELECTORS))))
+    total_sectors = blkgetsize64(paths[0]) / DM_SECTOR_SIZE
+    # <features> <hw handler> <#groups> <first group>
+    # <selector> <#selector args> <#paths> <#path args> [<path> <args>]*
+    return "0 %d multipath 1 queue_if_no_path 0 1 1 %s 0 %d 1 %s" % (
+        total_sectors, path_selector, len(paths),
+        " ".join(["%s 1" % dev_t(path) for path in paths]))
+
+
+def _sysfs_name(dbg, name):
+    # /dev/mapper/<name> -> dm-N
+    return os.path.basename(os.path.realpath(MAPPER_ROOT + name))
+
+
+class Multipath:
+
+    """An active dm-multipath map"""
+
+    def __init__(self, dbg, name):
+        self.name = name
+        existing = call(dbg, ["dmsetup", "table", self.name]).strip()
+        if " multipath " not in " %s " % existing:
+            message = ("Device mapper device %s is not a multipath map: %s" %
+                       (self.name, existing))
+            log.error("%s: %s" % (dbg, message))
+            raise ValueError(message)
+
+    def __repr__(self):
+        return "Multipath(%s)" % self.name
+
+    def slaves(self, dbg):
+        """Return the block devices (e.g. 'sdb') this map sends I/O to"""
+        slave_dir = os.path.join(
+            "/sys/block", _sysfs_name(dbg, self.name), "slaves")
+        try:
+            return sorted(os.listdir(slave_dir))
+        except OSError:
+            return []
+
+    def reload(self, dbg, paths, path_selector=DEFAULT_PATH_SELECTOR):
+        t = table(paths, path_selector)
+        call(dbg, ["dmsetup", "reload", self.name, "--table", t])
+        call(dbg, ["dmsetup", "resume", self.name])
+
+    def destroy(self, dbg):
+        call(dbg, ["dmsetup", "remove", self.name])
+
+    def block_device(self):
+        return MAPPER_ROOT + self.name
+
+    def path_stats(self, dbg):
+        """Return the I/O counters of every path in this map, keyed
+           by block device name, so that load balancing can be checked"""
+        stats = {}
+        for slave in self.slaves(dbg):
+            try:
+                with open(os.path.join("/sys/block", slave, "stat")) as f:
+                    values = [long(x) for x in f.read().split()]
+            except (IOError, ValueError):
+                continue
+            counters = dict(zip(STAT_FIELDS, values))
+            counters['read_bytes'] = counters['read_sectors'] * DM_SECTOR_SIZE
+            counters['write_bytes'] = (counters['write_sectors'] *
+                                       DM_SECTOR_SIZE)
+            stats[slave] = counters
+        return stats
+
+
+def find(dbg, name):
+    """Return the multipath map called [name], if there is one"""
+    if not os.path.exists(MAPPER_ROOT + name):
+        return None
+    try:
+        return Multipath(dbg, name)
+    except:
+        return None
+
+
+def create(dbg, name, paths, path_selector=DEFAULT_PATH_SELECTOR):
+    """Return a multipath map called [name] over [paths], creating it
+       or reloading it with the current set of paths as required"""
+    existing = find(dbg, name)
+    wanted = sorted([os.path.basename(os.path.realpath(p)) for p in paths])
+    if existing:
+        if existing.slaves(dbg) != wanted:
+            log.debug("%s: reloading %s with paths %s" %
+                      (dbg, existing, wanted))
+            existing.reload(dbg, paths, path_selector)
+        return existing
+    call(dbg, ["dmsetup", "create", name, "--table",
+               table(paths, path_selector)])
+    # Let multipathd monitor (and reinstate) the paths of the new map
+    call(dbg, ["multipathd", "add", "map", name], error=False)
+    return Multipath(dbg, name)
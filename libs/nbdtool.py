@@ -1,17 +1,75 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import io
 import os
+import re
+import mmap
+import sys
+import json
+import time
 import signal
 import errno
 import pickle
+import socket
+import struct
+import urlparse
+import subprocess
+
+from xapi.storage import log
 
 """
-Use "nbd-tool" to mirror disks between servers.
+Mirror disks to NBD servers.
+
+Once tapdisk mirrors a disk's writes to the destination (see
+Tapdisk.start_mirror), the data already on the disk still has to be
+copied across. That bulk copy runs in the background here. After each
+chunk is written to the destination, the source is read again: if the
+chunk has changed in the meantime the copy may have overwritten a
+mirrored write with stale data, so the chunk is marked dirty and copied
+again in the next pass. The mirror has converged once a pass finds
+nothing dirty, and from then on tapdisk keeps the destination in sync.
 """
 
 persist_root = "/tmp/persist-nbdtool/"
 
+CHUNK_SIZE = 1024 * 1024
+# Give up if the guest keeps re-dirtying chunks faster than we copy
+MAX_PASSES = 10
+# How often the copy records its progress
+PROGRESS_INTERVAL = 1.0
+
+# Fixed newstyle handshake, see the NBD protocol document
+NBD_MAGIC = "NBDMAGIC"
+NBD_OPTS_MAGIC = "IHAVEOPT"
+NBD_CLISERV_MAGIC = 0x00420281861253
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+NBD_OPT_EXPORT_NAME = 1
+
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+
+NBD_REQUEST = struct.Struct(">IHHQQI")
+NBD_REPLY = struct.Struct(">IIQ")
+
+
+class NbdError(Exception):
+    pass
+
 
 def path_to_persist(mirror):
-    return persist_root + mirror.pid
+    return persist_root + str(mirror.pid)
+
+
+def path_to_progress(mirror):
+    return path_to_persist(mirror) + ".progress"
 
 """
 ToDo: what is persist_foor?
@@ -20,6 +78,242 @@ def clear():
 """
 
 
+def _recv_exactly(sock, length):
+    chunks = []
+    while length > 0:
+        data = sock.recv(min(length, 1024 * 1024))
+        if not data:
+            raise NbdError("connection closed by the NBD server")
+        chunks.append(data)
+        length -= len(data)
+    return "".join(chunks)
+
+
+def connect(uri):
+    """Connect to the NBD server at [uri], either
+       nbd://host[:port]/export or nbd+unix:///export?socket=path"""
+    u = urlparse.urlparse(uri)
+    if u.scheme == "nbd":
+        sock = socket.create_connection((u.hostname, u.port or 10809))
+    elif u.scheme == "nbd+unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(urlparse.parse_qs(u.query)["socket"][0])
+    else:
+        raise ValueError("not an NBD uri: %s" % uri)
+    return sock
+
+
+def export_name(uri):
+    return urlparse.urlparse(uri).path.lstrip("/")
+
+
+class NbdClient(object):
+
+    """A minimal NBD client, enough to copy a disk to a server"""
+
+    def __init__(self, sock, name=""):
+        self.sock = sock
+        self.handle = 0
+        self.size = self.__handshake(name)
+
+    def __handshake(self, name):
+        if _recv_exactly(self.sock, 8) != NBD_MAGIC:
+            raise NbdError("not an NBD server")
+        magic = _recv_exactly(self.sock, 8)
+        if magic == NBD_OPTS_MAGIC:
+            (flags,) = struct.unpack(">H", _recv_exactly(self.sock, 2))
+            if not flags & NBD_FLAG_FIXED_NEWSTYLE:
+                raise NbdError("NBD server is not fixed newstyle")
+            client_flags = NBD_FLAG_C_FIXED_NEWSTYLE
+            if flags & NBD_FLAG_NO_ZEROES:
+                client_flags |= NBD_FLAG_C_NO_ZEROES
+            self.sock.sendall(struct.pack(">I", client_flags))
+            self.sock.sendall(NBD_OPTS_MAGIC +
+                              struct.pack(">II", NBD_OPT_EXPORT_NAME,
+                                          len(name)) + name)
+            (size, _) = struct.unpack(">QH", _recv_exactly(self.sock, 10))
+            if not client_flags & NBD_FLAG_C_NO_ZEROES:
+                _recv_exactly(self.sock, 124)
+        elif struct.unpack(">Q", magic)[0] == NBD_CLISERV_MAGIC:
+            # Oldstyle, as spoken by tapdisk
+            (size, _) = struct.unpack(">QI", _recv_exactly(self.sock, 12))
+            _recv_exactly(self.sock, 124)
+        else:
+            raise NbdError("unknown NBD handshake")
+        return size
+
+    def __request(self, command, offset=0, length=0, data=""):
+        self.handle += 1
+        self.sock.sendall(NBD_REQUEST.pack(
+            NBD_REQUEST_MAGIC, 0, command, self.handle, offset, length) + data)
+
+    def __reply(self):
+        (magic, error, handle) = NBD_REPLY.unpack(
+            _recv_exactly(self.sock, NBD_REPLY.size))
+        if magic != NBD_REPLY_MAGIC or handle != self.handle:
+            raise NbdError("unexpected NBD reply")
+        if error != 0:
+            raise NbdError("NBD server returned error %d" % error)
+
+    def read(self, offset, length):
+        self.__request(NBD_CMD_READ, offset, length)
+        self.__reply()
+        return _recv_exactly(self.sock, length)
+
+    def write(self, offset, data):
+        self.__request(NBD_CMD_WRITE, offset, len(data), data)
+        self.__reply()
+
+    def flush(self):
+        self.__request(NBD_CMD_FLUSH)
+        self.__reply()
+
+    def close(self):
+        try:
+            self.__request(NBD_CMD_DISC)
+        finally:
+            self.sock.close()
+
+
+class Progress(object):
+
+    """How far a background copy has got"""
+
+    def __init__(self, size):
+        self.state = "copying"
+        self.size = size
+        self.copied = 0
+        self.remaining = size
+        self.passes = 0
+        self.started = time.time()
+        self.updated = self.started
+        self.error = None
+
+    def throughput(self):
+        elapsed = self.updated - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.copied / elapsed
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "size": self.size,
+            "copied": self.copied,
+            "remaining": self.remaining,
+            "passes": self.passes,
+            "throughput": self.throughput(),
+            "error": self.error
+        }
+
+
+def _write_progress(path, progress):
+    if path is None:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(progress.to_dict(), f)
+    os.rename(tmp, path)
+
+
+class _ChunkReader(object):
+
+    """Reads chunks of the open file [fd] into a page aligned buffer,
+       so that [fd] may have been opened with O_DIRECT"""
+
+    def __init__(self, fd, chunk_size):
+        self.fd = fd
+        self.file = io.FileIO(fd, "r", closefd=False)
+        # Anonymous mmaps are page aligned
+        self.buf = mmap.mmap(-1, (chunk_size + mmap.PAGESIZE - 1) //
+                             mmap.PAGESIZE * mmap.PAGESIZE)
+
+    def read(self, offset, length):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        done = self.file.readinto(self.buf)
+        return self.buf[:min(done, length)]
+
+    def close(self):
+        self.buf.close()
+
+
+def copy(dbg, source, client, progress_path=None, chunk_size=CHUNK_SIZE,
+         max_passes=MAX_PASSES):
+    """Copy the open file [source] to [client], an NbdClient, until a
+       pass finds no chunk changed behind our back. Returns the final
+       Progress.
+
+       Guest writes reach the disk through tapdisk, not through dom0's
+       page cache, so a tapdev [source] must be opened with O_DIRECT:
+       otherwise both the copy and the check read stale data and a
+       changed chunk is never found dirty."""
+    reader = _ChunkReader(source, chunk_size)
+    try:
+        return _copy(dbg, reader, client, progress_path, chunk_size,
+                     max_passes)
+    finally:
+        reader.close()
+
+
+def _copy(dbg, reader, client, progress_path, chunk_size, max_passes):
+    size = client.size
+    progress = Progress(size)
+    dirty = set(range((size + chunk_size - 1) // chunk_size))
+    last_report = 0
+    while dirty:
+        if progress.passes == max_passes:
+            progress.state = "failed"
+            progress.error = "%d chunks still dirty after %d passes" % (
+                len(dirty), max_passes)
+            log.error("%s: %s" % (dbg, progress.error))
+            _write_progress(progress_path, progress)
+            return progress
+        progress.passes += 1
+        redirtied = set()
+        for chunk in sorted(dirty):
+            offset = chunk * chunk_size
+            length = min(chunk_size, size - offset)
+            data = reader.read(offset, length)
+            client.write(offset, data)
+            if reader.read(offset, length) != data:
+                redirtied.add(chunk)
+            progress.copied += length
+            progress.remaining -= length
+            progress.updated = time.time()
+            if progress.updated - last_report >= PROGRESS_INTERVAL:
+                _write_progress(progress_path, progress)
+                last_report = progress.updated
+        dirty = redirtied
+        # The chunks to copy again are still outstanding
+        progress.remaining = sum(
+            [min(chunk_size, size - c * chunk_size) for c in dirty])
+        log.debug("%s: copy pass %d done, %d chunks dirty" %
+                  (dbg, progress.passes, len(dirty)))
+    client.flush()
+    progress.state = "converged"
+    progress.updated = time.time()
+    _write_progress(progress_path, progress)
+    return progress
+
+
+def _is_running(pid):
+    # The copy is our child if this process started it: reap it, or
+    # it would stay around as a zombie which os.kill() finds alive
+    try:
+        (reaped, _) = os.waitpid(pid, os.WNOHANG)
+        return reaped == 0
+    except OSError as exc:
+        if exc.errno != errno.ECHILD:
+            raise
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        if exc.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
 class Mirror:
 
     """An active nbd mirror"""
@@ -40,9 +334,50 @@ class Mirror:
         with open(path, 'w') as f:
             pickle.dump(self, f)
 
+    def progress(self, dbg):
+        """Return the bulk copy's progress: state ('copying',
+           'converged' or 'failed'), size, copied, remaining, passes,
+           throughput (bytes per second) and error"""
+        try:
+            with open(path_to_progress(self)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"state": "copying", "size": None, "copied": 0,
+                    "remaining": None, "passes": 0, "throughput": 0.0,
+                    "error": None}
+
+    def wait(self, dbg, timeout=None, poll_interval=PROGRESS_INTERVAL):
+        """Block until the bulk copy has converged or failed, or until
+           [timeout] seconds have passed. Returns the last progress."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            progress = self.progress(dbg)
+            if progress["state"] != "copying":
+                return progress
+            if not _is_running(self.pid):
+                # It may have recorded its final state as it exited
+                progress = self.progress(dbg)
+                if progress["state"] == "copying":
+                    progress["state"] = "failed"
+                    progress["error"] = \
+                        "copy process %d exited before finishing" % self.pid
+                    log.error("%s: %s" % (dbg, progress["error"]))
+                return progress
+            if deadline is not None and time.time() >= deadline:
+                return progress
+            time.sleep(poll_interval)
+
     def destroy(self, dbg):
-        os.kill(self.pid, signal.SIGTERM)
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
         os.unlink(path_to_persist(self))
+        try:
+            os.unlink(path_to_progress(self))
+        except OSError:
+            pass
 
 
 def find(dbg, primary, secondary):
@@ -57,6 +392,8 @@ def find(dbg, primary, secondary):
         else:
             raise
     for filename in used:
+        if filename.endswith(".progress") or filename.endswith(".tmp"):
+            continue
         with open(persist_root + filename) as file:
             mirror = pickle.load(file)
             if mirror.primary == primary and mirror.secondary == secondary:
@@ -66,18 +403,69 @@ def find(dbg, primary, secondary):
 
 def create(dbg, primary, secondary):
     """Return an active mirror associated with the given primary
-       and secondary, creating a fresh one if one doesn't already exist."""
+       and secondary, creating a fresh one if one doesn't already exist.
+
+       [primary] is the path of the disk to copy, normally the block
+       device of a tapdisk which is already mirroring its writes to
+       [secondary], the uri of an NBD export (see connect())."""
     existing = find(dbg, primary, secondary)
     if existing:
         return existing
-    """
-    TODO: spawn nbd-client
+    # Get the command to run, need to replace pyc with py as __file__ will
+    # be the byte compiled file
+    args = [os.path.abspath(re.sub("pyc$", "py", __file__)),
+            primary, secondary]
+    proc = subprocess.Popen(args, close_fds=True)
+    log.debug("%s: started copy of %s to %s, pid %d" %
+              (dbg, primary, secondary, proc.pid))
+    return Mirror(primary, secondary, proc.pid)
+
+
+def mirror_tapdisk(dbg, tap, secondary):
+    """Start mirroring [tap] to the NBD export [secondary]: new writes
+       are sent there by tapdisk, the existing data by a background
+       copy. Returns the Mirror, see Mirror.wait() and
+       Mirror.progress()."""
+    sock = connect(secondary)
     try:
-        used = set(os.listdir(persist_root))
-    except OSError as exc:
-        if exc.errno == errno.ENOENT:
+        tap.start_mirror(dbg, sock.fileno())
+    finally:
+        # tapdisk has its own reference to the connection now
+        sock.close()
+    return create(dbg, tap.block_device(), secondary)
+
+
+def run_copy(dbg, primary, secondary):
+    progress_path = persist_root + str(os.getpid()) + ".progress"
+    try:
+        client = NbdClient(connect(secondary), export_name(secondary))
+        try:
+            source = os.open(primary, os.O_RDONLY | os.O_DIRECT)
+            try:
+                copy(dbg, source, client, progress_path)
+            finally:
+                os.close(source)
+        finally:
+            client.close()
+    except Exception as e:
+        progress = Progress(None)
+        progress.state = "failed"
+        progress.error = str(e)
+        _write_progress(progress_path, progress)
+        raise
+
+
+def daemonize():
+    for fd in [0, 1, 2]:
+        try:
+            os.close(fd)
+        except OSError:
             pass
-        else:
-            raise
-    """
-    raise "Unimplemented"
+
+
+if __name__ == '__main__':
+    try:
+        daemonize()
+        run_copy("nbdtool", sys.argv[1], sys.argv[2])
+    except:
+        log.error("nbdtool: error {}".format(sys.exc_info()))
@@ -1,80 +1,377 @@
+import os
+import json
+import time
+import errno
+import fcntl
+import threading
 from xapi.storage import log
 import XenAPI
 
-def get_online_host_refs(dbg, session):
-    # This function is borrowed from xapi-project/sm.git/util.py
-    online_hosts = []
-    hosts = session.xenapi.host.get_all_records()
-    for host_ref, host_rec in hosts.iteritems():
-        metrics_ref = host_rec["metrics"]
-        metrics_rec = session.xenapi.host_metrics.get_record(metrics_ref)
-        if metrics_rec["live"]:
-            online_hosts.append(host_ref)
-    return online_hosts
+# A plugin invocation is a short-lived process, so both the xapi session
+# and the directory of pool hosts are kept in host-local files: most
+# calls then cost a single host.call_plugin RPC instead of a login,
+# a scan of every host record and a logout.
+CACHE_DIR = "/var/run/nonpersistent/xapi-storage-plugins"
+SESSION_FILE = os.path.join(CACHE_DIR, "session")
+# Held while logging in, so that the host has a single session
+SESSION_LOCK = os.path.join(CACHE_DIR, "session.lock")
+HOST_DIRECTORY_FILE = os.path.join(CACHE_DIR, "hosts.json")
+HOST_DIRECTORY_TTL = 30  # seconds
 
+# How long each host gets to answer a plugin call made to the whole pool
+PLUGIN_CALL_TIMEOUT = 60  # seconds
 
-def call_plugin_in_pool(dbg, plugin_name, plugin_function, args):
-    log.debug("%s: calling plugin '%s' function '%s' with args %s in pool" % (dbg, plugin_name, plugin_function, args))
+# Session shared by all calls made by this process
+_session_ref = None
+
+
+def _make_cache_dir():
+    try:
+        os.makedirs(CACHE_DIR, 0700)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def _write_private(path, data):
+    # Atomically replace [path]; the session ref is a root credential
+    _make_cache_dir()
+    tmp = "%s.%d" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, "w") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _force_unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def _read_session_file():
+    try:
+        with open(SESSION_FILE) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def _session_of(session_ref):
     session = XenAPI.xapi_local()
+    session._session = session_ref
+    return session
+
+
+def _logout(dbg, session_ref):
+    # xapi caps the sessions of a user: don't leave the one we replace
+    # behind, though it has most likely expired already
     try:
+        _session_of(session_ref).xenapi.session.logout()
+    except Exception as exc:
+        log.debug("%s: cannot log out of the replaced xapi session: %s" %
+                  (dbg, exc))
+
+
+def _login(dbg, stale=None):
+    """Log in and record the session for every process to use, unless
+       another process has recorded one, other than [stale], while we
+       waited for the lock"""
+    global _session_ref
+    _make_cache_dir()
+    with open(SESSION_LOCK, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        recorded = _read_session_file()
+        if recorded is not None and recorded != stale:
+            _session_ref = recorded
+            return _session_of(recorded)
+        session = XenAPI.xapi_local()
         session.xenapi.login_with_password('root', '')
-    except:
-        # ToDo: We ought to raise something else
-        raise
+        _session_ref = session._session
+        _write_private(SESSION_FILE, _session_ref)
+    log.debug("%s: logged in to xapi" % dbg)
+    if recorded is not None:
+        _logout(dbg, recorded)
+    return session
+
+
+def get_session(dbg):
+    """Return a session to the local xapi, reusing the one recorded by
+       an earlier call (of this or another process) if there is one.
+
+       Each call returns a new proxy object sharing the session, so the
+       result may be used from one thread while others use theirs."""
+    global _session_ref
+    if _session_ref is None:
+        _session_ref = _read_session_file()
+    if _session_ref is None:
+        return _login(dbg)
+    return _session_of(_session_ref)
+
+
+def _is_session_invalid(exc):
+    return (isinstance(exc, XenAPI.Failure) and
+            exc.details[0] == 'SESSION_INVALID')
+
+
+def with_session(dbg, fn):
+    """Run fn(session), logging in again once if the recorded session
+       has expired"""
+    session = get_session(dbg)
     try:
-        for host_ref in get_online_host_refs(dbg, session):
-            log.debug("%s: calling plugin '%s' function '%s' with args %s on host %s" % (dbg, plugin_name, plugin_function, args, host_ref))
-            resulttext = session.xenapi.host.call_plugin(
-                host_ref,
-                plugin_name,
-                plugin_function,
-                args)
-            log.debug("%s: resulttext = %s" % (dbg, resulttext))
-            if resulttext != "True":
-                # ToDo: We ought to raise something else
-                raise xapi.storage.api.volume.Unimplemented(
-                    "Failed to get hostref %s to run %s(%s)" %
-                    (host_ref, plugin_name, plugin_function, args))
+        return fn(session)
+    except XenAPI.Failure as exc:
+        if not _is_session_invalid(exc):
+            raise
+        log.debug("%s: xapi session expired, logging in again" % dbg)
+        return fn(_login(dbg, session._session))
+
+
+def _fetch_host_directory(dbg, session):
+    # Two RPCs whatever the size of the pool
+    hosts = session.xenapi.host.get_all_records()
+    metrics = session.xenapi.host_metrics.get_all_records()
+    directory = {}
+    for host_ref, host_rec in hosts.iteritems():
+        metrics_rec = metrics.get(host_rec["metrics"], {})
+        directory[host_rec["name_label"]] = {
+            "ref": host_ref,
+            "uuid": host_rec["uuid"],
+            "live": bool(metrics_rec.get("live", False))
+        }
+    _write_private(HOST_DIRECTORY_FILE, json.dumps(directory))
+    return directory
+
+
+def get_host_directory(dbg, session, refresh=False):
+    """Return {name_label: {'ref', 'uuid', 'live'}} for the pool's
+       hosts, from the host-local cache unless it is older than
+       HOST_DIRECTORY_TTL or [refresh] is set"""
+    if not refresh:
+        try:
+            if time.time() - os.stat(HOST_DIRECTORY_FILE).st_mtime < \
+               HOST_DIRECTORY_TTL:
+                with open(HOST_DIRECTORY_FILE) as f:
+                    return json.load(f)
+        except (OSError, IOError, ValueError):
+            pass
+    return _fetch_host_directory(dbg, session)
+
+
+def invalidate_host_directory(dbg):
+    _force_unlink(HOST_DIRECTORY_FILE)
+
+
+def get_online_host_refs(dbg, session):
+    return [host["ref"] for host in
+            get_host_directory(dbg, session).itervalues() if host["live"]]
+
+
+class PluginCallFailed(Exception):
+
+    """A plugin function did not return the result expected of it"""
+
+
+class PluginCallTimedOut(Exception):
+
+    """A host did not answer a plugin call in time: the call may still
+       take effect there"""
+
+
+def _call_plugin(dbg, session, host_ref, plugin_name, plugin_function, args,
+                 expected="True"):
+    # A plugin function whose result does not tell whether it worked
+    # is called with [expected] None: only an exception is a failure
+    resulttext = session.xenapi.host.call_plugin(
+        host_ref,
+        plugin_name,
+        plugin_function,
+        args)
+    log.debug("%s: resulttext = %s" % (dbg, resulttext))
+    if expected is not None and resulttext != expected:
+        raise PluginCallFailed(
+            "Failed to get hostref %s to run %s(%s, %s): %s" %
+            (host_ref, plugin_name, plugin_function, args, resulttext))
+    return resulttext
+
+
+class PoolPluginCallFailed(Exception):
+
+    """A plugin call made to the whole pool failed on some hosts.
+       [failures] maps each of those hosts to its error and [succeeded]
+       lists the hosts on which the call did take effect. [timed_out]
+       lists the failed hosts which did not answer, on which the call
+       may still be running."""
+
+    def __init__(self, plugin_name, plugin_function, failures, succeeded):
+        self.failures = failures
+        self.succeeded = succeeded
+        self.timed_out = sorted([
+            host_ref for (host_ref, error) in failures.iteritems()
+            if isinstance(error, PluginCallTimedOut)])
+        Exception.__init__(self, "%s.%s failed on %d host(s): %s" % (
+            plugin_name, plugin_function, len(failures),
+            "; ".join(["%s: %s" % (host_ref, error) for (host_ref, error)
+                       in sorted(failures.iteritems())])))
+
+
+def _call_plugin_on_hosts(dbg, session_ref, host_refs, plugin_name,
+                          plugin_function, args, timeout, expected="True"):
+    """Call the plugin on all of [host_refs] at once and wait at most
+       [timeout] seconds for each. Returns (succeeded, failures)."""
+    results = {}
+
+    def worker(host_ref):
+        # XenAPI proxies are not thread safe: one per host
+        session = XenAPI.xapi_local()
+        session._session = session_ref
+        try:
+            _call_plugin(dbg, session, host_ref, plugin_name,
+                         plugin_function, args, expected)
+            results[host_ref] = None
+        except Exception as exc:
+            results[host_ref] = exc
+
+    threads = []
+    for host_ref in host_refs:
+        log.debug("%s: calling plugin '%s' function '%s' with args %s on host %s" % (dbg, plugin_name, plugin_function, args, host_ref))
+        thread = threading.Thread(target=worker, args=(host_ref,))
+        # A host which never answers must not keep us alive
+        thread.daemon = True
+        thread.start()
+        threads.append((host_ref, thread))
+
+    deadline = time.time() + timeout
+    succeeded = []
+    failures = {}
+    for (host_ref, thread) in threads:
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            failures[host_ref] = PluginCallTimedOut(
+                "no answer after %ds" % timeout)
+        elif results[host_ref] is None:
+            succeeded.append(host_ref)
+        else:
+            failures[host_ref] = results[host_ref]
+    return (succeeded, failures)
+
+
+def _call_plugin_on_wave(dbg, session, host_refs, plugin_name,
+                         plugin_function, args, timeout, expected):
+    (succeeded, failures) = _call_plugin_on_hosts(
+        dbg, session._session, host_refs, plugin_name,
+        plugin_function, args, timeout, expected)
+    if failures and not succeeded:
+        # If the session has expired it has done so for every host,
+        # let with_session log in again and retry
+        errors = failures.values()
+        if all([_is_session_invalid(e) for e in errors]):
+            raise errors[0]
+    return (succeeded, failures)
+
+
+def call_plugin_in_pool(dbg, plugin_name, plugin_function, args,
+                        timeout=PLUGIN_CALL_TIMEOUT, expected="True"):
+    """Call the plugin on every online host concurrently, so the whole
+       call takes as long as the slowest host. Returns the refs of the
+       hosts called; raises PoolPluginCallFailed if any of them failed."""
+    log.debug("%s: calling plugin '%s' function '%s' with args %s in pool" % (dbg, plugin_name, plugin_function, args))
+
+    def fn(session):
+        host_refs = get_online_host_refs(dbg, session)
+        (succeeded, failures) = _call_plugin_on_wave(
+            dbg, session, host_refs, plugin_name, plugin_function, args,
+            timeout, expected)
+        if failures:
+            raise PoolPluginCallFailed(plugin_name, plugin_function,
+                                       failures, succeeded)
+        return succeeded
+
+    try:
+        return with_session(dbg, fn)
     except:
-        # ToDo: We ought to raise something else
+        # The pool may have changed under our feet
+        invalidate_host_directory(dbg)
         raise
-    finally:
-        session.xenapi.session.logout()
+
+
+def call_plugin_in_waves(dbg, waves, plugin_name, plugin_function, args,
+                         timeout=PLUGIN_CALL_TIMEOUT, expected="True"):
+    """Call the plugin on each of [waves], lists of host refs, in turn:
+       concurrently on the hosts of a wave, each of which gets [timeout]
+       seconds, and on the next wave only once all of them succeeded.
+       Returns the refs of the hosts called; raises PoolPluginCallFailed
+       as soon as a wave fails."""
+    succeeded = []
+    for (n, wave) in enumerate(waves):
+        log.debug("%s: calling plugin '%s' function '%s' with args %s on wave %d/%d: %s" % (dbg, plugin_name, plugin_function, args, n + 1, len(waves), wave))
+
+        def fn(session):
+            return _call_plugin_on_wave(
+                dbg, session, wave, plugin_name, plugin_function, args,
+                timeout, expected)
+
+        (wave_succeeded, failures) = with_session(dbg, fn)
+        succeeded.extend(wave_succeeded)
+        if failures:
+            raise PoolPluginCallFailed(plugin_name, plugin_function,
+                                       failures, succeeded)
+    return succeeded
 
 
 def call_plugin_on_host(dbg, host_name, plugin_name, plugin_function, args):
     log.debug("%s: calling plugin '%s' function '%s' with args %s on %s" % (dbg, plugin_name, plugin_function, args, host_name))
-    session = XenAPI.xapi_local()
+
+    def fn(session):
+        host = get_host_directory(dbg, session).get(host_name)
+        if host is None or not host["live"]:
+            # Maybe it has just joined or come back up
+            host = get_host_directory(dbg, session, refresh=True).get(host_name)
+        if host is None or not host["live"]:
+            log.debug("%s: host %s is not online, not calling it" %
+                      (dbg, host_name))
+            return
+        log.debug("%s: calling plugin '%s' function '%s' with args %s on host %s - %s)" % (dbg, plugin_name, plugin_function, args, host["ref"], host_name))
+        _call_plugin(dbg, session, host["ref"], plugin_name,
+                     plugin_function, args)
+
     try:
-        session.xenapi.login_with_password('root', '')
+        with_session(dbg, fn)
     except:
-        # ToDo: We ought to raise something else
+        invalidate_host_directory(dbg)
         raise
+
+
+def _suspend_in_pool(dbg, suspend_function, resume_function, args):
     try:
-        for host_ref in get_online_host_refs(dbg, session):
-            log.debug("%s: host_ref %s - host_name %s)" % (dbg, session.xenapi.host.get_name_label(host_ref), host_name))
-            if session.xenapi.host.get_name_label(host_ref) == host_name:
-                log.debug("%s: calling plugin '%s' function '%s' with args %s on host %s - %s)" % (dbg, plugin_name, plugin_function, args, host_ref, host_name))
-                resulttext = session.xenapi.host.call_plugin(
-                    host_ref,
-                    plugin_name,
-                    plugin_function,
-                    args)
-                log.debug("%s: resulttext = %s" % (dbg, resulttext))
-                if resulttext != "True":
-                    # ToDo: We ought to raise something else
-                    raise xapi.storage.api.volume.Unimplemented(
-                        "Failed to get hostref %s to run %s(%s)" %
-                        (host_ref, plugin_name, plugin_function, args))
-    except:
-        # ToDo: We ought to raise something else
+        call_plugin_in_pool(dbg, "suspend-resume-datapath", suspend_function,
+                            args, PLUGIN_CALL_TIMEOUT)
+    except PoolPluginCallFailed as exc:
+        # Our caller will not resume a datapath it failed to suspend,
+        # so don't leave it paused on the hosts which answered: one
+        # which failed part way may have paused it, and resuming a
+        # running datapath is harmless. A host which timed out may
+        # still be suspending, and a resume overtaking the suspend
+        # would leave the datapath paused for good: leave those to
+        # whoever handles exc.timed_out.
+        log.error("%s: %s" % (dbg, exc))
+        if exc.timed_out:
+            log.error("%s: not resuming %s: %s may still be in progress" %
+                      (dbg, exc.timed_out, suspend_function))
+        answered = [host_ref for host_ref in
+                    exc.succeeded + sorted(exc.failures.keys())
+                    if host_ref not in exc.timed_out]
+        session = get_session(dbg)
+        _call_plugin_on_hosts(dbg, session._session, answered,
+                              "suspend-resume-datapath", resume_function,
+                              args, PLUGIN_CALL_TIMEOUT)
         raise
-    finally:
-        session.xenapi.session.logout()
 
 
 def suspend_datapath_in_pool(dbg, path):
-    call_plugin_in_pool(dbg, "suspend-resume-datapath", "suspend_datapath", {'path': path})
+    _suspend_in_pool(dbg, "suspend_datapath", "resume_datapath", {'path': path})
 
 
 def resume_datapath_in_pool(dbg, path):
@@ -90,5 +387,22 @@ def resume_datapath_on_host(dbg, host, path):
 
 
 def refresh_datapath_on_host(dbg, host, path, new_path):
-    call_plugin_on_host(dbg, host, "suspend-resume-datapath", "refresh_datapath", 
+    call_plugin_on_host(dbg, host, "suspend-resume-datapath", "refresh_datapath",
                         {'path': path, 'new_path': new_path})
+
+
+def suspend_datapaths_in_pool(dbg, paths):
+    _suspend_in_pool(dbg, "suspend_datapaths", "resume_datapaths",
+                     {'paths': json.dumps(paths)})
+
+
+def resume_datapaths_in_pool(dbg, paths):
+    call_plugin_in_pool(dbg, "suspend-resume-datapath", "resume_datapaths",
+                        {'paths': json.dumps(paths)})
+
+
+def refresh_datapaths_on_host(dbg, host, paths):
+    """Refresh all of [paths], a list of (path, new_path) pairs, on
+       [host] in a single plugin call"""
+    call_plugin_on_host(dbg, host, "suspend-resume-datapath", "refresh_datapaths",
+                        {'paths': json.dumps(paths)})
@@ -1,8 +1,9 @@
 """RRDD Plugin Protocol V2 Backend module
 """
 
-from struct import calcsize
-from ctypes import c_char, c_int32, c_int64, c_double
+from struct import Struct
+from time import time
+from zlib import crc32
 
 HEADER = 'DATASOURCES'
 PLUGIN_PATH = '/dev/shm/metrics/'
@@ -15,17 +16,20 @@ FMT_BE_INT32 = '>i'
 FMT_BE_INT64 = '>q'
 FMT_BE_DOUBLE = '>d'
 
-# pylint: disable=protected-access
-C_INT32_SIZE = calcsize(c_int32._type_)
-C_INT64_SIZE = calcsize(c_int64._type_)
-C_DOUBLE_SIZE = calcsize(c_double._type_)
-# pylint: enable=protected-access
+# Format characters of the datasource values, within a
+# Big-Endian format string
+VALUE_FORMATS = {FLOAT: 'd', INT64: 'q'}
 
-C_INT32_TYPE = c_char * C_INT32_SIZE
-C_INT64_TYPE = c_char * C_INT64_SIZE
-C_DOUBLE_TYPE = c_char * C_DOUBLE_SIZE
+BE_INT32 = Struct(FMT_BE_INT32)
+C_INT32_SIZE = BE_INT32.size
 
-DATA_CRC32_START = len(HEADER) + 3 * C_INT32_SIZE
+# File layout: header, data crc32, metadata crc32, number of
+# datasources, then the data (timestamp and values, covered by the
+# data crc32) and finally the metadata length and the metadata
+DATA_CRC32_OFFSET = len(HEADER)
+METADATA_CRC32_OFFSET = DATA_CRC32_OFFSET + C_INT32_SIZE
+DATASOURCES_NO_OFFSET = METADATA_CRC32_OFFSET + C_INT32_SIZE
+DATA_CRC32_START = DATASOURCES_NO_OFFSET + C_INT32_SIZE
 
 class PluginBackend(object):
     def __init__(self, plugin_name):
@@ -38,10 +42,9 @@ class PluginBackend(object):
 
         self.__plugin_name = plugin_name
 
-        # All keys in this dict correspond to a specific
-        # offset in the mmapped file and all writes to
-        # them propagate to the file
-        self.__data_map = None
+        # Packs the timestamp and all the values, in the order of
+        # the datasources, into the data block of the mmapped file
+        self.__data_struct = None
 
         # mmapped file offset, up to which
         # the data crc32 is calculated
@@ -53,10 +56,6 @@ class PluginBackend(object):
         # object returned by mmap()
         self.__buffer = None
 
-        # list containing the format strings
-        # of the respective datasources
-        self.__format_list = None
-
     def __del__(self):
         from os import close as os_close, unlink
 
@@ -84,75 +83,12 @@ class PluginBackend(object):
         ).encode(metadata_dict)
 
 
-    def __map_data_to_file(self, datasource_dict):
-        """Maps self.__data_map's keys to self.__buffer.
-
-        Maps offsets of the mmapped file (self.__buffer) to
-        keys in 'self.__data_map'. All writes to the keys
-        propagate to their respective offsets in the file
-
-        Args:
-            datasource_dict: {} of Datasource objects
-        """
-        self.__data_map = {}
-
-        sz_type = c_char * len(HEADER)
-        self.__data_map['header'] = sz_type.from_buffer(self.__buffer)
-        offset = len(HEADER)
-
-        self.__data_map['data_crc32'] = C_INT32_TYPE.from_buffer(
-            self.__buffer,
-            offset
-        )
-        offset += C_INT32_SIZE
-
-        self.__data_map['metadata_crc32'] = C_INT32_TYPE.from_buffer(
-            self.__buffer,
-            offset
-        )
-        offset += C_INT32_SIZE
-
-        self.__data_map['datasources_no'] = C_INT32_TYPE.from_buffer(
-            self.__buffer,
-            offset
-        )
-        offset += C_INT32_SIZE
-
-        self.__data_map['timestamp'] = C_INT64_TYPE.from_buffer(
-            self.__buffer,
-            offset
-        )
-        offset += C_INT64_SIZE
-
-        self.__data_map['values'] = []
-        for dsource in datasource_dict.values():
-            value_type = dsource.get_property('value_type')
-
-            if value_type == FLOAT:
-                c_type = C_DOUBLE_TYPE
-                c_type_size = C_DOUBLE_SIZE
-
-            elif value_type == INT64:
-                c_type = C_INT64_TYPE
-                c_type_size = C_INT64_SIZE
-
-            self.__data_map['values'].append(
-                c_type.from_buffer(self.__buffer, offset)
-            )
-            offset += c_type_size
-
-        self.__data_map['metadata_len'] = C_INT32_TYPE.from_buffer(
-            self.__buffer,
-            offset
-        )
-        offset += C_INT32_SIZE
-
-        sz_type = c_char * len(self.__metadata_str)
-        self.__data_map['metadata'] = sz_type.from_buffer(
-            self.__buffer,
-            offset
-        )
-
+    def __create_data_struct(self, datasource_dict):
+        self.__data_struct = Struct(FMT_BE_INT64 + ''.join([
+            VALUE_FORMATS[dsource.get_property('value_type')]
+            for dsource in datasource_dict.values()
+        ]))
+        self.__data_crc32_end = DATA_CRC32_START + self.__data_struct.size
 
     def full_update(self, datasource_dict):
         """Writes datasources to mmapped file.
@@ -167,32 +103,29 @@ class PluginBackend(object):
                 collected from the plugin to be written to the
                 mmapped file
         """
-        from zlib import crc32
-        from struct import pack
-
         self.__create_metadata_string(datasource_dict)
-        self.__create_format_list(datasource_dict)
-        self.__calc_data_crc32_end(datasource_dict)
+        self.__create_data_struct(datasource_dict)
 
         self.__reset_file()
-        self.__map_data_to_file(datasource_dict)
 
-        self.__data_map['header'].raw = HEADER
-        self.__data_map['datasources_no'].raw = pack(
-            FMT_BE_INT32,
+        self.__buffer[:len(HEADER)] = HEADER
+        BE_INT32.pack_into(
+            self.__buffer,
+            DATASOURCES_NO_OFFSET,
             len(datasource_dict)
         )
 
         self.fast_update(datasource_dict)
 
-        self.__data_map['metadata_len'].raw = pack(
-            FMT_BE_INT32,
-            len(self.__metadata_str)
-        )
+        offset = self.__data_crc32_end
+        BE_INT32.pack_into(self.__buffer, offset, len(self.__metadata_str))
+        offset += C_INT32_SIZE
 
-        self.__data_map['metadata'].raw = self.__metadata_str
-        self.__data_map['metadata_crc32'].raw = pack(
-            FMT_BE_INT32,
+        self.__buffer[offset:offset + len(self.__metadata_str)] = \
+            self.__metadata_str
+        BE_INT32.pack_into(
+            self.__buffer,
+            METADATA_CRC32_OFFSET,
             crc32(self.__metadata_str)
         )
 
@@ -202,52 +135,32 @@ class PluginBackend(object):
         What it says on the tin. ONLY USE if the difference between
         this and the previous submission is the datasources' values.
 
+        The timestamp and values are written with a single pack_into()
+        and the crc32 is computed in place, through a buffer() over the
+        mmapped file rather than a copy of it.
+
         Args:
             datasource_dict: {} of Datasource objects with data
                 collected from the plugin to be written to the
                 mmapped file
         """
-        from zlib import crc32
-        from time import time
-        from struct import pack
-
-        self.__data_map['timestamp'].raw = pack(FMT_BE_INT64, int(time()))
-
-        for i, dsource in enumerate(datasource_dict.values()):
-            self.__data_map['values'][i].raw = pack(
-                self.__format_list[i],
-                dsource.get_property('value')
-            )
-
-        self.__data_map['data_crc32'].raw = pack(
-            FMT_BE_INT32,
-            crc32(self.__buffer[DATA_CRC32_START:self.__data_crc32_end])
+        self.__data_struct.pack_into(
+            self.__buffer,
+            DATA_CRC32_START,
+            int(time()),
+            *[dsource.get_property('value')
+              for dsource in datasource_dict.values()]
         )
 
-    def __create_format_list(self, datasource_dict):
-        self.__format_list = []
-
-        for dsource in datasource_dict.values():
-            value_type = dsource.get_property('value_type')
-
-            if value_type == FLOAT:
-                self.__format_list.append(FMT_BE_DOUBLE)
-            elif value_type == INT64:
-                self.__format_list.append(FMT_BE_INT64)
-
-    def __calc_data_crc32_end(self, datasource_dict):
-        dsources_size = 0
-
-        for dsource in datasource_dict.values():
-            value_type = dsource.get_property('value_type')
-
-            if value_type == FLOAT:
-                dsources_size += C_DOUBLE_SIZE
-            elif value_type == INT64:
-                dsources_size += C_INT64_SIZE
-
-        self.__data_crc32_end = DATA_CRC32_START + C_INT64_SIZE + dsources_size
-
+        BE_INT32.pack_into(
+            self.__buffer,
+            DATA_CRC32_OFFSET,
+            crc32(buffer(
+                self.__buffer,
+                DATA_CRC32_START,
+                self.__data_struct.size
+            ))
+        )
 
     def __reset_file(self):
         from os import ftruncate
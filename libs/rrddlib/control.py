@@ -7,6 +7,11 @@ SOCKPATH = '/var/xapi/xcp-rrdd'
 PLUGIN_DOMAINS = frozenset(['Local', 'Interdomain'])
 READ_FREQS = {'Five_seconds': 5}
 
+# Readings between two registrations, which resynchronise the locally
+# computed reading times with xcp-rrdd's and re-register the plugin in
+# case xcp-rrdd has been restarted
+READINGS_PER_REGISTRATION = 12
+
 class UnixStreamHTTPConnection(HTTPConnection):
     def connect(self):
         from socket import socket, AF_UNIX, SOCK_STREAM
@@ -17,7 +22,12 @@ class UnixStreamHTTPConnection(HTTPConnection):
 
 class UnixStreamTransport(Transport):
     def make_connection(self, host):
-        return UnixStreamHTTPConnection(SOCKPATH)
+        # Keep the connection open across requests, like Transport
+        # does for TCP; it is dropped and reopened on error
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        self._connection = host, UnixStreamHTTPConnection(SOCKPATH)
+        return self._connection[1]
 
 
 class PluginControlError(Exception):
@@ -74,6 +84,11 @@ class PluginControl(object):
         self.__read_freq = read_freq
         self.__dispatch = getattr(PluginControl.__plugin_proxy, plugin_domain)
 
+        # Time of the next reading by xcp-rrdd, and the number of
+        # readings left before we register again
+        self.__next_reading = None
+        self.__readings_to_registration = 0
+
     def __del__(self):
         try:
             self.__deregister()
@@ -122,22 +137,42 @@ class PluginControl(object):
         for 'time_to_reading' that is at least as large the time it takes
         for the plugin to collect its data; however, it should also not
         be much larger, since this decreases the freshness of the data.
+
+        Only every READINGS_PER_REGISTRATION readings, or after a
+        failure, do we register with the daemon to learn the time of
+        its next reading; the times of the readings in between are
+        computed from the reading period. They are kept on an absolute
+        schedule, so the time spent collecting data does not make the
+        wake-ups drift, and readings we have overslept are skipped.
         """
-        from time import sleep
+        from math import ceil
+        from time import sleep, time
         from socket import error as socket_error
 
+        period = READ_FREQS[self.__read_freq]
         while True:
-            try:
-                wait_time = self.__register() - self.__time_to_reading
-
-                if wait_time < 0:
-                    wait_time = READ_FREQS[self.__read_freq] - wait_time
-
-                sleep(wait_time)
-                return
-            except socket_error:
-                # Log this thing instead of stderr
-                msg = "Failed to contact xcp-rrdd. Sleeping for 5 seconds.."
-                print msg
-                sleep(5.0)
-
+            now = time()
+            if self.__readings_to_registration <= 0:
+                try:
+                    self.__next_reading = now + self.__register()
+                except socket_error:
+                    # Log this thing instead of stderr
+                    msg = ("Failed to contact xcp-rrdd. "
+                           "Sleeping for 5 seconds..")
+                    print msg
+                    self.__readings_to_registration = 0
+                    sleep(5.0)
+                    continue
+                self.__readings_to_registration = READINGS_PER_REGISTRATION
+            else:
+                self.__next_reading += period
+
+            wait_time = self.__next_reading - self.__time_to_reading - now
+            if wait_time < 0:
+                missed = ceil(-wait_time / period)
+                self.__next_reading += missed * period
+                wait_time += missed * period
+
+            self.__readings_to_registration -= 1
+            sleep(wait_time)
+            return
@@ -89,3 +89,36 @@ def getmanufacturer(dbg, path):
             return line.replace(' ','').split(':')[-1]
     except:
         return ''
+
+def _sysfs_size(dev):
+    with open(os.path.join('/sys/block', dev, 'size')) as f:
+        return long(f.readline()) << SECTOR_SHIFT
+
+def rescan(dbg, path):
+    """Have the kernel re-read the capacity of the LUN behind [path], a
+       SCSI disk or a multipath map over SCSI disks, growing the map to
+       match. Costs no fork unless the map has to grow.
+
+        Return:
+            size -- (long) the size of [path] in bytes
+    """
+    dev = os.path.basename(os.path.realpath(path))
+    slaves_dir = os.path.join('/sys/block', dev, 'slaves')
+    slaves = sorted(os.listdir(slaves_dir)) if os.path.isdir(slaves_dir) \
+        else []
+    for slave in slaves or [dev]:
+        try:
+            with open(os.path.join('/sys/block', slave, 'device',
+                                   'rescan'), 'w') as f:
+                f.write('1')
+        except IOError as e:
+            log.error("%s: cannot rescan %s: %s" % (dbg, slave, e))
+
+    size = _sysfs_size(dev)
+    if slaves and max([_sysfs_size(s) for s in slaves]) > size:
+        with open(os.path.join('/sys/block', dev, 'dm', 'name')) as f:
+            name = f.read().strip()
+        log.debug("%s: growing multipath map %s" % (dbg, name))
+        call(dbg, ["multipathd", "resize", "map", name], error=False)
+        size = _sysfs_size(dev)
+    return size
@@ -1,10 +1,10 @@
 import os
 import signal
+import socket
 
-# from python-fdsend
-# import fdsend
-
+import fdpass
 import image
+import tapdiskregistry
 from xapi.storage.libs.util import call
 from xapi.storage import log
 import pickle
@@ -19,6 +19,7 @@ nbdserver_prefix = "/var/run/blktap-control/nbdserver"
 
 TD_PROC_METADATA_DIR = "/var/run/nonpersistent/dp-tapdisk"
 TD_PROC_METADATA_FILE = "meta.pickle"
+TD_REGISTRY_FILE = "tapdisks.db"
 
 
 class Tapdisk:
@@ -52,12 +53,20 @@ class Tapdisk:
               str(self.pid)])
         self.f = None
 
-    def open(self, dbg, f, o_direct=True):
+    def open(self, dbg, f, o_direct=True, lcache=False,
+             existing_parent=None):
+        """Open [f]. With [lcache] reads of [f]'s parents are copied into
+           [f]; with [existing_parent] reads of [f]'s parent go through
+           the tapdisk with that minor rather than to the parent file."""
         assert (isinstance(f, image.Vhd) or isinstance(f, image.Raw))
         args = ["tap-ctl", "open", "-m", str(self.minor),
                    "-p", str(self.pid), "-a", str(f)]
         if not o_direct:
             args.append("-D")
+        if lcache:
+            args.append("-r")
+        if existing_parent is not None:
+            args = args + ["-e", str(existing_parent)]
         call(dbg, args)
         self.f = f
 
@@ -76,107 +85,262 @@ class Tapdisk:
         if f:
             cmd = cmd + ["-a", str(f)]
         if self.secondary is not None:
-            cmd = cmd + ["-2 ", self.secondary]
+            cmd = cmd + ["-2", self.secondary]
         call(dbg, cmd)
 
     def block_device(self):
         return blktap2_prefix + str(self.minor)
 
-    """
-    ToDo: fdsend needs to be imported
     def start_mirror(self, dbg, fd):
+        """Mirror all writes to the NBD server connected to [fd] as
+           well as to our primary image"""
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.connect(nbdclient_prefix + str(self.pid))
         token = "token"
-        fdsend.sendfds(sock, token, fds=[fd])
+        fdpass.sendfds(sock, token, fds=[fd])
         sock.close()
         self.secondary = "nbd:" + token
         self.pause(dbg)
         self.unpause(dbg)
-    """
 
     def stop_mirror(self, dbg):
         self.secondary = None
         self.pause(dbg)
         self.unpause(dbg)
 
-    """
-    ToDo: fdsend needs to be imported
     def receive_nbd(self, dbg, fd):
+        """Serve our image over NBD to the client connected to [fd]"""
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.connect("%s%d.%d" % (nbdserver_prefix, self.pid, self.minor))
         token = "token"
-        fdsend.sendfds(sock, token, fds=[fd])
+        fdpass.sendfds(sock, token, fds=[fd])
         sock.close()
-    """
 
 
-def create(dbg):
+def spawn(dbg):
+    """Start a new tapdisk process; returns its pid"""
     output = call(dbg, ["tap-ctl", "spawn"]).strip()
-    pid = int(output)
+    return int(output)
+
+
+def allocate(dbg):
+    """Allocate a free tapdisk minor; returns it, or None on failure"""
     output = call(dbg, ["tap-ctl", "allocate"]).strip()
     prefix = blktap2_prefix
-    minor = None
     if output.startswith(prefix):
-        minor = int(output[len(prefix):])
+        return int(output[len(prefix):])
+    return None
+
+
+def attach(dbg, minor, pid):
+    call(dbg, ["tap-ctl", "attach", "-m", str(minor), "-p", str(pid)])
+    return Tapdisk(minor, pid, None)
+
+
+def create(dbg):
+    pid = spawn(dbg)
+    minor = allocate(dbg)
     if minor is None:
         os.kill(pid, signal.SIGQUIT)
         # TODO: FIXME:  break link to XAPI
         #raise xapi.InternalError("tap-ctl allocate returned unexpected " +
         #                         "output: %s" % (output))
-    call(dbg, ["tap-ctl", "attach", "-m", str(minor), "-p", str(pid)])
-    return Tapdisk(minor, pid, None)
+    return attach(dbg, minor, pid)
 
 
 def find_by_file(dbg, f):
     log.debug("%s: find_by_file f=%s" % (dbg, f))
     assert (isinstance(f, image.Path))
     # See whether this host has any metadata about this file
-    try:
-        log.debug("%s: find_by_file trying uri=%s" % (dbg, f.path))
-        tap = load_tapdisk_metadata(dbg, f.path)
-        log.debug("%s: returning td %s" % (dbg, tap))
-        return tap
-    # TODO: FIXME: Sort this error out
-    #except xapi.storage.api.volume.Volume_does_not_exist:
-    except OSError:
-        pass
+    return find_by_files(dbg, [f.path]).get(f.path)
+
+
+def find_by_files(dbg, paths):
+    """Return {path: Tapdisk} for those of [paths] with a tapdisk on
+       this host"""
+    taps = {}
+    for path in paths:
+        try:
+            taps[path] = load_tapdisk_metadata(dbg, path)
+        except Exception:
+            pass
+    return taps
+
+
+def find_by_minor(dbg, minor):
+    """Return (path, Tapdisk) for the tapdisk with [minor], or None"""
+    row = get_registry().get_by_minor(minor)
+    if row is None:
+        return None
+    return (row['path'], _tapdisk_of_row(row))
+
+
+def find_by_pid(dbg, pid):
+    """Return [(path, Tapdisk)] for the tapdisks of process [pid]"""
+    return [(row['path'], _tapdisk_of_row(row))
+            for row in get_registry().get_by_pid(pid)]
+
+
+def list_tapdisks(dbg):
+    """Return [(path, Tapdisk)] for every tapdisk we know of on this
+       host"""
+    return [(row['path'], _tapdisk_of_row(row))
+            for row in get_registry().get_all()]
+
+
+def tap_ctl_list(dbg):
+    """Return {minor: {'pid', 'minor', 'state', 'args'}} for every
+       tapdisk minor the kernel knows about"""
+    taps = {}
+    for line in call(dbg, ["tap-ctl", "list"]).split("\n"):
+        fields = dict([field.split("=", 1) for field in line.split()
+                       if "=" in field])
+        # A spawned tapdisk without a minor yet shows 'minor=-'
+        if not fields.get("minor", "").isdigit():
+            continue
+        minor = int(fields["minor"])
+        pid = fields.get("pid", "")
+        taps[minor] = {
+            "minor": minor,
+            "pid": int(pid) if pid.isdigit() else None,
+            "state": fields.get("state"),
+            "args": fields.get("args")
+        }
+    return taps
+
+
+def reconcile(dbg, live=None):
+    """Bring the registry back in line with 'tap-ctl list', e.g. after
+       a crash: forget tapdisks which have gone away and record what
+       the survivors actually have open. [live] is the result of
+       tap_ctl_list() if the caller already has it. Returns the minors
+       which are running but which the registry knows nothing about."""
+    if live is None:
+        live = tap_ctl_list(dbg)
+    registry = get_registry()
+    with registry.write_context():
+        for row in registry.get_all():
+            tap = live.get(row['minor'])
+            if tap is None or tap['pid'] != row['pid']:
+                log.debug("%s: forgetting dead tapdisk %d/%d serving %s" %
+                          (dbg, row['minor'], row['pid'], row['path']))
+                registry.remove(row['path'])
+                continue
+            (format, image_path) = _image_columns(_image_of_args(tap['args']))
+            if (format, image_path) != (row['format'], row['image']):
+                log.debug("%s: tapdisk %d has %s open, not %s:%s" %
+                          (dbg, row['minor'], tap['args'], row['format'],
+                           row['image']))
+                registry.put(row['path'], row['minor'], row['pid'],
+                             format, image_path, row['secondary'])
+        known = set([row['minor'] for row in registry.get_all()])
+        # Spare tapdisks waiting in the pool are accounted for too
+        known.update([row['minor'] for row in registry.get_pool_members()])
+    unknown = sorted(set(live.keys()) - known)
+    if unknown:
+        log.debug("%s: tapdisk minors %s are not in the registry" %
+                  (dbg, unknown))
+    return unknown
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        try:
+            os.makedirs(TD_PROC_METADATA_DIR, mode=0755)
+        except OSError as e:
+            if e.errno != 17:  # 17 == EEXIST, which is harmless
+                raise e
+        _registry = tapdiskregistry.TapdiskRegistry(
+            os.path.join(TD_PROC_METADATA_DIR, TD_REGISTRY_FILE))
+    return _registry
+
+
+def _image_columns(f):
+    if f is None:
+        return (None, None)
+    return (f.format(), f.path)
+
+
+def _image_of_columns(format, path):
+    if format == "vhd":
+        return image.Vhd(path)
+    elif format == "raw":
+        return image.Raw(path)
+    return None
+
+
+def _image_of_args(args):
+    # tap-ctl reports what a tapdisk has open as e.g. 'vhd:/path'
+    if not args or ":" not in args:
+        return None
+    (driver, path) = args.split(":", 1)
+    if driver == "vhd":
+        return image.Vhd(path)
+    elif driver == "aio":
+        return image.Raw(path)
+    return None
+
+
+def _tapdisk_of_row(row):
+    tap = Tapdisk(row['minor'], row['pid'],
+                  _image_of_columns(row['format'], row['image']))
+    tap.secondary = row['secondary']
+    return tap
+
+
+def _legacy_metadata_file(path):
+    # Metadata used to be pickled into one directory per volume
+    return (TD_PROC_METADATA_DIR + "/" + os.path.realpath(path) + "/" +
+            TD_PROC_METADATA_FILE)
+
+
+def _import_legacy_metadata(dbg, path):
+    filename = _legacy_metadata_file(path)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r") as fd:
+        meta = pickle.load(fd)
+    tap = Tapdisk(meta['minor'], meta['pid'], meta['f'])
+    tap.secondary = meta['secondary']
+    log.debug("%s: importing legacy tapdisk metadata %s" % (dbg, filename))
+    save_tapdisk_metadata(dbg, path, tap)
+    os.unlink(filename)
+    return tap
 
-def _metadata_dir(path):
-    return TD_PROC_METADATA_DIR + "/" + os.path.realpath(path)
 
 def save_tapdisk_metadata(dbg, path, tap):
     """ Record the tapdisk metadata for this VDI in host-local storage """
-    dirname = _metadata_dir(path)
-    try:
-        os.makedirs(dirname, mode=0755)
-    except OSError as e:
-        if e.errno != 17:  # 17 == EEXIST, which is harmless
-            raise e
-    with open(dirname + "/" + TD_PROC_METADATA_FILE, "w") as fd:
-        pickle.dump(tap.__dict__, fd)
+    (format, image_path) = _image_columns(tap.f)
+    registry = get_registry()
+    with registry.write_context():
+        registry.put(os.path.realpath(path), tap.minor, tap.pid,
+                     format, image_path, tap.secondary)
 
 def load_tapdisk_metadata(dbg, path):
     """Recover the tapdisk metadata for this VDI from host-local
        storage."""
-    dirname = _metadata_dir(path)
-    log.debug("%s: load_tapdisk_metadata: trying '%s'" % (dbg, dirname))
-    filename = dirname + "/" + TD_PROC_METADATA_FILE
-    if not(os.path.exists(filename)):
+    real_path = os.path.realpath(path)
+    log.debug("%s: load_tapdisk_metadata: trying '%s'" % (dbg, real_path))
+    row = get_registry().get_by_path(real_path)
+    if row is not None:
+        return _tapdisk_of_row(row)
+    tap = _import_legacy_metadata(dbg, path)
+    if tap is None:
         # XXX throw a better exception
         raise Exception('volume doesn\'t exist')
-        #raise xapi.storage.api.volume.Volume_does_not_exist(dirname)
-    with open(filename, "r") as fd:
-        meta = pickle.load(fd)
-        tap = Tapdisk(meta['minor'], meta['pid'], meta['f'])
-        tap.secondary = meta['secondary']
-        return tap
+        #raise xapi.storage.api.volume.Volume_does_not_exist(real_path)
+    return tap
 
 def forget_tapdisk_metadata(dbg, path):
     """Delete the tapdisk metadata for this VDI from host-local storage."""
-    dirname = _metadata_dir(path)
+    registry = get_registry()
+    with registry.write_context():
+        registry.remove(os.path.realpath(path))
     try:
-        os.unlink(dirname + "/" + TD_PROC_METADATA_FILE)
+        os.unlink(_legacy_metadata_file(path))
     except:
         pass
-
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import errno
+import fcntl
+import signal
+import subprocess
+
+from xapi.storage import log
+from xapi.storage.libs import tapdisk
+from xapi.storage.libs.util import call, read_sysconfig
+
+"""
+A pool of spare tapdisks, already spawned, allocated a minor and
+attached, so that Datapath.attach can hand one out without waiting for
+three tap-ctl invocations and a process start.
+
+The pool is refilled by a background process whenever it drops below
+the low watermark, up to the high watermark. Members are recorded in
+the tapdisk registry from the moment they are spawned: any member
+which never became ready, or whose process has gone away, is reaped
+when the refill process starts.
+"""
+
+CONFIG_FILE = "/etc/sysconfig/xapi-storage-tapdisk-pool"
+DEFAULT_LOW_WATERMARK = 2
+DEFAULT_HIGH_WATERMARK = 4
+
+REPLENISH_LOCK = os.path.join(tapdisk.TD_PROC_METADATA_DIR, "pool.lock")
+
+# Debug string
+POOL = 'tapdisk-pool'
+
+
+def get_watermarks(dbg):
+    """Return (low, high) from CONFIG_FILE, which may set
+       TAPDISK_POOL_LOW and TAPDISK_POOL_HIGH. A low watermark of 0
+       disables the pool."""
+    config = read_sysconfig(CONFIG_FILE)
+    try:
+        low = int(config.get("TAPDISK_POOL_LOW", DEFAULT_LOW_WATERMARK))
+        high = int(config.get("TAPDISK_POOL_HIGH", DEFAULT_HIGH_WATERMARK))
+    except ValueError:
+        log.error("%s: invalid watermarks in %s, using the defaults" %
+                  (dbg, CONFIG_FILE))
+        (low, high) = (DEFAULT_LOW_WATERMARK, DEFAULT_HIGH_WATERMARK)
+    return (max(low, 0), max(low, high))
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def create(dbg):
+    """Return an attached tapdisk for Datapath.attach, from the pool if
+       possible, and have the pool refilled in the background"""
+    (low, high) = get_watermarks(dbg)
+    if low == 0:
+        return tapdisk.create(dbg)
+
+    registry = tapdisk.get_registry()
+    tap = None
+    dead = []
+    with registry.write_context():
+        while True:
+            member = registry.take_pool_member()
+            if member is None:
+                break
+            if _is_running(member['pid']):
+                tap = tapdisk.Tapdisk(member['minor'], member['pid'], None)
+                break
+            dead.append(member)
+        remaining = registry.count_ready_pool_members()
+    for member in dead:
+        log.debug("%s: pool tapdisk %d has died" % (dbg, member['pid']))
+        try:
+            _destroy_member(dbg, member['pid'], member['minor'], False)
+        except Exception as e:
+            # e.g. its minor has already been freed; a fresh tapdisk
+            # will do just as well
+            log.error("%s: cannot clean up pool tapdisk %d: %s" %
+                      (dbg, member['pid'], e))
+
+    if remaining < low:
+        replenish_async(dbg)
+    if tap is None:
+        log.debug("%s: tapdisk pool is empty, creating one" % dbg)
+        return tapdisk.create(dbg)
+    log.debug("%s: took %s from the tapdisk pool" % (dbg, tap))
+    return tap
+
+
+def replenish_async(dbg):
+    # Get the command to run, need to replace pyc with py as __file__ will
+    # be the byte compiled file
+    args = [os.path.abspath(re.sub("pyc$", "py", __file__)), "replenish"]
+    subprocess.Popen(args, close_fds=True)
+    log.debug("%s: started tapdisk pool refill" % dbg)
+
+
+def _destroy_member(dbg, pid, minor, attached):
+    if minor is not None:
+        if attached:
+            call(dbg, ["tap-ctl", "detach", "-m", str(minor),
+                       "-p", str(pid)])
+        call(dbg, ["tap-ctl", "free", "-m", str(minor)])
+    if _is_running(pid):
+        try:
+            os.kill(pid, signal.SIGQUIT)
+        except OSError:
+            pass
+
+
+def reap(dbg):
+    """Destroy the pool members which never became ready (their refill
+       process died half way) and forget those which have gone away,
+       along with the registry entries of tapdisks which have crashed.
+       Must only be called by the refill process, see replenish()."""
+    live = tapdisk.tap_ctl_list(dbg)
+    tapdisk.reconcile(dbg, live)
+    registry = tapdisk.get_registry()
+    for member in registry.get_pool_members():
+        pid = member['pid']
+        minor = member['minor']
+        ready = member['ready']
+        if ready and minor in live and live[minor]['pid'] == pid:
+            continue
+        log.debug("%s: reaping pool tapdisk pid=%d minor=%s ready=%d" %
+                  (dbg, pid, minor, ready))
+        _destroy_member(dbg, pid, minor, ready)
+        with registry.write_context():
+            registry.remove_pool_member(pid)
+
+
+def _add_member(dbg, registry):
+    pid = tapdisk.spawn(dbg)
+    with registry.write_context():
+        registry.add_pool_member(pid)
+    minor = tapdisk.allocate(dbg)
+    if minor is None:
+        raise Exception("tap-ctl allocate failed")
+    with registry.write_context():
+        registry.update_pool_member(pid, minor, False)
+    tapdisk.attach(dbg, minor, pid)
+    attached = tapdisk.tap_ctl_list(dbg).get(minor)
+    if attached is None or attached['pid'] != pid:
+        raise Exception("tap-ctl attach of %d to %d failed" % (minor, pid))
+    with registry.write_context():
+        registry.update_pool_member(pid, minor, True)
+
+
+def replenish(dbg):
+    """Reap leaked pool members and fill the pool up to the high
+       watermark. Only one refill runs at a time on a host."""
+    (low, high) = get_watermarks(dbg)
+    registry = tapdisk.get_registry()
+    with open(REPLENISH_LOCK, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                log.debug("%s: tapdisk pool refill already running" % dbg)
+                return
+            raise
+        reap(dbg)
+        while registry.count_ready_pool_members() < high:
+            try:
+                _add_member(dbg, registry)
+            except Exception as e:
+                # Leave what we could not finish to the next reap
+                log.error("%s: failed to add a tapdisk to the pool: %s" %
+                          (dbg, e))
+                return
+
+
+def daemonize():
+    for fd in [0, 1, 2]:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    try:
+        if sys.argv[1] == "replenish":
+            daemonize()
+            replenish(POOL)
+    except:
+        log.error("tapdiskpool: error {}".format(sys.exc_info()))
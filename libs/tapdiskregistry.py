@@ -0,0 +1,234 @@
+import sqlite3
+from contextlib import contextmanager
+
+"""
+Host-local registry of the tapdisks serving our volumes.
+
+One row per tapdisk, indexed by the (real) path of the volume it serves,
+by minor and by pid, so that finding the tapdisk for a path, or the
+volume behind a minor, is a single lookup rather than a walk of
+per-volume metadata directories.
+
+It also records the members of the pool of spawned tapdisks waiting to
+be handed out, see tapdiskpool, and the host-local read caches of shared
+parent images together with the volumes using them, see
+libvhd.readcache.
+"""
+
+
+class TapdiskRegistry(object):
+
+    def __init__(self, path):
+        self.__path = path
+        self.__connect()
+        self.create()
+
+    def __connect(self):
+        # Transactions are started explicitly, see write_context()
+        self._conn = sqlite3.connect(
+            self.__path,
+            timeout=3600,
+            isolation_level=None
+        )
+
+        self._conn.row_factory = sqlite3.Row
+
+    def create(self):
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tapdisk(
+                path      TEXT    PRIMARY KEY NOT NULL,
+                minor     INTEGER NOT NULL UNIQUE,
+                pid       INTEGER NOT NULL,
+                format    TEXT,
+                image     TEXT,
+                secondary TEXT
+            )"""
+        )
+        self._conn.execute("""
+            CREATE INDEX IF NOT EXISTS tapdisk_pid ON tapdisk(pid)"""
+        )
+        # A pool member is recorded as soon as it has been spawned, so
+        # that one which never became ready can be found and reaped
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pool(
+                pid   INTEGER PRIMARY KEY NOT NULL,
+                minor INTEGER UNIQUE,
+                ready INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        # [identity] tells whether [parent] is still the file the cache
+        # was made from
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS read_cache(
+                parent    TEXT PRIMARY KEY NOT NULL,
+                cache     TEXT NOT NULL UNIQUE,
+                identity  TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS read_cache_user(
+                path   TEXT PRIMARY KEY NOT NULL,
+                parent TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute("""
+            CREATE INDEX IF NOT EXISTS read_cache_user_parent
+            ON read_cache_user(parent)"""
+        )
+
+    def put(self, path, minor, pid, format=None, image=None,
+            secondary=None):
+        """Record that tapdisk [minor]/[pid] serves [path], replacing
+           whatever was recorded for either the path or the minor"""
+        self._conn.execute(
+            "DELETE FROM tapdisk WHERE minor = :minor AND path != :path",
+            {"minor": minor, "path": path}
+        )
+        self._conn.execute("""
+            INSERT OR REPLACE INTO tapdisk(
+                path, minor, pid, format, image, secondary)
+            VALUES (:path, :minor, :pid, :format, :image, :secondary)""",
+            {"path": path, "minor": minor, "pid": pid, "format": format,
+             "image": image, "secondary": secondary}
+        )
+
+    def __get_one(self, column, value):
+        res = self._conn.execute(
+            "SELECT * FROM tapdisk WHERE %s = :value" % column,
+            {"value": value}
+        )
+        return res.fetchone()
+
+    def get_by_path(self, path):
+        return self.__get_one("path", path)
+
+    def get_by_minor(self, minor):
+        return self.__get_one("minor", minor)
+
+    def get_by_pid(self, pid):
+        res = self._conn.execute(
+            "SELECT * FROM tapdisk WHERE pid = :pid", {"pid": pid})
+        return res.fetchall()
+
+    def get_all(self):
+        return self._conn.execute(
+            "SELECT * FROM tapdisk ORDER BY minor").fetchall()
+
+    def remove(self, path):
+        self._conn.execute(
+            "DELETE FROM tapdisk WHERE path = :path", {"path": path})
+
+    def remove_minor(self, minor):
+        self._conn.execute(
+            "DELETE FROM tapdisk WHERE minor = :minor", {"minor": minor})
+
+    def add_pool_member(self, pid):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO pool(pid) VALUES (:pid)", {"pid": pid})
+
+    def update_pool_member(self, pid, minor, ready):
+        self._conn.execute(
+            "UPDATE pool SET minor = :minor, ready = :ready WHERE pid = :pid",
+            {"pid": pid, "minor": minor, "ready": int(ready)}
+        )
+
+    def remove_pool_member(self, pid):
+        self._conn.execute("DELETE FROM pool WHERE pid = :pid", {"pid": pid})
+
+    def get_pool_members(self):
+        return self._conn.execute(
+            "SELECT * FROM pool ORDER BY pid").fetchall()
+
+    def count_ready_pool_members(self):
+        res = self._conn.execute("SELECT COUNT(*) FROM pool WHERE ready = 1")
+        return res.fetchone()[0]
+
+    def take_pool_member(self):
+        """Remove and return a ready pool member, or None if there are
+           none. Must be called inside write_context()."""
+        row = self._conn.execute(
+            "SELECT * FROM pool WHERE ready = 1 LIMIT 1").fetchone()
+        if row is not None:
+            self.remove_pool_member(row['pid'])
+        return row
+
+    def put_read_cache(self, parent, cache, identity, last_used):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO read_cache(
+                parent, cache, identity, last_used)
+            VALUES (:parent, :cache, :identity, :last_used)""",
+            {"parent": parent, "cache": cache, "identity": identity,
+             "last_used": last_used}
+        )
+
+    def touch_read_cache(self, parent, last_used):
+        self._conn.execute(
+            "UPDATE read_cache SET last_used = :last_used "
+            "WHERE parent = :parent",
+            {"parent": parent, "last_used": last_used}
+        )
+
+    def get_read_cache(self, parent):
+        res = self._conn.execute(
+            "SELECT * FROM read_cache WHERE parent = :parent",
+            {"parent": parent})
+        return res.fetchone()
+
+    def get_read_caches(self):
+        return self._conn.execute(
+            "SELECT * FROM read_cache ORDER BY parent").fetchall()
+
+    def get_idle_read_caches(self):
+        """Return the read caches nobody uses, least recently used
+           first"""
+        return self._conn.execute("""
+            SELECT * FROM read_cache WHERE parent NOT IN (
+                SELECT parent FROM read_cache_user)
+            ORDER BY last_used""").fetchall()
+
+    def remove_read_cache(self, parent):
+        self._conn.execute(
+            "DELETE FROM read_cache_user WHERE parent = :parent",
+            {"parent": parent})
+        self._conn.execute(
+            "DELETE FROM read_cache WHERE parent = :parent",
+            {"parent": parent})
+
+    def add_read_cache_user(self, path, parent):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO read_cache_user(path, parent) "
+            "VALUES (:path, :parent)",
+            {"path": path, "parent": parent})
+
+    def remove_read_cache_user(self, path):
+        """Forget that [path] uses a read cache; returns the parent
+           it was using, or None. Must be called inside
+           write_context()."""
+        row = self._conn.execute(
+            "SELECT parent FROM read_cache_user WHERE path = :path",
+            {"path": path}).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "DELETE FROM read_cache_user WHERE path = :path", {"path": path})
+        return row['parent']
+
+    def count_read_cache_users(self, parent):
+        res = self._conn.execute(
+            "SELECT COUNT(*) FROM read_cache_user WHERE parent = :parent",
+            {"parent": parent})
+        return res.fetchone()[0]
+
+    @contextmanager
+    def write_context(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def close(self):
+        self._conn.close()
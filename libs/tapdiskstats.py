@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import re
+import sys
+import time
+import json
+import errno
+import fcntl
+import subprocess
+
+from xapi.storage import log
+from xapi.storage.libs import tapdisk
+from xapi.storage.libs.rrddlib import Datasource, PluginControl
+from xapi.storage.libs.util import call
+
+"""
+Per-host collector of the I/O statistics of every tapdisk in the tapdisk
+registry, published to xcp-rrdd as per-volume rate datasources.
+
+The counters are read from the sysfs stat file of each tapdev block
+device, which costs no fork per tapdisk. The hits and misses of the
+host-local read caches (see libvhd.readcache), which only tapdisk
+itself counts, are read with 'tap-ctl stats'. The collector is started
+by Datapath.attach and exits once the host has had no tapdisks for a
+while.
+"""
+
+PLUGIN_NAME = 'tapdisk_stats'
+
+# Fields of /sys/block/<dev>/stat, see Documentation/block/stat.txt
+STAT_FIELDS = ['read_ios', 'read_merges', 'read_sectors', 'read_ticks',
+               'write_ios', 'write_merges', 'write_sectors', 'write_ticks',
+               'in_flight', 'io_ticks', 'time_in_queue']
+SECTOR_SIZE = 512
+
+# Exit after this many readings in a row without a tapdisk
+IDLE_READINGS = 12
+
+LOCK_FILE = os.path.join(tapdisk.TD_PROC_METADATA_DIR, "stats.lock")
+
+# Debug string
+STATS = 'tapdisk-stats'
+
+
+def read_counters(tap):
+    """Return the cumulative I/O counters of [tap]'s block device, or
+       None if it has gone away"""
+    try:
+        rdev = os.stat(tap.block_device()).st_rdev
+        with open("/sys/dev/block/%d:%d/stat" %
+                  (os.major(rdev), os.minor(rdev))) as f:
+            values = [long(x) for x in f.read().split()]
+    except (OSError, IOError, ValueError):
+        return None
+    return dict(zip(STAT_FIELDS, values))
+
+
+def rates(old, new, interval):
+    """Compute the per-second rates, and the mean latencies in ms, of
+       the I/O done between two readings of the counters"""
+    delta = dict([(key, max(new[key] - old[key], 0)) for key in old])
+    result = {
+        'read_iops': delta['read_ios'] / interval,
+        'write_iops': delta['write_ios'] / interval,
+        'read_throughput': delta['read_sectors'] * SECTOR_SIZE / interval,
+        'write_throughput': delta['write_sectors'] * SECTOR_SIZE / interval,
+        'read_latency': 0.0,
+        'write_latency': 0.0,
+        'inflight': float(new['in_flight'])
+    }
+    if delta['read_ios']:
+        result['read_latency'] = delta['read_ticks'] / delta['read_ios']
+    if delta['write_ios']:
+        result['write_latency'] = delta['write_ticks'] / delta['write_ios']
+    return result
+
+
+RATES = [
+    ('read_iops', 'read requests per second', '(requests/s)'),
+    ('write_iops', 'write requests per second', '(requests/s)'),
+    ('read_throughput', 'bytes read per second', 'B/s'),
+    ('write_throughput', 'bytes written per second', 'B/s'),
+    ('read_latency', 'mean read latency', 'ms'),
+    ('write_latency', 'mean write latency', 'ms'),
+    ('inflight', 'requests in flight', '(requests)'),
+]
+
+
+def read_cache_counters(dbg, tap):
+    """Return the cumulative reads served by the read cache image
+       [tap] has open ('hits') and those it passed on to the shared
+       parent ('misses'), or None if they cannot be read"""
+    (stdout, _, rc) = call(dbg, ["tap-ctl", "stats", "-m", str(tap.minor),
+                                 "-p", str(tap.pid)], simple=False)
+    if rc != 0:
+        return None
+    try:
+        # The first image is the cache, the others its parent chain;
+        # 'hits' counts the [reads, writes] each image completed
+        images = json.loads(stdout)['images']
+        return {
+            'hits': long(images[0]['hits'][0]),
+            'misses': sum([long(i['hits'][0]) for i in images[1:]])
+        }
+    except (ValueError, KeyError, IndexError, TypeError):
+        log.error("%s: unexpected tap-ctl stats output for %s: %s" %
+                  (dbg, tap, stdout))
+        return None
+
+
+def read_cache_rates(old, new, interval):
+    delta = dict([(key, max(new[key] - old[key], 0)) for key in old])
+    result = {
+        'read_cache_hits': delta['hits'] / interval,
+        'read_cache_misses': delta['misses'] / interval,
+        'read_cache_hit_ratio': 0.0
+    }
+    if delta['hits'] + delta['misses']:
+        result['read_cache_hit_ratio'] = \
+            delta['hits'] / (delta['hits'] + delta['misses'])
+    return result
+
+
+READ_CACHE_RATES = [
+    ('read_cache_hits', 'reads served from local disk per second',
+     '(requests/s)'),
+    ('read_cache_misses', 'reads of the shared image per second',
+     '(requests/s)'),
+    ('read_cache_hit_ratio', 'fraction of reads served from local disk',
+     ''),
+]
+
+
+# Mount points, and directories which are not, seen by volume_id()
+_mount_points = {}
+
+
+def _is_mount_point(path):
+    if path not in _mount_points:
+        _mount_points[path] = os.path.ismount(path)
+    return _mount_points[path]
+
+
+def volume_id(path):
+    """Name a volume after its SR and its key within the SR.
+
+    Volume keys are only unique within an SR, and a volume may sit any
+    number of directories below its SR's mount point, so the SR is named
+    after that mount point, e.g. "scsi-<SCSI id>_42" for the gfs2
+    volume "<sr-mount>/dev/disk/by-id/scsi-<SCSI id>/42/42". A volume
+    which is not on a file system of its own, such as "/dev/<VG>/42", is
+    named after its directory."""
+    path = path.rstrip('/')
+    sr = os.path.dirname(path)
+    parent = sr
+    # Top-level mount points such as /dev never hold SRs
+    while parent.count('/') > 1:
+        if _is_mount_point(parent):
+            sr = parent
+            break
+        parent = os.path.dirname(parent)
+    return re.sub(r'[^a-zA-Z0-9-]', '_',
+                  os.path.basename(sr) + '_' + os.path.basename(path))
+
+
+def create_datasources(volume_ids, cache_ids=()):
+    """Create the Datasources for the volumes in [volume_ids] and the
+       read caches of the shared images in [cache_ids]; keys are
+       (volume id, rate name)"""
+    ds_dict = {}
+    for (ids, rates, kind) in [(volume_ids, RATES, 'Volume '),
+                               (cache_ids, READ_CACHE_RATES, 'Image ')]:
+        for vid in ids:
+            for (rate, description, units) in rates:
+                ds_dict[(vid, rate)] = Datasource(
+                    'tapdisk_%s_%s' % (rate, vid),
+                    0.0,
+                    'float',
+                    description=kind + vid + ' ' + description,
+                    datasource_type='gauge',
+                    min_val=0.0,
+                    units=units,
+                    owner='host'
+                )
+    return ds_dict
+
+
+def run_stats(dbg):
+    stats_plugin = PluginControl(PLUGIN_NAME, 'Local', 'Five_seconds', 0.5)
+
+    # The collector starts with the first attach after it last exited,
+    # e.g. after tapdisks crashed: don't report (or let anyone find)
+    # tapdisks which have gone
+    try:
+        tapdisk.reconcile(dbg)
+    except Exception as e:
+        log.error("%s: cannot reconcile the tapdisk registry: %s" % (dbg, e))
+
+    ds_dict = None
+    previous = {}
+    idle = 0
+    while idle < IDLE_READINGS:
+        stats_plugin.wake_up_before_next_reading()
+        now = time.time()
+
+        taps = tapdisk.list_tapdisks(dbg)
+        current = {}
+        for (path, tap) in taps:
+            counters = read_counters(tap)
+            if counters is not None:
+                current[(volume_id(path), rates)] = (now, counters)
+        idle = idle + 1 if not current else 0
+
+        cache_taps = dict(taps)
+        for row in tapdisk.get_registry().get_read_caches():
+            tap = cache_taps.get(row['cache'])
+            counters = None if tap is None else read_cache_counters(dbg, tap)
+            if counters is not None:
+                current[(volume_id(row['parent']), read_cache_rates)] = \
+                    (now, counters)
+
+        # Only rewrite the metadata when volumes come or go
+        if ds_dict is None or set(previous) != set(current):
+            volume_ids = [vid for (vid, fn) in current if fn == rates]
+            cache_ids = [vid for (vid, fn) in current if fn != rates]
+            log.debug("%s: now reporting volumes %s and read caches %s" %
+                      (dbg, sorted(volume_ids), sorted(cache_ids)))
+            ds_dict = create_datasources(volume_ids, cache_ids)
+            stats_plugin.full_update(ds_dict)
+
+        for (key, (when, counters)) in current.iteritems():
+            if key not in previous or when <= previous[key][0]:
+                continue
+            (then, old) = previous[key]
+            (vid, compute_rates) = key
+            for (rate, value) in \
+                    compute_rates(old, counters, when - then).iteritems():
+                ds_dict[(vid, rate)].set_value(value)
+        previous = current
+
+        stats_plugin.fast_update(ds_dict)
+    log.debug("%s: no tapdisks left, exiting" % dbg)
+
+
+def ensure_running(dbg):
+    """Start the host's collector unless it is already running"""
+    try:
+        # Creates the directory holding LOCK_FILE
+        tapdisk.get_registry()
+        with open(LOCK_FILE, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Get the command to run, need to replace pyc with py as __file__
+        # will be the byte compiled file
+        args = [os.path.abspath(re.sub("pyc$", "py", __file__))]
+        subprocess.Popen(args, close_fds=True)
+        log.debug("%s: started the tapdisk stats collector" % dbg)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            # Statistics must never stop a VM from starting
+            log.error("%s: cannot start the tapdisk stats collector: %s" %
+                      (dbg, e))
+    except OSError as e:
+        log.error("%s: cannot start the tapdisk stats collector: %s" %
+                  (dbg, e))
+
+
+def daemonize():
+    for fd in [0, 1, 2]:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    try:
+        daemonize()
+        with open(LOCK_FILE, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Somebody else beat us to it
+                sys.exit(0)
+            run_stats(STATS)
+    except SystemExit:
+        raise
+    except:
+        log.error("tapdiskstats: error {}".format(sys.exc_info()))
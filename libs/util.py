@@ -48,6 +48,22 @@ def unlock_file(dbg, filehandle):
     filehandle.close()
 
 
+def read_sysconfig(filename):
+    """Return the KEY=value settings of a sysconfig-style file as a
+       dict; a missing file has no settings"""
+    config = {}
+    try:
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#") and "=" in line:
+                    key, value = line.split("=", 1)
+                    config[key.strip()] = value.strip().strip('"')
+    except IOError:
+        pass
+    return config
+
+
 def call(dbg, cmd_args, error=True, simple=True, expRc=0):
     """[call dbg cmd_args] executes [cmd_args]
     if [error] and exit code != expRc, log and throws a BackendError
@@ -0,0 +1,10 @@
+class SR_does_not_exist(Exception):
+    pass
+
+
+class Sr_not_attached(Exception):
+    pass
+
+
+class Unimplemented(Exception):
+    pass
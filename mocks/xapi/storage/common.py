@@ -0,0 +1,2 @@
+def call(dbg, cmd_args, error=True, simple=True, expRc=0):
+    raise NotImplementedError("tests must not run %s" % cmd_args)
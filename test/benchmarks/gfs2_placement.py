@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Stress benchmark of volume placement on a gfs2 SR: prints the latency of
+creating a volume and of the first write to it, in milliseconds, with
+[hosts] writers creating [volumes] volumes each at the same time.
+
+'shared' places every volume in the SR root, as SR.create used to;
+'sharded' goes through gfs2.Callbacks and the per-host shards. Each
+writer is a process pretending to be a host of its own; for the DLM
+traffic of a real pool, run it on several hosts at once against the
+same SR. Run it on a host with the SR attached, from the directory of
+the gfs2 plugin:
+
+    python test/benchmarks/gfs2_placement.py <SR mount> shared|sharded \
+        [hosts] [volumes]
+"""
+
+import os
+import sys
+import mmap
+import time
+import json
+import shutil
+import socket
+import multiprocessing
+
+import gfs2
+
+DEFAULT_HOSTS = 4
+DEFAULT_VOLUMES = 50
+# What vhd-util create writes for a small volume, BAT included
+METADATA_SIZE = 4 * 1024 * 1024
+BLOCK_SIZE = gfs2.VHD_BLOCK_SIZE
+
+
+def create_shared(opq, name):
+    vol_dir = os.path.join(opq, name)
+    os.mkdir(vol_dir)
+    vol_path = os.path.join(vol_dir, name)
+    with open(vol_path, "w") as f:
+        f.truncate(METADATA_SIZE)
+    return vol_path
+
+
+def create_sharded(opq, name):
+    cb = gfs2.Callbacks()
+    vol_path = cb.volumeCreate(opq, name, BLOCK_SIZE)
+    with open(vol_path, "w") as f:
+        f.truncate(METADATA_SIZE)
+    cb.volumePreallocate(opq, name, BLOCK_SIZE)
+    return vol_path
+
+
+def first_write(vol_path, buf):
+    fd = os.open(vol_path, os.O_WRONLY | os.O_DIRECT)
+    try:
+        os.lseek(fd, METADATA_SIZE, os.SEEK_SET)
+        os.write(fd, buf)
+    finally:
+        os.close(fd)
+
+
+def writer(opq, layout, host, volumes, start, results):
+    try:
+        results.put(measure(opq, layout, host, volumes, start))
+    except Exception as e:
+        results.put(e)
+
+
+def measure(opq, layout, host, volumes, start):
+    gfs2._host_shard = host
+    create = create_shared if layout == "shared" else create_sharded
+    buf = mmap.mmap(-1, BLOCK_SIZE)
+    creates = []
+    writes = []
+    start.wait()
+    for i in range(volumes):
+        name = "%s-%d" % (host, i)
+        t0 = time.time()
+        vol_path = create(opq, name)
+        t1 = time.time()
+        first_write(vol_path, buf)
+        t2 = time.time()
+        creates.append(t1 - t0)
+        writes.append(t2 - t1)
+    return (creates, writes)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def report(name, values):
+    print "%-12s %10.2f %10.2f %10.2f %10.2f" % (
+        name, sum(values) / len(values) * 1000,
+        percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000,
+        max(values) * 1000)
+
+
+def main(mnt_path, layout, hosts, volumes):
+    opq = os.path.join(mnt_path, "placement-benchmark-%s-%d" %
+                       (socket.gethostname(), os.getpid()))
+    os.mkdir(opq)
+    with open(os.path.join(opq, "meta.json"), "w") as f:
+        json.dump({"fs_parameters": {"preallocation": "sparse"}}, f)
+    try:
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(
+            target=writer,
+            args=(opq, layout, "%s-%d" % (socket.gethostname(), n),
+                  volumes, start, results)) for n in range(hosts)]
+        for proc in procs:
+            proc.start()
+        start.set()
+        creates = []
+        writes = []
+        for proc in procs:
+            result = results.get()
+            if isinstance(result, Exception):
+                raise result
+            (c, w) = result
+            creates.extend(c)
+            writes.extend(w)
+        for proc in procs:
+            proc.join()
+        print "%s layout, %d hosts x %d volumes" % (layout, hosts, volumes)
+        print "%-12s %10s %10s %10s %10s" % ("ms", "mean", "p50", "p99", "max")
+        report("create", creates)
+        report("first write", writes)
+    finally:
+        shutil.rmtree(opq)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[2] not in ("shared", "sharded"):
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2],
+         int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_HOSTS,
+         int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_VOLUMES)
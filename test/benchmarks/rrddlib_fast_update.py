@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Benchmark of PluginBackend.fast_update: prints the time per update, in
+microseconds, against the number of datasources.
+
+Run with xapi.storage.libs importable, e.g. from a test environment set
+up by test/setup_env_for_python_unittests.sh:
+
+    python test/benchmarks/rrddlib_fast_update.py [count...]
+"""
+
+import sys
+import shutil
+import tempfile
+import timeit
+
+from xapi.storage.libs.rrddlib import backend, Datasource
+
+DEFAULT_COUNTS = [1, 10, 100, 1000, 5000]
+MIN_SECONDS = 0.5
+
+
+def datasources(count):
+    ds_dict = {}
+    for i in range(count):
+        name = 'ds_%d' % i
+        if i % 2:
+            ds_dict[name] = Datasource(name, float(i), 'float')
+        else:
+            ds_dict[name] = Datasource(name, i, 'int64')
+    return ds_dict
+
+
+def time_fast_update(count):
+    ds_dict = datasources(count)
+    plugin = backend.PluginBackend('benchmark_%d' % count)
+    plugin.full_update(ds_dict)
+    timer = timeit.Timer(lambda: plugin.fast_update(ds_dict))
+    number = 1
+    while True:
+        elapsed = min(timer.repeat(3, number))
+        if elapsed >= MIN_SECONDS:
+            return elapsed / number * 1e6
+        number *= 10
+
+
+def main(counts):
+    plugin_dir = tempfile.mkdtemp()
+    backend.PLUGIN_PATH = plugin_dir + '/'
+    try:
+        print "%12s %16s %16s" % ("datasources", "us/update", "us/datasource")
+        for count in counts:
+            usecs = time_fast_update(count)
+            print "%12d %16.2f %16.3f" % (count, usecs, usecs / count)
+    finally:
+        shutil.rmtree(plugin_dir)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
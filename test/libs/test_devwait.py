@@ -0,0 +1,80 @@
+import os
+import mock
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from xapi.storage.libs import devwait
+
+
+@mock.patch('xapi.storage.libs.devwait.log')
+class WaitForPathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def create_later(self, delay, *paths):
+        def create():
+            time.sleep(delay)
+            for path in paths:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, "w").close()
+        thread = threading.Thread(target=create)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_paths_already_exist(self, mock_log):
+        path = os.path.join(self.dir, "scsi-1")
+        open(path, "w").close()
+
+        self.assertEquals(set(), devwait.wait_for_paths("test", [path], 0))
+
+    def test_paths_created_late(self, mock_log):
+        paths = [os.path.join(self.dir, "scsi-1"),
+                 os.path.join(self.dir, "scsi-2")]
+        self.create_later(0.1, *paths)
+
+        start = time.time()
+        missing = devwait.wait_for_paths("test", paths, 10)
+
+        self.assertEquals(set(), missing)
+        # Woken by inotify, not by the deadline
+        self.assertLess(time.time() - start, 5)
+
+    def test_timeout(self, mock_log):
+        paths = [os.path.join(self.dir, "scsi-1"),
+                 os.path.join(self.dir, "scsi-2")]
+        open(paths[0], "w").close()
+
+        start = time.time()
+        missing = devwait.wait_for_paths("test", paths, 0.2)
+
+        self.assertEquals(set([paths[1]]), missing)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    @mock.patch('xapi.storage.libs.devwait.Inotify',
+                side_effect=OSError(24, "Too many open files"))
+    def test_poll_without_inotify(self, mock_inotify, mock_log):
+        path = os.path.join(self.dir, "scsi-1")
+        self.create_later(0.1, path)
+
+        self.assertEquals(set(), devwait.wait_for_paths("test", [path], 10))
+
+    def test_poll_when_directory_missing(self, mock_log):
+        # udev has not created the directory of links yet
+        path = os.path.join(self.dir, "by-id", "scsi-1")
+        self.create_later(0.1, path)
+
+        self.assertEquals(set(), devwait.wait_for_paths("test", [path], 10))
+
+    @mock.patch('xapi.storage.libs.devwait.Inotify',
+                side_effect=OSError(24, "Too many open files"))
+    def test_poll_timeout(self, mock_inotify, mock_log):
+        path = os.path.join(self.dir, "scsi-1")
+
+        self.assertEquals(set([path]),
+                          devwait.wait_for_paths("test", [path], 0.2))
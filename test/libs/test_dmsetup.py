@@ -0,0 +1,44 @@
+import mock
+import unittest
+
+from xapi.storage.libs import dmsetup
+
+DMSETUP_TABLE = """_dev_loop0: 0 2048 linear 7:0 0
+_dev_loop1: 0 4096 linear 7:1 0
+36001405e4b4e1fbd4b54e3e8a2a2e7b1: 0 20971520 multipath 0 0 1 1 \
+service-time 0 1 1 8:16 1
+"""
+
+
+class InternalError(Exception):
+    pass
+
+
+@mock.patch('xapi.storage.libs.dmsetup.xapi')
+@mock.patch('xapi.storage.libs.dmsetup.log')
+@mock.patch('xapi.storage.libs.dmsetup.table')
+@mock.patch('xapi.storage.libs.dmsetup.call', return_value=DMSETUP_TABLE)
+class DmsetupTest(unittest.TestCase):
+
+    def test_find_all(self, call, table, log, xapi):
+        table.side_effect = {
+            "/dev/loop0": "0 2048 linear 7:0 0",
+            "/dev/loop1": "0 4096 linear 7:1 0",
+            "/dev/loop2": "0 2048 linear 7:2 0"
+        }.get
+
+        dms = dmsetup.find_all("test",
+                               ["/dev/loop0", "/dev/loop1", "/dev/loop2"])
+
+        self.assertEquals(["/dev/loop0", "/dev/loop1"], sorted(dms))
+        self.assertEquals("/dev/mapper/_dev_loop1",
+                          dms["/dev/loop1"].block_device())
+        # A single scan for all of the devices
+        call.assert_called_once_with("test", ["dmsetup", "table"])
+
+    def test_find_all_skips_unexpected_table(self, call, table, log, xapi):
+        xapi.InternalError = InternalError
+        # e.g. the loop device has grown since the dm device was made
+        table.return_value = "0 8192 linear 7:0 0"
+
+        self.assertEquals({}, dmsetup.find_all("test", ["/dev/loop0"]))
@@ -0,0 +1,63 @@
+import os
+import socket
+import unittest
+
+from xapi.storage.libs import fdpass
+
+
+class FdPassTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def test_pass_pipe(self):
+        (r, w) = os.pipe()
+        self.addCleanup(os.close, w)
+
+        sent = fdpass.sendfds(self.sender, "fd", [r])
+        os.close(r)
+        (message, fds) = fdpass.recvfds(self.receiver, 16, 1)
+
+        self.assertEquals(2, sent)
+        self.assertEquals("fd", message)
+        self.assertEquals(1, len(fds))
+        # The received descriptor is a new one for the same pipe
+        os.write(w, "hello")
+        self.assertEquals("hello", os.read(fds[0], 5))
+        os.close(fds[0])
+
+    def test_pass_several(self):
+        (r, w) = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        other, peer = socket.socketpair()
+        self.addCleanup(other.close)
+        self.addCleanup(peer.close)
+
+        # Socket objects are passed by their descriptor
+        fdpass.sendfds(self.sender, "fds", [w, other])
+        (message, fds) = fdpass.recvfds(self.receiver, 16, 2)
+
+        self.assertEquals("fds", message)
+        self.assertEquals(2, len(fds))
+        os.write(fds[0], "x")
+        self.assertEquals("x", os.read(r, 1))
+        os.write(fds[1], "y")
+        self.assertEquals("y", peer.recv(1))
+        for fd in fds:
+            os.close(fd)
+
+    def test_message_only(self):
+        self.sender.sendall("plain")
+
+        self.assertEquals(("plain", []),
+                          fdpass.recvfds(self.receiver, 16, 1))
+
+    def test_empty_message(self):
+        (r, w) = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+
+        self.assertRaises(ValueError, fdpass.sendfds, self.sender, "", [r])
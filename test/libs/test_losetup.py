@@ -0,0 +1,43 @@
+import mock
+import unittest
+
+from xapi.storage.libs import losetup
+
+LOSETUP_A = """/dev/loop0: [0801]:1234 (/var/run/sr-mount/1/a.raw)
+/dev/loop1: [0801]:1235 (/var/run/sr-mount/1/b.raw)
+"""
+
+
+@mock.patch('os.path.realpath', side_effect=lambda path: path)
+@mock.patch('xapi.storage.libs.losetup.call', return_value=LOSETUP_A)
+class LosetupTest(unittest.TestCase):
+
+    def test_find_all(self, call, realpath):
+        loops = losetup.find_all("test", ["/var/run/sr-mount/1/a.raw",
+                                          "/var/run/sr-mount/1/b.raw",
+                                          "/var/run/sr-mount/1/c.raw"])
+
+        self.assertEquals(["/var/run/sr-mount/1/a.raw",
+                           "/var/run/sr-mount/1/b.raw"], sorted(loops))
+        self.assertEquals(
+            "/dev/loop1",
+            loops["/var/run/sr-mount/1/b.raw"].block_device())
+        # A single scan for all of the paths
+        call.assert_called_once_with("test", ["losetup", "-a"])
+
+    def test_find_all_follows_symlinks(self, call, realpath):
+        realpath.side_effect = {
+            "/var/run/sr-mount/uuid/a.raw": "/var/run/sr-mount/1/a.raw"
+        }.get
+
+        loops = losetup.find_all("test", ["/var/run/sr-mount/uuid/a.raw"])
+
+        self.assertEquals(
+            "/dev/loop0",
+            loops["/var/run/sr-mount/uuid/a.raw"].block_device())
+
+    def test_find(self, call, realpath):
+        self.assertEquals(
+            "/dev/loop0",
+            losetup.find("test", "/var/run/sr-mount/1/a.raw").block_device())
+        self.assertIsNone(losetup.find("test", "/var/run/sr-mount/1/c.raw"))
@@ -0,0 +1,85 @@
+import mock
+import unittest
+
+from xapi.storage.libs import multipath
+
+# A 10 GiB LUN
+LUN_SIZE = 10 * 1024 * 1024 * 1024
+DEV_T = {"/dev/sdb": "8:16", "/dev/sdc": "8:32"}
+
+
+@mock.patch('xapi.storage.libs.multipath.dev_t', side_effect=DEV_T.get)
+@mock.patch('xapi.storage.libs.multipath.blkgetsize64',
+            return_value=LUN_SIZE)
+class MultipathTableTest(unittest.TestCase):
+
+    def test_table_two_paths(self, blkgetsize64, dev_t):
+        self.assertEquals(
+            "0 20971520 multipath 1 queue_if_no_path 0 1 1 "
+            "service-time 0 2 1 8:16 1 8:32 1",
+            multipath.table(["/dev/sdb", "/dev/sdc"]))
+
+    def test_table_path_selector(self, blkgetsize64, dev_t):
+        self.assertEquals(
+            "0 20971520 multipath 1 queue_if_no_path 0 1 1 "
+            "round-robin 0 1 1 8:16 1",
+            multipath.table(["/dev/sdb"], "round-robin"))
+
+    def test_table_unknown_path_selector(self, blkgetsize64, dev_t):
+        self.assertRaises(ValueError, multipath.table,
+                          ["/dev/sdb"], "least-used")
+
+    @mock.patch('xapi.storage.libs.multipath.Multipath')
+    @mock.patch('xapi.storage.libs.multipath.find', return_value=None)
+    @mock.patch('xapi.storage.libs.multipath.call')
+    def test_create(self, call, find, mp_class, blkgetsize64, dev_t):
+        mp = multipath.create("test", "3600a", ["/dev/sdb", "/dev/sdc"])
+
+        call.assert_any_call(
+            "test", ["dmsetup", "create", "3600a", "--table",
+                     "0 20971520 multipath 1 queue_if_no_path 0 1 1 "
+                     "service-time 0 2 1 8:16 1 8:32 1"])
+        call.assert_any_call(
+            "test", ["multipathd", "add", "map", "3600a"], error=False)
+        self.assertEquals(mp_class.return_value, mp)
+
+    @mock.patch('xapi.storage.libs.multipath.find')
+    @mock.patch('xapi.storage.libs.multipath.call')
+    @mock.patch('xapi.storage.libs.multipath.log')
+    def test_create_reloads_changed_paths(self, log, call, find,
+                                          blkgetsize64, dev_t):
+        find.return_value.slaves.return_value = ["sdb"]
+
+        mp = multipath.create("test", "3600a", ["/dev/sdb", "/dev/sdc"])
+
+        find.return_value.reload.assert_called_once_with(
+            "test", ["/dev/sdb", "/dev/sdc"], "service-time")
+        call.assert_not_called()
+        self.assertEquals(find.return_value, mp)
+
+    @mock.patch('xapi.storage.libs.multipath.find')
+    @mock.patch('xapi.storage.libs.multipath.call')
+    def test_create_keeps_same_paths(self, call, find, blkgetsize64, dev_t):
+        find.return_value.slaves.return_value = ["sdb", "sdc"]
+
+        multipath.create("test", "3600a", ["/dev/sdc", "/dev/sdb"])
+
+        find.return_value.reload.assert_not_called()
+        call.assert_not_called()
+
+
+class MultipathPathStatsTest(unittest.TestCase):
+
+    @mock.patch('xapi.storage.libs.multipath.call',
+                return_value="0 20971520 multipath 1 queue_if_no_path ...")
+    def test_path_stats(self, call):
+        mp = multipath.Multipath("test", "3600a")
+        stat = "10 0 80 5 20 0 160 7 1 12 12\n"
+        with mock.patch.object(mp, 'slaves', return_value=["sdb"]), \
+                mock.patch('__builtin__.open', mock.mock_open(read_data=stat)):
+            stats = mp.path_stats("test")
+
+        self.assertEquals(["sdb"], stats.keys())
+        self.assertEquals(10, stats["sdb"]["read_ios"])
+        self.assertEquals(80 * 512, stats["sdb"]["read_bytes"])
+        self.assertEquals(160 * 512, stats["sdb"]["write_bytes"])
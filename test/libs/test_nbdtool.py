@@ -0,0 +1,248 @@
+import os
+import shutil
+import subprocess
+import mock
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from xapi.storage.libs import nbdtool
+
+
+class LoopbackNbdServer(threading.Thread):
+
+    """Serve [disk], a bytearray, to a single client over [sock] using
+       the fixed newstyle handshake"""
+
+    def __init__(self, sock, disk):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.disk = disk
+        self.export = None
+        self.flushes = 0
+
+    def recv(self, length):
+        return nbdtool._recv_exactly(self.sock, length)
+
+    def run(self):
+        try:
+            self.serve()
+        except nbdtool.NbdError:
+            pass
+        finally:
+            self.sock.close()
+
+    def serve(self):
+        self.sock.sendall(nbdtool.NBD_MAGIC + nbdtool.NBD_OPTS_MAGIC +
+                          struct.pack(">H", nbdtool.NBD_FLAG_FIXED_NEWSTYLE |
+                                      nbdtool.NBD_FLAG_NO_ZEROES))
+        (client_flags,) = struct.unpack(">I", self.recv(4))
+        assert self.recv(8) == nbdtool.NBD_OPTS_MAGIC
+        (option, length) = struct.unpack(">II", self.recv(8))
+        assert option == nbdtool.NBD_OPT_EXPORT_NAME
+        self.export = self.recv(length)
+        self.sock.sendall(struct.pack(">QH", len(self.disk), 0))
+        if not client_flags & nbdtool.NBD_FLAG_C_NO_ZEROES:
+            self.sock.sendall("\0" * 124)
+
+        while True:
+            (magic, _, command, handle, offset, length) = \
+                nbdtool.NBD_REQUEST.unpack(self.recv(nbdtool.NBD_REQUEST.size))
+            assert magic == nbdtool.NBD_REQUEST_MAGIC
+            reply = nbdtool.NBD_REPLY.pack(nbdtool.NBD_REPLY_MAGIC, 0, handle)
+            if command == nbdtool.NBD_CMD_READ:
+                self.sock.sendall(
+                    reply + str(self.disk[offset:offset + length]))
+            elif command == nbdtool.NBD_CMD_WRITE:
+                self.disk[offset:offset + length] = self.recv(length)
+                self.sock.sendall(reply)
+            elif command == nbdtool.NBD_CMD_FLUSH:
+                self.flushes += 1
+                self.sock.sendall(reply)
+            elif command == nbdtool.NBD_CMD_DISC:
+                return
+
+
+class NbdToolTest(unittest.TestCase):
+
+    CHUNK = 4096
+    SIZE = 10 * CHUNK
+
+    def setUp(self):
+        self.destination = bytearray(self.SIZE)
+        client_sock, server_sock = socket.socketpair()
+        self.server = LoopbackNbdServer(server_sock, self.destination)
+        self.server.start()
+        self.client = nbdtool.NbdClient(client_sock, "export")
+
+        self.source_fd, self.source_path = tempfile.mkstemp()
+        os.write(self.source_fd, "".join(
+            [chr(i) * self.CHUNK for i in range(10)]))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.join(5)
+        os.close(self.source_fd)
+        os.unlink(self.source_path)
+
+    def source(self):
+        with open(self.source_path) as f:
+            return f.read()
+
+    def test_handshake_read_write(self):
+        self.assertEquals("export", self.server.export)
+        self.assertEquals(self.SIZE, self.client.size)
+
+        self.client.write(self.CHUNK, "hello")
+
+        self.assertEquals("hello", self.client.read(self.CHUNK, 5))
+        self.assertEquals("\0" * 5, self.client.read(0, 5))
+
+    @mock.patch('xapi.storage.libs.nbdtool.log')
+    def test_copy_converges(self, mock_log):
+        progress_path = self.source_path + ".progress"
+
+        progress = nbdtool.copy("test", self.source_fd, self.client,
+                                progress_path, chunk_size=self.CHUNK)
+
+        self.assertEquals("converged", progress.state)
+        self.assertEquals(1, progress.passes)
+        self.assertEquals(self.SIZE, progress.copied)
+        self.assertEquals(0, progress.remaining)
+        self.assertEquals(self.source(), str(self.destination))
+        self.assertEquals(1, self.server.flushes)
+        with open(progress_path) as f:
+            self.assertEquals("converged", nbdtool.json.load(f)["state"])
+        os.unlink(progress_path)
+
+    @mock.patch('xapi.storage.libs.nbdtool.log')
+    def test_copy_recopies_chunks_written_during_copy(self, mock_log):
+        client_write = self.client.write
+        guest_writes = [3 * self.CHUNK]
+
+        def write(offset, data):
+            client_write(offset, data)
+            if offset in guest_writes:
+                # A guest write lands after we read the chunk: tapdisk
+                # mirrors it to both sides, then our stale copy of the
+                # chunk overwrites it on the destination
+                guest_writes.remove(offset)
+                os.lseek(self.source_fd, offset, os.SEEK_SET)
+                os.write(self.source_fd, "new")
+                self.destination[offset:offset + 3] = "new"
+                client_write(offset, data)
+
+        with mock.patch.object(self.client, 'write', side_effect=write):
+            progress = nbdtool.copy("test", self.source_fd, self.client,
+                                    chunk_size=self.CHUNK)
+
+        self.assertEquals("converged", progress.state)
+        self.assertEquals(2, progress.passes)
+        self.assertEquals(self.SIZE + self.CHUNK, progress.copied)
+        self.assertEquals(self.source(), str(self.destination))
+
+    @mock.patch('xapi.storage.libs.nbdtool.log')
+    def test_copy_gives_up_when_never_clean(self, mock_log):
+        client_write = self.client.write
+
+        def write(offset, data):
+            client_write(offset, data)
+            if offset == 0:
+                os.lseek(self.source_fd, 0, os.SEEK_SET)
+                os.write(self.source_fd, os.urandom(8))
+
+        with mock.patch.object(self.client, 'write', side_effect=write):
+            progress = nbdtool.copy("test", self.source_fd, self.client,
+                                    chunk_size=self.CHUNK, max_passes=3)
+
+        self.assertEquals("failed", progress.state)
+        self.assertEquals(3, progress.passes)
+        self.assertEquals(self.CHUNK, progress.remaining)
+
+
+    @mock.patch('xapi.storage.libs.nbdtool.log')
+    def test_copy_recopies_chunk_changed_before_check(self, mock_log):
+        reader_read = nbdtool._ChunkReader.read
+        reads = []
+
+        def read(reader, offset, length):
+            data = reader_read(reader, offset, length)
+            reads.append(offset)
+            if offset == 5 * self.CHUNK and reads.count(offset) == 1:
+                # The guest writes between the copy and the check
+                os.lseek(self.source_fd, offset, os.SEEK_SET)
+                os.write(self.source_fd, "new")
+            return data
+
+        with mock.patch.object(nbdtool._ChunkReader, 'read', read):
+            progress = nbdtool.copy("test", self.source_fd, self.client,
+                                    chunk_size=self.CHUNK)
+
+        self.assertEquals("converged", progress.state)
+        self.assertEquals(2, progress.passes)
+        self.assertEquals(self.SIZE + self.CHUNK, progress.copied)
+        self.assertEquals(self.source(), str(self.destination))
+
+    @mock.patch('xapi.storage.libs.nbdtool.copy')
+    @mock.patch('xapi.storage.libs.nbdtool.NbdClient')
+    @mock.patch('xapi.storage.libs.nbdtool.connect')
+    @mock.patch('os.close')
+    @mock.patch('os.open', return_value=42)
+    @mock.patch('xapi.storage.libs.nbdtool.log')
+    def test_run_copy_bypasses_page_cache(self, mock_log, mock_open,
+                                          mock_close, mock_connect,
+                                          mock_client, mock_copy):
+        nbdtool.run_copy("test", "/dev/xen/blktap-2/tapdev1",
+                         "nbd+unix:///export?socket=/tmp/nbd")
+
+        mock_open.assert_called_once_with(
+            "/dev/xen/blktap-2/tapdev1", os.O_RDONLY | os.O_DIRECT)
+        self.assertEquals(42, mock_copy.call_args[0][1])
+        mock_close.assert_called_once_with(42)
+
+
+@mock.patch('xapi.storage.libs.nbdtool.log')
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.persist_root = tempfile.mkdtemp() + "/"
+        patch = mock.patch('xapi.storage.libs.nbdtool.persist_root',
+                           self.persist_root)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree, self.persist_root)
+
+    def test_wait_copy_died(self, mock_log):
+        proc = subprocess.Popen(["true"])
+        mirror = nbdtool.Mirror("/dev/sm/backend/sr/1", "nbd:unix:/x:y",
+                                proc.pid)
+
+        progress = mirror.wait("test", timeout=5, poll_interval=0.01)
+
+        self.assertEquals("failed", progress["state"])
+        self.assertIn(str(proc.pid), progress["error"])
+
+    def test_wait_copy_finished(self, mock_log):
+        proc = subprocess.Popen(["true"])
+        mirror = nbdtool.Mirror("/dev/sm/backend/sr/1", "nbd:unix:/x:y",
+                                proc.pid)
+        progress = nbdtool.Progress(4096)
+        progress.state = "converged"
+        nbdtool._write_progress(nbdtool.path_to_progress(mirror), progress)
+
+        self.assertEquals("converged",
+                          mirror.wait("test", poll_interval=0.01)["state"])
+
+    def test_wait_timeout(self, mock_log):
+        proc = subprocess.Popen(["sleep", "5"])
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        mirror = nbdtool.Mirror("/dev/sm/backend/sr/1", "nbd:unix:/x:y",
+                                proc.pid)
+
+        progress = mirror.wait("test", timeout=0.05, poll_interval=0.01)
+
+        self.assertEquals("copying", progress["state"])
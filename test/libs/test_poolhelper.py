@@ -0,0 +1,441 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from xapi.storage.libs import poolhelper
+
+
+class TestCallPluginInPool(unittest.TestCase):
+
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_hosts_called_concurrently(self, mock_log, mockXenAPI,
+                                       mock_call_plugin):
+        host_refs = ["host1", "host2", "host3"]
+        # Each call only succeeds once every host has been called
+        lock = threading.Lock()
+        called = []
+        all_called = threading.Event()
+
+        def call_plugin(dbg, session, host_ref, *args):
+            with lock:
+                called.append(host_ref)
+                if len(called) == len(host_refs):
+                    all_called.set()
+            all_called.wait(5)
+            if not all_called.is_set():
+                raise Exception("hosts called one at a time")
+            return "True"
+
+        mock_call_plugin.side_effect = call_plugin
+
+        succeeded, failures = poolhelper._call_plugin_on_hosts(
+            "test", "OpaqueRef:session", host_refs, "plugin", "fn", {}, 5)
+
+        self.assertEquals(sorted(host_refs), sorted(succeeded))
+        self.assertEquals({}, failures)
+        self.assertEquals(3, mock_call_plugin.call_count)
+
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_failures_aggregated(self, mock_log, mockXenAPI,
+                                 mock_call_plugin):
+        def call_plugin(dbg, session, host_ref, *args):
+            if host_ref != "host2":
+                raise Exception("failed on %s" % host_ref)
+            return "True"
+
+        mock_call_plugin.side_effect = call_plugin
+
+        succeeded, failures = poolhelper._call_plugin_on_hosts(
+            "test", "OpaqueRef:session", ["host1", "host2", "host3"],
+            "plugin", "fn", {}, 5)
+
+        self.assertEquals(["host2"], succeeded)
+        self.assertEquals(["host1", "host3"], sorted(failures.keys()))
+
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_slow_host_times_out(self, mock_log, mockXenAPI,
+                                 mock_call_plugin):
+        release = threading.Event()
+
+        def call_plugin(dbg, session, host_ref, *args):
+            if host_ref == "host1":
+                release.wait()
+            return "True"
+
+        mock_call_plugin.side_effect = call_plugin
+
+        try:
+            succeeded, failures = poolhelper._call_plugin_on_hosts(
+                "test", "OpaqueRef:session", ["host1", "host2"],
+                "plugin", "fn", {}, 0.1)
+        finally:
+            release.set()
+
+        self.assertEquals(["host2"], succeeded)
+        self.assertEquals(["host1"], failures.keys())
+
+
+class TestCallPluginInWaves(unittest.TestCase):
+
+    @mock.patch('xapi.storage.libs.poolhelper.get_session')
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_waves_called_in_order(self, mock_log, mockXenAPI,
+                                   mock_call_plugin, mock_get_session):
+        lock = threading.Lock()
+        called = []
+
+        def call_plugin(dbg, session, host_ref, *args):
+            with lock:
+                called.append(host_ref)
+            return ""
+
+        mock_call_plugin.side_effect = call_plugin
+
+        succeeded = poolhelper.call_plugin_in_waves(
+            "test", [["host1", "host2"], ["host3"]], "plugin", "fn", {},
+            expected=None)
+
+        self.assertEquals(["host1", "host2", "host3"], sorted(succeeded))
+        self.assertEquals(["host1", "host2"], sorted(called[:2]))
+        self.assertEquals("host3", called[2])
+        self.assertEquals(None, mock_call_plugin.call_args[0][6])
+
+    @mock.patch('xapi.storage.libs.poolhelper.get_session')
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_failed_wave_stops_later_waves(self, mock_log, mockXenAPI,
+                                           mock_call_plugin,
+                                           mock_get_session):
+        def call_plugin(dbg, session, host_ref, *args):
+            if host_ref == "host2":
+                raise Exception("failed on %s" % host_ref)
+            return "True"
+
+        mock_call_plugin.side_effect = call_plugin
+
+        with self.assertRaises(poolhelper.PoolPluginCallFailed) as cm:
+            poolhelper.call_plugin_in_waves(
+                "test", [["host1", "host2"], ["host3"]], "plugin", "fn", {})
+
+        self.assertEquals(["host1"], cm.exception.succeeded)
+        self.assertEquals(["host2"], cm.exception.failures.keys())
+        self.assertEquals(2, mock_call_plugin.call_count)
+
+
+class XenAPIFailure(Exception):
+
+    def __init__(self, details):
+        Exception.__init__(self, details)
+        self.details = details
+
+
+class PoolHelperCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        patches = [
+            mock.patch('xapi.storage.libs.poolhelper.CACHE_DIR',
+                       self.cache_dir),
+            mock.patch('xapi.storage.libs.poolhelper.SESSION_FILE',
+                       os.path.join(self.cache_dir, "session")),
+            mock.patch('xapi.storage.libs.poolhelper.SESSION_LOCK',
+                       os.path.join(self.cache_dir, "session.lock")),
+            mock.patch('xapi.storage.libs.poolhelper.HOST_DIRECTORY_FILE',
+                       os.path.join(self.cache_dir, "hosts.json")),
+            mock.patch('xapi.storage.libs.poolhelper._session_ref', None),
+            mock.patch('xapi.storage.libs.poolhelper.log')
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def fake_session(self, mockXenAPI, login_delay=0):
+        # Every proxy made, and the refs of those logged out
+        self.proxies = []
+        self.logged_out = []
+        logins = []
+
+        def xapi_local():
+            session = mock.MagicMock()
+            session._session = None
+
+            def login(user, password):
+                time.sleep(login_delay)
+                logins.append(session)
+                session._session = "OpaqueRef:session%d" % len(logins)
+            session.xenapi.login_with_password.side_effect = login
+            session.xenapi.session.logout.side_effect = \
+                lambda: self.logged_out.append(session._session)
+            self.proxies.append(session)
+            return session
+        mockXenAPI.xapi_local.side_effect = xapi_local
+        mockXenAPI.Failure = XenAPIFailure
+
+    def record_session(self, session_ref):
+        with open(poolhelper.SESSION_FILE, "w") as f:
+            f.write(session_ref)
+
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    def test_session_persisted(self, mockXenAPI):
+        self.fake_session(mockXenAPI)
+
+        session = poolhelper.get_session("test")
+
+        self.assertEquals("OpaqueRef:session1", session._session)
+        with open(poolhelper.SESSION_FILE) as f:
+            self.assertEquals("OpaqueRef:session1", f.read())
+        self.assertEquals(
+            0600, os.stat(poolhelper.SESSION_FILE).st_mode & 0777)
+
+        # Another process picks up the recorded session
+        poolhelper._session_ref = None
+        session = poolhelper.get_session("test")
+
+        self.assertEquals("OpaqueRef:session1", session._session)
+        session.xenapi.login_with_password.assert_not_called()
+
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    def test_concurrent_logins(self, mockXenAPI):
+        self.fake_session(mockXenAPI, login_delay=0.1)
+        sessions = []
+
+        def get_session():
+            # As if in another process
+            with mock.patch('xapi.storage.libs.poolhelper._session_ref',
+                            None):
+                sessions.append(poolhelper.get_session("test")._session)
+
+        threads = [threading.Thread(target=get_session) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(["OpaqueRef:session1"] * 3, sessions)
+        self.assertEquals(
+            1, len([p for p in self.proxies
+                    if p.xenapi.login_with_password.called]))
+
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    def test_with_session_logs_in_again(self, mockXenAPI):
+        self.fake_session(mockXenAPI)
+        self.record_session("OpaqueRef:expired")
+        sessions = []
+
+        def fn(session):
+            sessions.append(session._session)
+            if session._session == "OpaqueRef:expired":
+                raise XenAPIFailure(['SESSION_INVALID', 'OpaqueRef:expired'])
+            return "done"
+
+        self.assertEquals("done", poolhelper.with_session("test", fn))
+        self.assertEquals(["OpaqueRef:expired", "OpaqueRef:session1"],
+                          sessions)
+        with open(poolhelper.SESSION_FILE) as f:
+            self.assertEquals("OpaqueRef:session1", f.read())
+        self.assertEquals(["OpaqueRef:expired"], self.logged_out)
+
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    def test_with_session_adopts_newer_session(self, mockXenAPI):
+        self.fake_session(mockXenAPI)
+        poolhelper._session_ref = "OpaqueRef:expired"
+        # Another process has logged in again already
+        self.record_session("OpaqueRef:other")
+        sessions = []
+
+        def fn(session):
+            sessions.append(session._session)
+            if session._session == "OpaqueRef:expired":
+                raise XenAPIFailure(['SESSION_INVALID', 'OpaqueRef:expired'])
+            return "done"
+
+        self.assertEquals("done", poolhelper.with_session("test", fn))
+        self.assertEquals(["OpaqueRef:expired", "OpaqueRef:other"], sessions)
+        self.assertEquals("OpaqueRef:other", poolhelper._session_ref)
+        for proxy in self.proxies:
+            proxy.xenapi.login_with_password.assert_not_called()
+        self.assertEquals([], self.logged_out)
+
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    def test_with_session_other_failure(self, mockXenAPI):
+        self.fake_session(mockXenAPI)
+        poolhelper._session_ref = "OpaqueRef:session"
+        fn = mock.MagicMock(side_effect=XenAPIFailure(['HOST_OFFLINE']))
+
+        self.assertRaises(XenAPIFailure, poolhelper.with_session, "test", fn)
+        self.assertEquals(1, fn.call_count)
+        self.assertEquals("OpaqueRef:session", poolhelper._session_ref)
+
+    def host_session(self):
+        session = mock.MagicMock()
+        session.xenapi.host.get_all_records.return_value = {
+            "OpaqueRef:host1": {"name_label": "host1", "uuid": "uuid1",
+                                "metrics": "OpaqueRef:metrics1"},
+            "OpaqueRef:host2": {"name_label": "host2", "uuid": "uuid2",
+                                "metrics": "OpaqueRef:metrics2"}
+        }
+        session.xenapi.host_metrics.get_all_records.return_value = {
+            "OpaqueRef:metrics1": {"live": True},
+            "OpaqueRef:metrics2": {"live": False}
+        }
+        return session
+
+    def test_host_directory_cached(self):
+        session = self.host_session()
+
+        directory = poolhelper.get_host_directory("test", session)
+
+        self.assertEquals(
+            {"ref": "OpaqueRef:host1", "uuid": "uuid1", "live": True},
+            directory["host1"])
+        self.assertEquals(["OpaqueRef:host1"],
+                          poolhelper.get_online_host_refs("test", session))
+        self.assertEquals(
+            1, session.xenapi.host.get_all_records.call_count)
+
+        poolhelper.get_host_directory("test", session, refresh=True)
+
+        self.assertEquals(
+            2, session.xenapi.host.get_all_records.call_count)
+
+    @mock.patch('time.time')
+    def test_host_directory_expires(self, mock_time):
+        session = self.host_session()
+        mock_time.return_value = 1000
+        poolhelper.get_host_directory("test", session)
+        os.utime(poolhelper.HOST_DIRECTORY_FILE, (1000, 1000))
+
+        mock_time.return_value = 1000 + poolhelper.HOST_DIRECTORY_TTL - 1
+        poolhelper.get_host_directory("test", session)
+
+        self.assertEquals(
+            1, session.xenapi.host.get_all_records.call_count)
+
+        mock_time.return_value = 1000 + poolhelper.HOST_DIRECTORY_TTL
+        poolhelper.get_host_directory("test", session)
+
+        self.assertEquals(
+            2, session.xenapi.host.get_all_records.call_count)
+
+    @mock.patch('xapi.storage.libs.poolhelper.get_session')
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin_on_wave')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    def test_host_directory_invalidated_on_failure(self, mockXenAPI,
+                                                   call_plugin_on_wave,
+                                                   get_session):
+        mockXenAPI.Failure = XenAPIFailure
+        get_session.return_value = self.host_session()
+        call_plugin_on_wave.return_value = ([], {"OpaqueRef:host1": "error"})
+
+        self.assertRaises(poolhelper.PoolPluginCallFailed,
+                          poolhelper.call_plugin_in_pool,
+                          "test", "plugin", "fn", {})
+
+        self.assertFalse(os.path.exists(poolhelper.HOST_DIRECTORY_FILE))
+
+    def test_call_plugin_unexpected_result(self):
+        session = mock.MagicMock()
+        session.xenapi.host.call_plugin.return_value = "False"
+
+        self.assertRaises(poolhelper.PluginCallFailed,
+                          poolhelper._call_plugin,
+                          "test", session, "OpaqueRef:host1", "plugin", "fn",
+                          {})
+
+
+class TestSuspendInPool(unittest.TestCase):
+
+    @mock.patch('xapi.storage.libs.poolhelper.get_session')
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin_on_hosts')
+    @mock.patch('xapi.storage.libs.poolhelper.call_plugin_in_pool')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_rollback_resumes_hosts_which_answered(
+            self, mock_log, mock_call_plugin_in_pool,
+            mock_call_plugin_on_hosts, mock_get_session):
+        mock_call_plugin_in_pool.side_effect = \
+            poolhelper.PoolPluginCallFailed(
+                "suspend-resume-datapath", "suspend_datapath",
+                {"host2": poolhelper.PluginCallTimedOut("no answer"),
+                 "host3": Exception("failed")},
+                ["host1"])
+        mock_call_plugin_on_hosts.return_value = ([], {})
+
+        with self.assertRaises(poolhelper.PoolPluginCallFailed) as cm:
+            poolhelper.suspend_datapath_in_pool("test", "/dev/sm/backend/sr/1")
+
+        self.assertEquals(["host2"], cm.exception.timed_out)
+        mock_call_plugin_on_hosts.assert_called_once_with(
+            "test", mock_get_session.return_value._session,
+            ["host1", "host3"], "suspend-resume-datapath",
+            "resume_datapath", {'path': "/dev/sm/backend/sr/1"},
+            poolhelper.PLUGIN_CALL_TIMEOUT)
+
+    @mock.patch('xapi.storage.libs.poolhelper.PLUGIN_CALL_TIMEOUT', 0.1)
+    @mock.patch('xapi.storage.libs.poolhelper.get_online_host_refs',
+                return_value=["host1", "host2"])
+    @mock.patch('xapi.storage.libs.poolhelper.invalidate_host_directory')
+    @mock.patch('xapi.storage.libs.poolhelper.get_session')
+    @mock.patch('xapi.storage.libs.poolhelper._call_plugin')
+    @mock.patch('xapi.storage.libs.poolhelper.XenAPI')
+    @mock.patch('xapi.storage.libs.poolhelper.log')
+    def test_rollback_does_not_overtake_slow_suspend(
+            self, mock_log, mockXenAPI, mock_call_plugin, mock_get_session,
+            mock_invalidate, mock_get_online_host_refs):
+        mockXenAPI.Failure = XenAPIFailure
+        lock = threading.Lock()
+        calls = []
+        release = threading.Event()
+
+        def call_plugin(dbg, session, host_ref, plugin_name,
+                        plugin_function, *args):
+            if (host_ref, plugin_function) == ("host2", "suspend_datapath"):
+                # Still suspending long after the caller gave up
+                release.wait(5)
+            with lock:
+                calls.append((host_ref, plugin_function))
+            if host_ref == "host1":
+                raise Exception("failed")
+            return "True"
+
+        mock_call_plugin.side_effect = call_plugin
+
+        try:
+            with self.assertRaises(poolhelper.PoolPluginCallFailed) as cm:
+                poolhelper.suspend_datapath_in_pool(
+                    "test", "/dev/sm/backend/sr/1")
+        finally:
+            release.set()
+
+        self.assertEquals(["host2"], cm.exception.timed_out)
+        self.assertEquals([("host1", "suspend_datapath"),
+                           ("host1", "resume_datapath")], calls[:2])
+        self.assertNotIn(("host2", "resume_datapath"), calls)
+
+    @mock.patch('xapi.storage.libs.poolhelper.call_plugin_in_pool')
+    def test_batch_calls(self, mock_call_plugin_in_pool):
+        paths = ["/sr/a.vhd", "/sr/b.vhd"]
+
+        poolhelper.suspend_datapaths_in_pool("test", paths)
+        poolhelper.resume_datapaths_in_pool("test", paths)
+
+        mock_call_plugin_in_pool.assert_has_calls([
+            mock.call("test", "suspend-resume-datapath", "suspend_datapaths",
+                      {'paths': json.dumps(paths)},
+                      poolhelper.PLUGIN_CALL_TIMEOUT),
+            mock.call("test", "suspend-resume-datapath", "resume_datapaths",
+                      {'paths': json.dumps(paths)})])
@@ -0,0 +1,112 @@
+import os
+import json
+import mock
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from xapi.storage.libs.rrddlib import backend, control, Datasource
+
+
+class PluginBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(backend, 'PLUGIN_PATH',
+                                    self.plugin_dir + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.subject = backend.PluginBackend('test')
+
+    def tearDown(self):
+        del self.subject
+        shutil.rmtree(self.plugin_dir)
+
+    def contents(self):
+        with open(os.path.join(self.plugin_dir, 'test')) as f:
+            return f.read()
+
+    @mock.patch('xapi.storage.libs.rrddlib.backend.time')
+    def test_full_and_fast_update(self, mock_time):
+        mock_time.return_value = 1000.5
+        ds_dict = {
+            'a': Datasource('a', 1.5, 'float'),
+            'b': Datasource('b', 7, 'int64')
+        }
+
+        self.subject.full_update(ds_dict)
+        ds_dict['a'].set_value(2.5)
+        self.subject.fast_update(ds_dict)
+
+        data = self.contents()
+        self.assertEquals('DATASOURCES', data[:11])
+        (data_crc, metadata_crc, count) = struct.unpack('>iii', data[11:23])
+        self.assertEquals(2, count)
+        values = dict(zip(ds_dict, [2.5, 7]))
+        fmt = '>q' + ''.join(['d' if key == 'a' else 'q' for key in ds_dict])
+        size = struct.calcsize(fmt)
+        self.assertEquals(
+            (1000,) + tuple([values[key] for key in ds_dict]),
+            struct.unpack(fmt, data[23:23 + size]))
+        self.assertEquals(zlib.crc32(data[23:23 + size]), data_crc)
+        (metadata_len,) = struct.unpack(
+            '>i', data[23 + size:27 + size])
+        metadata = data[27 + size:27 + size + metadata_len]
+        self.assertEquals(zlib.crc32(metadata), metadata_crc)
+        self.assertEquals(
+            set(['a', 'b']), set(json.loads(metadata)['datasources']))
+
+
+class PluginControlTest(unittest.TestCase):
+
+    @mock.patch('xapi.storage.libs.rrddlib.control.PluginBackend')
+    @mock.patch('xmlrpclib.ServerProxy')
+    def setUp(self, mock_proxy, mock_backend):
+        self.now = [100.0]
+        self.sleeps = []
+        plugin = mock_proxy.return_value.Plugin
+        self.register = plugin.Local.register
+        plugin.Local.deregister.return_value = {
+            'Status': 'Success', 'Value': None}
+        self.subject = control.PluginControl(
+            'test', 'Local', 'Five_seconds', 0.5)
+
+    def tearDown(self):
+        control.PluginControl._PluginControl__plugin_proxy = None
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now[0] += seconds
+
+    def wake_up(self, work=0.0):
+        with mock.patch('time.time', side_effect=lambda: self.now[0]), \
+                mock.patch('time.sleep', side_effect=self.sleep):
+            self.subject.wake_up_before_next_reading()
+        self.now[0] += work
+
+    def test_registers_once_per_registration_period(self):
+        self.register.return_value = {'Status': 'Success', 'Value': 2.0}
+
+        for _ in range(control.READINGS_PER_REGISTRATION + 1):
+            # Collecting the data takes some time, which must not
+            # make the wake-ups drift
+            self.wake_up(work=0.2)
+
+        self.assertEquals(2, self.register.call_count)
+        # The second registration says the next reading is 2s away
+        self.assertEquals(
+            [1.5] + [4.8] * (control.READINGS_PER_REGISTRATION - 1) + [1.5],
+            [round(s, 6) for s in self.sleeps])
+
+    def test_skips_overslept_readings(self):
+        self.register.return_value = {'Status': 'Success', 'Value': 2.0}
+
+        self.wake_up(work=7.0)
+        self.wake_up()
+
+        self.assertEquals(1, self.register.call_count)
+        # Woke at 101.5, back at 108.5: the reading at 107 is missed,
+        # so wake up before the one at 112
+        self.assertEquals([1.5, 3.0], [round(s, 6) for s in self.sleeps])
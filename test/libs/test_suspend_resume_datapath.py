@@ -0,0 +1,99 @@
+import imp
+import json
+import mock
+import os
+import sys
+import unittest
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                      "overlay", "etc", "xapi.d", "plugins",
+                      "suspend-resume-datapath")
+
+with mock.patch.dict(sys.modules, {'XenAPIPlugin': mock.MagicMock()}):
+    plugin = imp.load_source("suspend_resume_datapath", PLUGIN)
+
+
+def datapaths(*paths):
+    return [plugin.Datapath(path, mock.MagicMock(), mock.MagicMock())
+            for path in paths]
+
+
+@mock.patch.object(plugin, 'log')
+class SuspendResumeDatapathTest(unittest.TestCase):
+
+    @mock.patch.object(plugin.tapdisk, 'find_by_files')
+    @mock.patch.object(plugin.dmsetup, 'find_all')
+    @mock.patch.object(plugin.losetup, 'find_all')
+    def test_find_datapaths(self, losetup_find_all, dmsetup_find_all,
+                            find_by_files, log):
+        loop = mock.MagicMock()
+        loop.block_device.return_value = "/dev/loop0"
+        losetup_find_all.return_value = {"/sr/a.raw": loop}
+        dmsetup_find_all.return_value = {"/dev/loop0": "dm-a"}
+        find_by_files.return_value = {"/sr/b.vhd": "tap-b"}
+
+        found = plugin._find_datapaths("test", ["/sr/a.raw", "/sr/b.vhd"])
+
+        self.assertEquals([("/sr/a.raw", "dm-a", None),
+                           ("/sr/b.vhd", None, "tap-b")],
+                          [(d.path, d.dm, d.tap) for d in found])
+        dmsetup_find_all.assert_called_once_with("test", ["/dev/loop0"])
+
+    def test_in_parallel_raises_after_all_ran(self, log):
+        done = []
+
+        def fn(item):
+            done.append(item)
+            if item == "b":
+                raise Exception("b failed")
+
+        with self.assertRaises(Exception) as cm:
+            plugin._in_parallel("test", fn, ["a", "b", "c"])
+
+        self.assertEquals(["a", "b", "c"], sorted(done))
+        self.assertIn("b failed", str(cm.exception))
+
+    @mock.patch.object(plugin, '_find_datapaths')
+    def test_suspend_datapaths(self, find_datapaths, log):
+        find_datapaths.return_value = datapaths("/sr/a.vhd", "/sr/b.vhd")
+
+        self.assertEquals("True", plugin.suspend_datapaths(
+            None, {'paths': json.dumps(["/sr/a.vhd", "/sr/b.vhd"])}))
+
+        find_datapaths.assert_called_once_with(None, ["/sr/a.vhd",
+                                                      "/sr/b.vhd"])
+        for datapath in find_datapaths.return_value:
+            datapath.dm.suspend.assert_called_once_with(None)
+            datapath.tap.pause.assert_called_once_with(None)
+
+    @mock.patch.object(plugin, '_find_datapaths')
+    def test_resume_datapaths_failure(self, find_datapaths, log):
+        find_datapaths.return_value = datapaths("/sr/a.vhd", "/sr/b.vhd")
+        find_datapaths.return_value[0].tap.unpause.side_effect = \
+            Exception("tap-ctl unpause failed")
+
+        self.assertRaises(Exception, plugin.resume_datapaths,
+                          None, {'paths': json.dumps(["/sr/a.vhd",
+                                                      "/sr/b.vhd"])})
+
+        # The other path is resumed all the same
+        find_datapaths.return_value[1].tap.unpause.assert_called_once_with(
+            None)
+
+    @mock.patch.object(plugin.tapdisk, 'save_tapdisk_metadata')
+    @mock.patch.object(plugin.tapdisk, 'forget_tapdisk_metadata')
+    @mock.patch.object(plugin, '_find_datapaths')
+    def test_refresh_datapaths(self, find_datapaths, forget, save, log):
+        (a, b) = datapaths("/sr/a.vhd", "/sr/b.vhd")
+        b.dm = None
+        find_datapaths.return_value = [a, b]
+
+        plugin.refresh_datapaths(None, {'paths': json.dumps(
+            [["/sr/a.vhd", "/sr/a.vhd"], ["/sr/b.vhd", "/sr/c.vhd"]])})
+
+        a.dm.suspend.assert_called_once_with(None)
+        a.dm.resume.assert_called_once_with(None)
+        self.assertEquals("/sr/c.vhd",
+                          b.tap.unpause.call_args[0][1].path)
+        forget.assert_called_once_with(None, "/sr/b.vhd")
+        save.assert_called_once_with(None, "/sr/c.vhd", b.tap)
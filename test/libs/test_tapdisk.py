@@ -0,0 +1,59 @@
+import mock
+import unittest
+
+from xapi.storage.libs import tapdisk
+from xapi.storage.libs import tapdiskregistry
+
+
+@mock.patch('xapi.storage.libs.tapdisk.log')
+@mock.patch('xapi.storage.libs.tapdisk.tap_ctl_list')
+@mock.patch('xapi.storage.libs.tapdisk.get_registry')
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = tapdiskregistry.TapdiskRegistry(":memory:")
+        with self.registry.write_context():
+            self.registry.put("/sr/1", 1, 100, "vhd", "/sr/1.vhd")
+            self.registry.put("/sr/2", 2, 101, "vhd", "/sr/2.vhd")
+            self.registry.put("/sr/3", 3, 102, "vhd", "/sr/3.vhd")
+            self.registry.put("/sr/4", 4, 103, "vhd", "/sr/4.vhd")
+            self.registry.add_pool_member(104)
+            self.registry.update_pool_member(104, 5, True)
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_reconcile_after_crash(self, get_registry, tap_ctl_list, log):
+        get_registry.return_value = self.registry
+        tap_ctl_list.return_value = {
+            1: {'minor': 1, 'pid': 100, 'state': '0', 'args': 'vhd:/sr/1.vhd'},
+            # Minor 2's tapdisk died and another process took the minor
+            2: {'minor': 2, 'pid': 200, 'state': '0', 'args': None},
+            # Minor 3 has gone altogether
+            4: {'minor': 4, 'pid': 103, 'state': '0', 'args': 'aio:/sr/4.raw'},
+            5: {'minor': 5, 'pid': 104, 'state': '0', 'args': None},
+            6: {'minor': 6, 'pid': 105, 'state': '0', 'args': None}
+        }
+
+        unknown = tapdisk.reconcile("test")
+
+        self.assertEquals([2, 6], unknown)
+        self.assertEquals(["/sr/1", "/sr/4"],
+                          sorted([row['path'] for row in
+                                  self.registry.get_all()]))
+        self.assertIsNone(tapdisk.find_by_minor("test", 2))
+        self.assertIsNone(tapdisk.find_by_minor("test", 3))
+        self.assertEquals([], tapdisk.find_by_pid("test", 101))
+        row = self.registry.get_by_minor(4)
+        self.assertEquals(("raw", "/sr/4.raw"), (row['format'], row['image']))
+
+    def test_reconcile_with_live_list(self, get_registry, tap_ctl_list, log):
+        get_registry.return_value = self.registry
+        live = {1: {'minor': 1, 'pid': 100, 'state': '0',
+                    'args': 'vhd:/sr/1.vhd'}}
+
+        tapdisk.reconcile("test", live)
+
+        tap_ctl_list.assert_not_called()
+        self.assertEquals(["/sr/1"],
+                          [row['path'] for row in self.registry.get_all()])
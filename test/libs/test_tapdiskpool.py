@@ -0,0 +1,163 @@
+import mock
+import shutil
+import tempfile
+import unittest
+
+from xapi.storage.libs import tapdiskpool
+from xapi.storage.libs import tapdiskregistry
+
+
+@mock.patch('xapi.storage.libs.tapdiskpool.log')
+@mock.patch('xapi.storage.libs.tapdiskpool.tapdisk')
+class TapdiskPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = tapdiskregistry.TapdiskRegistry(":memory:")
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.registry.close()
+        shutil.rmtree(self.lock_dir)
+
+    def add_members(self, *members):
+        with self.registry.write_context():
+            for (pid, minor, ready) in members:
+                self.registry.add_pool_member(pid)
+                self.registry.update_pool_member(pid, minor, ready)
+
+    @mock.patch('xapi.storage.libs.tapdiskpool.read_sysconfig')
+    def test_get_watermarks(self, read_sysconfig, tapdisk, log):
+        read_sysconfig.return_value = {}
+        self.assertEquals((2, 4), tapdiskpool.get_watermarks("test"))
+
+        read_sysconfig.return_value = {"TAPDISK_POOL_LOW": "3",
+                                       "TAPDISK_POOL_HIGH": "1"}
+        self.assertEquals((3, 3), tapdiskpool.get_watermarks("test"))
+
+        read_sysconfig.return_value = {"TAPDISK_POOL_LOW": "many"}
+        self.assertEquals((2, 4), tapdiskpool.get_watermarks("test"))
+
+    @mock.patch('xapi.storage.libs.tapdiskpool.get_watermarks',
+                return_value=(0, 0))
+    def test_create_pool_disabled(self, get_watermarks, tapdisk, log):
+        tap = tapdiskpool.create("test")
+
+        self.assertEquals(tapdisk.create.return_value, tap)
+        tapdisk.get_registry.assert_not_called()
+
+    @mock.patch('xapi.storage.libs.tapdiskpool.replenish_async')
+    @mock.patch('xapi.storage.libs.tapdiskpool._is_running',
+                return_value=True)
+    @mock.patch('xapi.storage.libs.tapdiskpool.get_watermarks',
+                return_value=(2, 4))
+    def test_create_takes_member(self, get_watermarks, is_running,
+                                 replenish_async, tapdisk, log):
+        tapdisk.get_registry.return_value = self.registry
+        self.add_members((100, 1, True), (101, 2, True), (102, 3, True),
+                         (103, None, False))
+
+        tap = tapdiskpool.create("test")
+
+        self.assertEquals(tapdisk.Tapdisk.return_value, tap)
+        tapdisk.create.assert_not_called()
+        self.assertEquals(2, self.registry.count_ready_pool_members())
+        # Still at the low watermark
+        replenish_async.assert_not_called()
+
+        tapdiskpool.create("test")
+
+        self.assertEquals(1, self.registry.count_ready_pool_members())
+        replenish_async.assert_called_once_with("test")
+
+    @mock.patch('xapi.storage.libs.tapdiskpool.replenish_async')
+    @mock.patch('xapi.storage.libs.tapdiskpool.get_watermarks',
+                return_value=(2, 4))
+    def test_create_empty_pool(self, get_watermarks, replenish_async,
+                               tapdisk, log):
+        tapdisk.get_registry.return_value = self.registry
+
+        tap = tapdiskpool.create("test")
+
+        self.assertEquals(tapdisk.create.return_value, tap)
+        replenish_async.assert_called_once_with("test")
+
+    @mock.patch('xapi.storage.libs.tapdiskpool._destroy_member',
+                side_effect=Exception("tap-ctl free failed"))
+    @mock.patch('xapi.storage.libs.tapdiskpool.replenish_async')
+    @mock.patch('xapi.storage.libs.tapdiskpool._is_running',
+                return_value=False)
+    @mock.patch('xapi.storage.libs.tapdiskpool.get_watermarks',
+                return_value=(2, 4))
+    def test_create_dead_member(self, get_watermarks, is_running,
+                                replenish_async, destroy_member, tapdisk,
+                                log):
+        tapdisk.get_registry.return_value = self.registry
+        self.add_members((100, 1, True))
+
+        tap = tapdiskpool.create("test")
+
+        # Failing to clean up the dead member does not fail the attach
+        destroy_member.assert_called_once_with("test", 100, 1, False)
+        self.assertEquals(tapdisk.create.return_value, tap)
+        self.assertEquals([], self.registry.get_pool_members())
+
+    @mock.patch('xapi.storage.libs.tapdiskpool._destroy_member')
+    def test_reap(self, destroy_member, tapdisk, log):
+        tapdisk.get_registry.return_value = self.registry
+        tapdisk.tap_ctl_list.return_value = {
+            1: {'pid': 100, 'minor': 1},
+            # Minor 2 has been reused by another tapdisk
+            2: {'pid': 200, 'minor': 2}
+        }
+        self.add_members((100, 1, True), (101, 2, True), (102, None, False),
+                         (103, 3, False))
+
+        tapdiskpool.reap("test")
+
+        tapdisk.reconcile.assert_called_once_with(
+            "test", tapdisk.tap_ctl_list.return_value)
+        self.assertEquals(
+            [100], [m['pid'] for m in self.registry.get_pool_members()])
+        destroy_member.assert_has_calls([
+            mock.call("test", 101, 2, True),
+            mock.call("test", 102, None, False),
+            mock.call("test", 103, 3, False)])
+
+    @mock.patch('xapi.storage.libs.tapdiskpool._add_member')
+    @mock.patch('xapi.storage.libs.tapdiskpool.reap')
+    @mock.patch('xapi.storage.libs.tapdiskpool.get_watermarks',
+                return_value=(2, 4))
+    def test_replenish_to_high_watermark(self, get_watermarks, reap,
+                                         add_member, tapdisk, log):
+        tapdisk.get_registry.return_value = self.registry
+        self.add_members((100, 0, True))
+        pids = iter(range(101, 110))
+
+        def add(dbg, registry):
+            pid = next(pids)
+            self.add_members((pid, pid - 100, True))
+        add_member.side_effect = add
+
+        with mock.patch('xapi.storage.libs.tapdiskpool.REPLENISH_LOCK',
+                        self.lock_dir + "/pool.lock"):
+            tapdiskpool.replenish("test")
+
+        reap.assert_called_once_with("test")
+        self.assertEquals(3, add_member.call_count)
+        self.assertEquals(4, self.registry.count_ready_pool_members())
+
+    @mock.patch('xapi.storage.libs.tapdiskpool._add_member',
+                side_effect=Exception("tap-ctl allocate failed"))
+    @mock.patch('xapi.storage.libs.tapdiskpool.reap')
+    @mock.patch('xapi.storage.libs.tapdiskpool.get_watermarks',
+                return_value=(2, 4))
+    def test_replenish_gives_up_on_failure(self, get_watermarks, reap,
+                                           add_member, tapdisk, log):
+        tapdisk.get_registry.return_value = self.registry
+
+        with mock.patch('xapi.storage.libs.tapdiskpool.REPLENISH_LOCK',
+                        self.lock_dir + "/pool.lock"):
+            tapdiskpool.replenish("test")
+
+        add_member.assert_called_once()
+        self.assertEquals(0, self.registry.count_ready_pool_members())
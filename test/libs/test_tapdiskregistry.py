@@ -0,0 +1,108 @@
+import unittest
+
+from xapi.storage.libs import tapdiskregistry
+
+
+class TapdiskRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.subject = tapdiskregistry.TapdiskRegistry(":memory:")
+
+    def tearDown(self):
+        self.subject.close()
+
+    def test_lookup_success(self):
+        with self.subject.write_context():
+            self.subject.put("/sr/1", 1, 100, "vhd", "/sr/1")
+            self.subject.put("/sr/2", 2, 100)
+            self.subject.put("/sr/3", 3, 200, "raw", "/sr/3", "nbd:token")
+
+        row = self.subject.get_by_path("/sr/3")
+        self.assertEquals(3, row['minor'])
+        self.assertEquals(200, row['pid'])
+        self.assertEquals("raw", row['format'])
+        self.assertEquals("nbd:token", row['secondary'])
+
+        self.assertEquals("/sr/1", self.subject.get_by_minor(1)['path'])
+        self.assertEquals(None, self.subject.get_by_minor(4))
+        self.assertEquals(
+            ["/sr/1", "/sr/2"],
+            sorted([row['path'] for row in self.subject.get_by_pid(100)]))
+        self.assertEquals(
+            [1, 2, 3], [row['minor'] for row in self.subject.get_all()])
+
+    def test_put_replaces_path_and_minor(self):
+        with self.subject.write_context():
+            self.subject.put("/sr/1", 1, 100)
+            self.subject.put("/sr/1", 1, 100, "vhd", "/sr/1")
+            # Minor 1 has been handed to another volume
+            self.subject.put("/sr/2", 1, 101)
+
+        self.assertEquals(None, self.subject.get_by_path("/sr/1"))
+        self.assertEquals("/sr/2", self.subject.get_by_minor(1)['path'])
+        self.assertEquals(1, len(self.subject.get_all()))
+
+    def test_remove_success(self):
+        with self.subject.write_context():
+            self.subject.put("/sr/1", 1, 100)
+            self.subject.put("/sr/2", 2, 100)
+            self.subject.remove("/sr/1")
+            self.subject.remove_minor(2)
+            # Removing something unknown is harmless
+            self.subject.remove("/sr/3")
+
+        self.assertEquals([], self.subject.get_all())
+
+    def test_write_context_rolls_back(self):
+        try:
+            with self.subject.write_context():
+                self.subject.put("/sr/1", 1, 100)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEquals(None, self.subject.get_by_path("/sr/1"))
+
+    def test_pool_take_only_ready(self):
+        with self.subject.write_context():
+            self.subject.add_pool_member(100)
+            self.subject.add_pool_member(101)
+            self.subject.update_pool_member(101, 5, True)
+            self.subject.add_pool_member(102)
+            self.subject.update_pool_member(102, 6, False)
+
+        self.assertEquals(1, self.subject.count_ready_pool_members())
+        with self.subject.write_context():
+            member = self.subject.take_pool_member()
+            self.assertEquals((101, 5), (member['pid'], member['minor']))
+            self.assertEquals(None, self.subject.take_pool_member())
+
+        self.assertEquals(
+            [100, 102],
+            [row['pid'] for row in self.subject.get_pool_members()])
+
+    def test_idle_read_caches_least_recently_used_first(self):
+        with self.subject.write_context():
+            self.subject.put_read_cache("/sr/1", "/cache/1", "a", 30.0)
+            self.subject.put_read_cache("/sr/2", "/cache/2", "b", 10.0)
+            self.subject.put_read_cache("/sr/3", "/cache/3", "c", 20.0)
+            self.subject.add_read_cache_user("/sr/10", "/sr/2")
+            self.subject.add_read_cache_user("/sr/11", "/sr/2")
+
+        self.assertEquals(2, self.subject.count_read_cache_users("/sr/2"))
+        self.assertEquals(
+            ["/cache/3", "/cache/1"],
+            [row['cache'] for row in self.subject.get_idle_read_caches()])
+
+        with self.subject.write_context():
+            self.assertEquals(
+                "/sr/2", self.subject.remove_read_cache_user("/sr/10"))
+            self.assertEquals(
+                None, self.subject.remove_read_cache_user("/sr/10"))
+            self.subject.touch_read_cache("/sr/3", 40.0)
+            self.subject.remove_read_cache("/sr/2")
+
+        self.assertEquals(0, self.subject.count_read_cache_users("/sr/2"))
+        self.assertEquals(
+            ["/cache/1", "/cache/3"],
+            [row['cache'] for row in self.subject.get_idle_read_caches()])
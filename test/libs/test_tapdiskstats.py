@@ -0,0 +1,94 @@
+import mock
+import unittest
+
+from xapi.storage.libs import tapdiskstats
+
+
+def counters(**kwargs):
+    values = dict([(field, 0) for field in tapdiskstats.STAT_FIELDS])
+    values.update(kwargs)
+    return values
+
+
+class TapdiskStatsTest(unittest.TestCase):
+
+    def test_rates_success(self):
+        old = counters(read_ios=100, read_sectors=800, read_ticks=50,
+                       write_ios=10, write_sectors=80, write_ticks=40)
+        new = counters(read_ios=200, read_sectors=1800, read_ticks=250,
+                       write_ios=10, write_sectors=80, write_ticks=40,
+                       in_flight=3)
+
+        rates = tapdiskstats.rates(old, new, 5.0)
+
+        self.assertEquals(20.0, rates['read_iops'])
+        self.assertEquals(0.0, rates['write_iops'])
+        self.assertEquals(1000 * 512 / 5.0, rates['read_throughput'])
+        self.assertEquals(0.0, rates['write_throughput'])
+        self.assertEquals(2.0, rates['read_latency'])
+        # No writes completed, so no meaningful latency
+        self.assertEquals(0.0, rates['write_latency'])
+        self.assertEquals(3.0, rates['inflight'])
+
+    def test_rates_counter_reset(self):
+        old = counters(read_ios=100)
+        new = counters(read_ios=10)
+
+        rates = tapdiskstats.rates(old, new, 5.0)
+
+        self.assertEquals(0.0, rates['read_iops'])
+
+    @mock.patch('xapi.storage.libs.tapdiskstats._mount_points', {})
+    @mock.patch('os.path.ismount')
+    def test_volume_id(self, ismount):
+        mount = "/var/run/sr-mount/dev/disk/by-id/scsi-3600a0980383039737"
+        ismount.side_effect = lambda path: path == mount
+
+        self.assertEquals(
+            "scsi-3600a0980383039737_42",
+            tapdiskstats.volume_id(mount + "/42/42"))
+        # As read caches see a volume in a per-host directory
+        self.assertEquals(
+            "scsi-3600a0980383039737_42",
+            tapdiskstats.volume_id(mount + "/hosts/5d0e8f4c/42/42"))
+        self.assertEquals(
+            "VG_XenStorage-1_42",
+            tapdiskstats.volume_id("/dev/VG_XenStorage-1/42"))
+
+    @mock.patch('xapi.storage.libs.tapdiskstats._mount_points', {})
+    @mock.patch('os.path.ismount')
+    def test_volume_id_two_srs(self, ismount):
+        mounts = ["/var/run/sr-mount/dev/disk/by-id/scsi-360014051",
+                  "/var/run/sr-mount/dev/disk/by-id/scsi-360014052"]
+        ismount.side_effect = lambda path: path in mounts
+
+        # Every SR's metabase numbers its volumes from 1
+        self.assertNotEquals(
+            tapdiskstats.volume_id(mounts[0] + "/1/1"),
+            tapdiskstats.volume_id(mounts[1] + "/1/1"))
+
+    def test_create_datasources(self):
+        ds_dict = tapdiskstats.create_datasources(["sr_1", "sr_2"])
+
+        self.assertEquals(2 * len(tapdiskstats.RATES), len(ds_dict))
+        self.assertEquals(
+            "tapdisk_read_iops_sr_1",
+            ds_dict[("sr_1", "read_iops")].get_property('name'))
+
+    def test_read_cache_rates(self):
+        rates = tapdiskstats.read_cache_rates(
+            {'hits': 100, 'misses': 50}, {'hits': 130, 'misses': 60}, 5.0)
+
+        self.assertEquals(6.0, rates['read_cache_hits'])
+        self.assertEquals(2.0, rates['read_cache_misses'])
+        self.assertEquals(0.75, rates['read_cache_hit_ratio'])
+
+    def test_create_datasources_with_read_caches(self):
+        ds_dict = tapdiskstats.create_datasources(["sr_1"], ["sr_2"])
+
+        self.assertEquals(
+            len(tapdiskstats.RATES) + len(tapdiskstats.READ_CACHE_RATES),
+            len(ds_dict))
+        self.assertEquals(
+            "tapdisk_read_cache_hits_sr_2",
+            ds_dict[("sr_2", "read_cache_hits")].get_property('name'))
@@ -0,0 +1,75 @@
+import unittest
+
+from xapi.storage.libs import iscsisessions
+
+
+class ISCSISessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.subject = iscsisessions.ISCSISessionStore(":memory:")
+
+    def tearDown(self):
+        self.subject.close()
+
+    def test_refcount_success(self):
+        with self.subject.write_context():
+            self.subject.add_ref("iqn1", "iscsi://t/iqn1/1")
+            self.subject.add_ref("iqn1", "probe-uuid")
+            self.subject.add_ref("iqn2", "iscsi://t/iqn2/1")
+
+        self.assertEquals(2, self.subject.get_refcount("iqn1"))
+        self.assertEquals(1, self.subject.get_refcount("iqn2"))
+
+    def test_add_ref_twice_counts_once(self):
+        with self.subject.write_context():
+            self.subject.add_ref("iqn1", "iscsi://t/iqn1/1")
+            self.subject.add_ref("iqn1", "iscsi://t/iqn1/1")
+
+        self.assertEquals(1, self.subject.get_refcount("iqn1"))
+
+    def test_remove_ref_returns_remaining(self):
+        with self.subject.write_context():
+            self.subject.add_ref("iqn1", "a")
+            self.subject.add_ref("iqn1", "b")
+            self.assertEquals(1, self.subject.remove_ref("iqn1", "a"))
+            self.assertEquals(0, self.subject.remove_ref("iqn1", "b"))
+            # Removing an unknown ref is harmless
+            self.assertEquals(0, self.subject.remove_ref("iqn1", "c"))
+
+    def test_session_id_success(self):
+        with self.subject.write_context():
+            self.subject.set_session_id("iqn1", "10.0.0.1:3260", 3)
+            self.subject.set_session_id("iqn1", "10.0.0.2:3260", 4)
+
+        self.assertEquals(
+            3, self.subject.get_session_id("iqn1", "10.0.0.1:3260"))
+        self.assertEquals(
+            4, self.subject.get_session_id("iqn1", "10.0.0.2:3260"))
+        self.assertEquals(
+            None, self.subject.get_session_id("iqn2", "10.0.0.1:3260"))
+
+        with self.subject.write_context():
+            self.subject.set_session_id("iqn1", "10.0.0.1:3260", 7)
+            self.subject.delete_sessions("iqn1")
+
+        self.assertEquals(
+            None, self.subject.get_session_id("iqn1", "10.0.0.1:3260"))
+
+    def test_write_context_rolls_back(self):
+        try:
+            with self.subject.write_context():
+                self.subject.add_ref("iqn1", "a")
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEquals(0, self.subject.get_refcount("iqn1"))
+
+    def test_get_refs(self):
+        with self.subject.write_context():
+            self.subject.add_ref("iqn1", "a")
+            self.subject.add_ref("iqn1", "b")
+            self.subject.add_ref("iqn2", "c")
+
+        self.assertEquals(["a", "b"], sorted(self.subject.get_refs("iqn1")))
+        self.assertEquals([], self.subject.get_refs("iqn3"))
@@ -0,0 +1,335 @@
+import mock
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import urlparse
+
+import xapi.storage.api.volume
+from xapi.storage.libs import libiscsi
+from xapi.storage.libs import iscsisessions
+
+IQN = "iqn.2009-01.com.example:target1"
+SCSIID = "36001405e4b4e1fbd4b54e3e8a2a2e7b1"
+
+NODE_RECORD = """# BEGIN RECORD 6.2.0.873-30
+node.name = iqn.2009-01.com.example:target1
+node.session.cmds_max = 1024
+node.session.queue_depth = 128
+node.session.nr_sessions = 1
+node.session.iscsi.FirstBurstLength = 262144
+node.conn[0].iscsi.MaxRecvDataSegmentLength = 262144
+# END RECORD
+"""
+
+
+def uri(query=""):
+    return urlparse.urlparse(
+        "iscsi://10.0.0.1/%s/%s%s" % (IQN, SCSIID, query))
+
+
+@mock.patch('xapi.storage.libs.libiscsi.log')
+class TuningTest(unittest.TestCase):
+
+    def test_decompose_default_profile(self, log):
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        self.assertEquals(libiscsi.DEFAULT_TUNING_PROFILE,
+                          keys['tuning_profile'])
+
+    def test_decompose_profile(self, log):
+        keys = libiscsi.decomposeISCSIuri(
+            "test", uri("?tuning_profile=dense"))
+
+        self.assertEquals("dense", keys['tuning_profile'])
+        self.assertEquals(SCSIID, keys['scsiid'])
+
+    def test_decompose_unknown_profile(self, log):
+        self.assertRaises(xapi.storage.api.volume.SR_does_not_exist,
+                          libiscsi.decomposeISCSIuri,
+                          "test", uri("?tuning_profile=fast"))
+
+    def test_profiles_only_use_reported_keys(self, log):
+        for profile in libiscsi.TUNING_PROFILES.values():
+            for name in profile['session']:
+                self.assertIn(name, libiscsi.TUNING_SESSION_KEYS)
+            for name in profile['queue']:
+                self.assertIn(name, libiscsi.TUNING_QUEUE_KEYS)
+
+    @mock.patch('xapi.storage.libs.libiscsi.call')
+    def test_apply_session_tuning(self, call, log):
+        libiscsi.applySessionTuning("test", "10.0.0.1:3260", IQN, "dense")
+
+        session = libiscsi.TUNING_PROFILES['dense']['session']
+        self.assertEquals(len(session), call.call_count)
+        call.assert_any_call(
+            "test",
+            ["/usr/sbin/iscsiadm", "-m", "node", "-T", IQN,
+             "--portal", "10.0.0.1:3260", "--op", "update",
+             "-n", "node.session.queue_depth", "-v", "128"])
+
+    @mock.patch('xapi.storage.libs.libiscsi.call')
+    def test_apply_session_tuning_default(self, call, log):
+        libiscsi.applySessionTuning("test", "10.0.0.1:3260", IQN, "default")
+
+        call.assert_not_called()
+
+    @mock.patch('os.path.realpath', return_value="/dev/sdb")
+    def test_apply_queue_tuning(self, realpath, log):
+        with mock.patch('__builtin__.open', mock.mock_open()) as m:
+            libiscsi.applyQueueTuning("test", "/dev/disk/by-id/scsi-1",
+                                      "throughput")
+
+        m.assert_any_call("/sys/block/sdb/queue/read_ahead_kb", "w")
+        m.assert_any_call("/sys/block/sdb/queue/nr_requests", "w")
+        m.assert_any_call("/sys/block/sdb/queue/max_sectors_kb", "w")
+        m().write.assert_any_call("4096\n")
+
+    @mock.patch('os.path.realpath', return_value="/dev/sdb")
+    def test_apply_queue_tuning_rejected_value(self, realpath, log):
+        with mock.patch('__builtin__.open', side_effect=IOError(22, "")):
+            # e.g. max_sectors_kb above the hardware limit
+            libiscsi.applyQueueTuning("test", "/dev/sdb", "dense")
+
+    @mock.patch('xapi.storage.libs.libiscsi._read_sysfs', return_value="64")
+    @mock.patch('xapi.storage.libs.libiscsi.multipath')
+    @mock.patch('xapi.storage.libs.libiscsi.call')
+    @mock.patch('os.path.realpath', return_value="/dev/sdb")
+    def test_get_tuning(self, realpath, call, multipath, read_sysfs, log):
+        call.return_value = NODE_RECORD
+        multipath.find.return_value = None
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+        keys['portals'] = ["10.0.0.1:3260"]
+
+        tuning = libiscsi.getTuning("test", keys)
+
+        self.assertEquals("default", tuning['profile'])
+        self.assertEquals(
+            {'node.session.cmds_max': '1024',
+             'node.session.queue_depth': '128',
+             'node.session.iscsi.FirstBurstLength': '262144',
+             'node.conn[0].iscsi.MaxRecvDataSegmentLength': '262144'},
+            tuning['sessions']["10.0.0.1:3260"])
+        self.assertEquals(["sdb"], tuning['queues'].keys())
+        self.assertEquals("64", tuning['queues']['sdb']['queue_depth'])
+
+    @mock.patch('xapi.storage.libs.libiscsi.xapi.storage.libs.poolhelper')
+    def test_get_pool_tuning_profile(self, poolhelper, log):
+        poolhelper.with_session.return_value = "dense"
+        self.assertEquals(
+            "dense", libiscsi.getPoolTuningProfile("test", SCSIID))
+
+        poolhelper.with_session.return_value = "fast"
+        self.assertIsNone(libiscsi.getPoolTuningProfile("test", SCSIID))
+
+        poolhelper.with_session.side_effect = Exception("xapi is down")
+        self.assertIsNone(libiscsi.getPoolTuningProfile("test", SCSIID))
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = iscsisessions.ISCSISessionStore(":memory:")
+        # login() and logout() close the store they opened
+        self.store.close = mock.MagicMock()
+        refdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, refdir)
+        patch = mock.patch('xapi.storage.libs.libiscsi.ISCSI_REFDIR', refdir)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.store._conn.close()
+
+    def assert_outside_transaction(self, *args):
+        # Fails if the store's write lock is held
+        try:
+            self.store._conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as exc:
+            self.fail("iscsiadm run inside a transaction: %s" % exc)
+        self.store._conn.execute("COMMIT")
+
+
+@mock.patch('xapi.storage.libs.libiscsi.waitForDevice')
+@mock.patch('xapi.storage.libs.libiscsi.applySessionTuning')
+@mock.patch('xapi.storage.libs.libiscsi.getPortals')
+@mock.patch('xapi.storage.libs.libiscsi.iscsisessions.find_live_session')
+@mock.patch('xapi.storage.libs.libiscsi.call')
+@mock.patch('xapi.storage.libs.libiscsi.openSessionStore')
+@mock.patch('xapi.storage.libs.libiscsi.log')
+class LoginTest(StoreTestCase):
+
+    def test_login_outside_transaction(self, log, openSessionStore, call,
+                                       find_live_session, getPortals,
+                                       applySessionTuning, waitForDevice):
+        openSessionStore.return_value = self.store
+        getPortals.return_value = ["10.0.0.1:3260", "10.0.1.1:3260"]
+        sessions = {}
+
+        def iscsiadm(dbg, cmd):
+            self.assert_outside_transaction()
+            sessions[cmd[cmd.index("--portal") + 1]] = len(sessions) + 1
+        call.side_effect = iscsiadm
+        find_live_session.side_effect = lambda iqn, portal: \
+            sessions.get(portal)
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        libiscsi.login("test", uri().geturl(), keys)
+
+        self.assertEquals(2, call.call_count)
+        self.assertEquals(1, self.store.get_session_id(IQN, "10.0.0.1:3260"))
+        self.assertEquals(2, self.store.get_session_id(IQN, "10.0.1.1:3260"))
+        self.assertEquals([uri().geturl()], self.store.get_refs(IQN))
+
+
+@mock.patch('xapi.storage.libs.libiscsi._import_legacy_refs')
+@mock.patch('xapi.storage.libs.libiscsi.multipath')
+@mock.patch('xapi.storage.libs.libiscsi.call')
+@mock.patch('xapi.storage.libs.libiscsi.openSessionStore')
+@mock.patch('xapi.storage.libs.libiscsi.log')
+class LogoutTest(StoreTestCase):
+
+    def add_refs(self, *refs):
+        with self.store.write_context():
+            for ref in refs:
+                self.store.add_ref(IQN, ref)
+
+    def test_logout_keeps_map_in_use(self, log, openSessionStore, call,
+                                     multipath, legacy):
+        openSessionStore.return_value = self.store
+        sr1 = uri().geturl()
+        sr2 = uri("?tuning_profile=dense").geturl()
+        self.add_refs(sr1, sr2)
+
+        libiscsi.logout("test", sr1, IQN, SCSIID)
+
+        # The same LUN is still attached through another URI
+        multipath.find.return_value.destroy.assert_not_called()
+        call.assert_not_called()
+
+    def test_logout_last_ref_to_lun(self, log, openSessionStore, call,
+                                    multipath, legacy):
+        openSessionStore.return_value = self.store
+        sr1 = uri().geturl()
+        other_lun = "iscsi://10.0.0.1/%s/36001405other" % IQN
+        self.add_refs(sr1, other_lun, "probe-uuid")
+
+        libiscsi.logout("test", sr1, IQN, SCSIID)
+
+        multipath.find.assert_called_with("test", SCSIID)
+        multipath.find.return_value.destroy.assert_called_once_with("test")
+        # Other refs keep the sessions up
+        call.assert_not_called()
+
+    def test_logout_last_ref(self, log, openSessionStore, call,
+                             multipath, legacy):
+        openSessionStore.return_value = self.store
+        sr1 = uri().geturl()
+        self.add_refs(sr1)
+
+        call.side_effect = self.assert_outside_transaction
+        multipath.find.return_value.destroy.side_effect = \
+            self.assert_outside_transaction
+
+        libiscsi.logout("test", sr1, IQN, SCSIID)
+
+        multipath.find.return_value.destroy.assert_called_once_with("test")
+        call.assert_called_once_with(
+            "test", ["/usr/sbin/iscsiadm", "-m", "node", "-T", IQN, "-u"])
+        self.assertEquals(0, self.store.get_refcount(IQN))
+
+
+@mock.patch('xapi.storage.libs.libiscsi.log')
+class PathsTest(unittest.TestCase):
+
+    @mock.patch('xapi.storage.libs.libiscsi.discoverIQN')
+    def test_get_portals(self, discoverIQN, log):
+        discoverIQN.return_value = [
+            ("10.0.0.1:3260", "1", IQN),
+            ("10.0.0.1:3260", "1", "iqn.2009-01.com.example:target2"),
+            ("10.0.1.1:3260", "2", IQN),
+            # Reported again for another interface
+            ("10.0.0.1:3260", "1", IQN)
+        ]
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        self.assertEquals(["10.0.0.1:3260", "10.0.1.1:3260"],
+                          libiscsi.getPortals("test", keys))
+
+    @mock.patch('xapi.storage.libs.libiscsi.discoverIQN')
+    def test_get_portals_iqn_not_reported(self, discoverIQN, log):
+        discoverIQN.return_value = [
+            ("10.0.0.1:3260", "1", "iqn.2009-01.com.example:target2"),
+            ("10.0.1.1:3260", "2", "iqn.2009-01.com.example:target2")
+        ]
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        self.assertEquals(["10.0.0.1:3260"],
+                          libiscsi.getPortals("test", keys))
+
+    @mock.patch('xapi.storage.libs.libiscsi.devwait')
+    @mock.patch('os.path.realpath')
+    def test_get_lun_path_devices(self, realpath, devwait, log):
+        by_path = libiscsi.BY_PATH_ROOT + "ip-%s-iscsi-" + IQN + "-lun-2"
+        realpath.side_effect = {
+            libiscsi.DEV_PATH_ROOT + SCSIID: "/dev/sdb",
+            "/sys/block/sdb/device":
+                "/sys/devices/platform/host3/session1/target3:0:0/3:0:0:2",
+            by_path % "10.0.0.1:3260": "/dev/sdb",
+            by_path % "10.0.1.1:3260": "/dev/sdc"
+        }.get
+        devwait.wait_for_paths.return_value = set()
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+        keys['portals'] = ["10.0.0.1:3260", "10.0.1.1:3260"]
+
+        self.assertEquals(["/dev/sdb", "/dev/sdc"],
+                          libiscsi.getLUNPathDevices("test", keys))
+        devwait.wait_for_paths.assert_called_once_with(
+            "test", [by_path % "10.0.0.1:3260", by_path % "10.0.1.1:3260"],
+            libiscsi.DEVICE_WAIT_TIMEOUT)
+
+    @mock.patch('xapi.storage.libs.libiscsi.devwait')
+    @mock.patch('os.path.realpath')
+    def test_get_lun_path_devices_missing_path(self, realpath, devwait, log):
+        by_path = libiscsi.BY_PATH_ROOT + "ip-%s-iscsi-" + IQN + "-lun-0"
+        realpath.side_effect = {
+            libiscsi.DEV_PATH_ROOT + SCSIID: "/dev/sdb",
+            "/sys/block/sdb/device":
+                "/sys/devices/platform/host3/session1/target3:0:0/3:0:0:0",
+            by_path % "10.0.0.1:3260": "/dev/sdb"
+        }.get
+        devwait.wait_for_paths.return_value = set([by_path % "10.0.1.1:3260"])
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+        keys['portals'] = ["10.0.0.1:3260", "10.0.1.1:3260"]
+
+        self.assertEquals(["/dev/sdb"],
+                          libiscsi.getLUNPathDevices("test", keys))
+
+    @mock.patch('os.listdir', return_value=["sdc", "sdb"])
+    @mock.patch('os.path.realpath', return_value="/dev/dm-3")
+    def test_get_lun_path_devices_multipathd(self, realpath, listdir, log):
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        self.assertEquals(["/dev/sdb", "/dev/sdc"],
+                          libiscsi.getLUNPathDevices("test", keys))
+        listdir.assert_called_once_with("/sys/block/dm-3/slaves")
+
+    @mock.patch('xapi.storage.libs.libiscsi.devwait')
+    def test_wait_for_device(self, devwait, log):
+        devwait.wait_for_paths.return_value = set()
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        libiscsi.waitForDevice("test", keys)
+        devwait.wait_for_paths.assert_called_once_with(
+            "test", [libiscsi.DEV_PATH_ROOT + SCSIID],
+            libiscsi.DEVICE_WAIT_TIMEOUT)
+
+    @mock.patch('xapi.storage.libs.libiscsi.devwait')
+    def test_wait_for_device_missing(self, devwait, log):
+        devwait.wait_for_paths.return_value = set(
+            [libiscsi.DEV_PATH_ROOT + SCSIID])
+        keys = libiscsi.decomposeISCSIuri("test", uri())
+
+        with self.assertRaises(xapi.storage.api.volume.Unimplemented) as cm:
+            libiscsi.waitForDevice("test", keys)
+        self.assertIn(SCSIID, str(cm.exception))
@@ -324,7 +324,7 @@ class VHDCoalesceTest(unittest.TestCase):
         # Node wasn't active so no need to refresh the datapath
         mockPoolHelper.suspend_datapath_on_host.assert_not_called()
         mockPoolHelper.resume_datapath_on_host.assert_not_called()
-        mockPoolHelper.refresh_datapath_on_host.assert_not_called()
+        mockPoolHelper.refresh_datapaths_on_host.assert_not_called()
 
     @mock.patch('xapi.storage.libs.libvhd.coalesce.VHDMetabase')
     @mock.patch('xapi.storage.libs.libvhd.coalesce.VHDUtil.set_parent')
@@ -421,7 +421,7 @@ class VHDCoalesceTest(unittest.TestCase):
         # Node was active so need to refresh the datapath on the correct host
         mockPoolHelper.suspend_datapath_on_host.assert_not_called()
         mockPoolHelper.resume_datapath_on_host.assert_not_called()
-        mockPoolHelper.refresh_datapath_on_host.assert_called_with("GC", "Host1", mock.ANY, mock.ANY)
+        mockPoolHelper.refresh_datapaths_on_host.assert_called_with("GC", "Host1", mock.ANY)
 
     # Tests for garbage clean up
 
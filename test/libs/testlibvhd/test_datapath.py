@@ -1,8 +1,16 @@
+import mock
 import unittest
+from contextlib import contextmanager
 
+from xapi.storage.libs.libvhd.metabase import VHD, VDI
 from xapi.storage.libs.libvhd import datapath
 
 
+@contextmanager
+def test_context():
+    yield
+
+
 class TestVHDDatapath(unittest.TestCase):
 
     def test__parse_uri(self):
@@ -12,3 +20,51 @@ class TestVHDDatapath(unittest.TestCase):
 
         self.assertEquals(("vhd:////TestScsiId", "GfsTest"), parsed_uri)
 
+    def activate(self, callbacks, mockDatabase, mockTapdisk):
+        mockDB = mock.MagicMock()
+        mockDatabase.return_value = mockDB
+        mockDB.write_context.side_effect = test_context
+        mockDB.get_vdi_by_id.return_value = VDI(
+            "1", "Test", "Test Desc", None, 0, VHD(3, 2, 0, 10*1024, 10*1024))
+        callbacks.volumeGetPath.side_effect = \
+            lambda opq, name: "/sr/" + name
+
+        datapath.VHDDatapath.activate(
+            "test", "vhd+tapdisk://gfs2/TestScsiId|1", 0, callbacks)
+
+        return mockTapdisk.load_tapdisk_metadata.return_value
+
+    @mock.patch('xapi.storage.libs.libvhd.datapath.readcache')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.tapdisk')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.image')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.Lock')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.VHDMetabase')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.util')
+    def test_activate_read_caching(self, util, mockDatabase, lock, image,
+                                   mockTapdisk, readcache):
+        callbacks = mock.MagicMock()
+        callbacks.volumeReadCaching.return_value = True
+
+        tap = self.activate(callbacks, mockDatabase, mockTapdisk)
+
+        readcache.acquire.assert_called_once_with("test", "/sr/3", "/sr/2")
+        tap.open.assert_called_once_with(
+            "test", mock.ANY, existing_parent=readcache.acquire.return_value)
+
+    @mock.patch('xapi.storage.libs.libvhd.datapath.readcache')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.tapdisk')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.image')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.Lock')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.VHDMetabase')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.util')
+    def test_activate_without_read_caching_callback(
+            self, util, mockDatabase, lock, image, mockTapdisk, readcache):
+        callbacks = mock.MagicMock()
+        # e.g. the lvm2 callbacks
+        del callbacks.volumeReadCaching
+
+        tap = self.activate(callbacks, mockDatabase, mockTapdisk)
+
+        readcache.acquire.assert_not_called()
+        tap.open.assert_called_once_with(
+            "test", mock.ANY, existing_parent=None)
@@ -338,3 +338,43 @@ class VHDMetabaseTest(unittest.TestCase):
 
         refresh_entries = self.subject.get_refresh_entries()
         self.assertEquals(0, len(refresh_entries))
+
+    def test_claim_pooled_vhd_success(self):
+        with self.subject.write_context():
+            small = self.subject.insert_pooled_vhd(10*1024)
+            large = self.subject.insert_pooled_vhd(20*1024)
+            self.subject.insert_pooled_vhd(30*1024)
+
+        self.assertEquals(3, self.subject.count_pooled_vhds())
+
+        with self.subject.write_context():
+            vhd = self.subject.claim_pooled_vhd(25*1024, "claim-1")
+
+        self.assertEquals(large.id, vhd.id)
+        self.assertEquals(2, self.subject.count_pooled_vhds())
+
+        with self.subject.write_context():
+            vhd = self.subject.claim_pooled_vhd(25*1024, "claim-2")
+
+        self.assertEquals(small.id, vhd.id)
+        self.assertEquals(1, self.subject.count_pooled_vhds())
+
+    def test_claim_pooled_vhd_none_small_enough(self):
+        with self.subject.write_context():
+            self.subject.insert_pooled_vhd(20*1024)
+            vhd = self.subject.claim_pooled_vhd(10*1024, "claim-1")
+
+        self.assertIsNone(vhd)
+        self.assertEquals(1, self.subject.count_pooled_vhds())
+
+    def test_pooled_vhd_is_not_garbage(self):
+        with self.subject.write_context():
+            self.subject.insert_pooled_vhd(10*1024)
+
+        self.assertEquals(0, len(self.subject.get_garbage_vhds()))
+
+        with self.subject.write_context():
+            self.subject.claim_pooled_vhd(10*1024, "claim-1")
+
+        # Claimed without a VDI being created for it
+        self.assertEquals(1, len(self.subject.get_garbage_vhds()))
@@ -0,0 +1,66 @@
+import os
+import mock
+import shutil
+import tempfile
+import unittest
+
+from xapi.storage.libs import tapdiskregistry
+from xapi.storage.libs.libvhd import readcache
+
+
+class ReadCacheTest(unittest.TestCase):
+
+    BLOCK = 64 * 1024
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.registry = tapdiskregistry.TapdiskRegistry(":memory:")
+
+    def tearDown(self):
+        self.registry.close()
+        shutil.rmtree(self.cache_dir)
+
+    def add_cache(self, parent, last_used, user=None):
+        cache = readcache.cache_path(self.cache_dir, parent)
+        with open(cache, "w") as f:
+            f.write("x" * self.BLOCK)
+        with self.registry.write_context():
+            self.registry.put_read_cache(parent, cache, "id", last_used)
+            if user is not None:
+                self.registry.add_read_cache_user(user, parent)
+        return cache
+
+    @mock.patch('xapi.storage.libs.libvhd.readcache.tapdisk')
+    @mock.patch('xapi.storage.libs.libvhd.readcache.log')
+    def test_evict_least_recently_used_idle_caches(self, mock_log,
+                                                   mock_tapdisk):
+        mock_tapdisk.find_by_files.return_value = {}
+        oldest = self.add_cache("/sr/1/1", 10.0)
+        in_use = self.add_cache("/sr/2/2", 5.0, user="/sr/20/20")
+        newest = self.add_cache("/sr/3/3", 30.0)
+        orphan = os.path.join(self.cache_dir, "old" + readcache.CACHE_SUFFIX)
+        open(orphan, "w").close()
+        usage = readcache._disk_usage(oldest)
+
+        remaining = readcache._evict("test", self.registry, self.cache_dir,
+                                     2 * usage)
+
+        self.assertEquals(2 * usage, remaining)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(in_use))
+        self.assertTrue(os.path.exists(newest))
+        self.assertEquals(
+            ["/sr/2/2", "/sr/3/3"],
+            [row['parent'] for row in self.registry.get_read_caches()])
+
+    @mock.patch('xapi.storage.libs.libvhd.readcache.tapdisk')
+    @mock.patch('xapi.storage.libs.libvhd.readcache.log')
+    def test_evict_keeps_caches_in_use(self, mock_log, mock_tapdisk):
+        mock_tapdisk.find_by_files.return_value = {}
+        in_use = self.add_cache("/sr/1/1", 10.0, user="/sr/10/10")
+
+        remaining = readcache._evict("test", self.registry, self.cache_dir, 0)
+
+        self.assertEquals(readcache._disk_usage(in_use), remaining)
+        self.assertTrue(os.path.exists(in_use))
@@ -0,0 +1,39 @@
+import mock
+import struct
+import tempfile
+import unittest
+
+from xapi.storage.libs.libvhd.vhdutil import VHDUtil
+
+
+def make_vhd(bat):
+    """Return a temporary file laid out like a dynamic VHD with the BAT
+       [bat], a list of block sector offsets or None"""
+    f = tempfile.NamedTemporaryFile()
+    footer = 'conectix' + '\0' * 8 + struct.pack('>Q', 512)
+    f.write(footer.ljust(512, '\0'))
+    header = 'cxsparse' + '\0' * 8 + struct.pack('>Q', 1536) + \
+        '\0' * 4 + struct.pack('>I', len(bat))
+    f.write(header.ljust(1024, '\0'))
+    for entry in bat:
+        f.write(struct.pack('>I', 0xFFFFFFFF if entry is None else entry))
+    f.flush()
+    return f
+
+
+@mock.patch('xapi.storage.libs.libvhd.vhdutil.log')
+class TestVHDUtilIsEmpty(unittest.TestCase):
+
+    def test_is_empty_no_blocks(self, log):
+        with make_vhd([None, None, None]) as f:
+            self.assertTrue(VHDUtil.is_empty("test", f.name))
+
+    def test_is_empty_allocated_block(self, log):
+        with make_vhd([None, 4096, None]) as f:
+            self.assertFalse(VHDUtil.is_empty("test", f.name))
+
+    def test_is_empty_not_a_vhd(self, log):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write('\0' * 2048)
+            f.flush()
+            self.assertRaises(Exception, VHDUtil.is_empty, "test", f.name)
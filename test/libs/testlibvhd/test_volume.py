@@ -58,7 +58,7 @@ class TestVHDVolume(unittest.TestCase):
                 )
             ]
 
-        mockVHDUtil.is_parent_pointing_to_path.return_value = True
+        mockVHDUtil.is_empty.return_value = False
 
         clone = volume.VHDVolume.clone("test", "test-sr", "test-vhd", callbacks)
         
@@ -114,7 +114,7 @@ class TestVHDVolume(unittest.TestCase):
                 )
             ]
 
-        mockVHDUtil.is_parent_pointing_to_path.return_value = True
+        mockVHDUtil.is_empty.return_value = False
 
         clone = volume.VHDVolume.clone("test", "test-sr", "test-vhd", callbacks)
         
@@ -163,7 +163,7 @@ class TestVHDVolume(unittest.TestCase):
                 )
             ]
 
-        mockVHDUtil.is_parent_pointing_to_path.return_value = False
+        mockVHDUtil.is_empty.return_value = True
 
         clone = volume.VHDVolume.clone("test", "test-sr", "test-vhd", callbacks)
         
@@ -173,3 +173,129 @@ class TestVHDVolume(unittest.TestCase):
 
         callbacks.volumeStartOperations.assert_called()
         callbacks.volumeStopOperations.assert_called()
+
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDMetabase')
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDUtil')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.poolhelper')
+    def test_clone_many_refresh_datapath_once(self, poolhelper, mockVHDUtil, mockDatabase):
+        callbacks = mock.MagicMock()
+
+        mockDB = mock.MagicMock()
+
+        mockDatabase.return_value = mockDB
+
+        mockDB.write_context.side_effect = test_context
+
+        mockDB.get_vdi_by_id.return_value = VDI(
+            "1",
+            "Test",
+            "Test Desc",
+            "Host1",
+            0,
+            VHD(
+                2,
+                1,
+                0,
+                10*1024,
+                10*1024
+                )
+            )
+
+        mockDB.insert_child_vhd.side_effect = [
+            VHD(id, 2, 0, 10*1024, 10*1024) for id in range(3, 7)
+            ]
+
+        mockVHDUtil.is_empty.return_value = False
+
+        clones = volume.VHDVolume.clone_many(
+            "test", "test-sr", "test-vhd", 3, callbacks)
+
+        self.assertEquals(3, len(clones))
+        poolhelper.refresh_datapath_on_host.assert_called_once()
+        # One snapshot for the new leaf of the VDI, one per clone
+        self.assertEquals(4, mockVHDUtil.snapshot.call_count)
+        mockVHDUtil.is_empty.assert_called_once()
+        self.assertEquals(3, mockDB.insert_vdi.call_count)
+
+        callbacks.volumeStartOperations.assert_called()
+        callbacks.volumeStopOperations.assert_called()
+
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDMetabase')
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDUtil')
+    @mock.patch('xapi.storage.libs.libvhd.datapath.poolhelper')
+    def test_clone_many_empty_success(self, poolhelper, mockVHDUtil, mockDatabase):
+        callbacks = mock.MagicMock()
+
+        mockDB = mock.MagicMock()
+
+        mockDatabase.return_value = mockDB
+
+        mockDB.write_context.side_effect = test_context
+
+        mockDB.get_vdi_by_id.return_value = VDI(
+            "1",
+            "Test",
+            "Test Desc",
+            "Host1",
+            0,
+            VHD(
+                2,
+                1,
+                0,
+                10*1024,
+                10*1024
+                )
+            )
+
+        mockDB.insert_child_vhd.side_effect = [
+            VHD(id, 1, 0, 10*1024, 10*1024) for id in range(3, 6)
+            ]
+
+        mockVHDUtil.is_empty.return_value = True
+
+        clones = volume.VHDVolume.clone_many(
+            "test", "test-sr", "test-vhd", 3, callbacks)
+
+        self.assertEquals(3, len(clones))
+        poolhelper.refresh_datapath_on_host.assert_not_called()
+        self.assertEquals(3, mockVHDUtil.snapshot.call_count)
+        mockDB.update_vdi_vhd_id.assert_not_called()
+        self.assertEquals(3, mockDB.insert_vdi.call_count)
+
+        callbacks.volumeStartOperations.assert_called()
+        callbacks.volumeStopOperations.assert_called()
+
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDMetabase')
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDUtil')
+    def test_create_preallocates(self, mockVHDUtil, mockDatabase):
+        callbacks = mock.MagicMock()
+        mockDB = mock.MagicMock()
+        mockDatabase.return_value = mockDB
+        mockDB.write_context.side_effect = test_context
+        mockDB.claim_pooled_vhd.return_value = None
+        mockDB.insert_new_vhd.return_value = VHD(3, None, 0, 0, 0)
+
+        volume.VHDVolume.create(
+            "test", "test-sr", "Test", "Test Desc", 10*1024, callbacks)
+
+        callbacks.volumePreallocate.assert_called_once_with(
+            mock.ANY, "3", 1024*1024)
+
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDMetabase')
+    @mock.patch('xapi.storage.libs.libvhd.volume.VHDUtil')
+    def test_create_without_preallocate(self, mockVHDUtil, mockDatabase):
+        callbacks = mock.MagicMock()
+        # e.g. the lvm2 callbacks
+        del callbacks.volumePreallocate
+        mockDB = mock.MagicMock()
+        mockDatabase.return_value = mockDB
+        mockDB.write_context.side_effect = test_context
+        mockDB.claim_pooled_vhd.return_value = None
+        mockDB.insert_new_vhd.return_value = VHD(3, None, 0, 0, 0)
+
+        vol = volume.VHDVolume.create(
+            "test", "test-sr", "Test", "Test Desc", 10*1024, callbacks)
+
+        self.assertEquals(1024*1024, vol['virtual_size'])
+        callbacks.volumeCreate.assert_called_once_with(
+            mock.ANY, "3", 1024*1024)
@@ -74,9 +74,15 @@ fi
     for volume in $VOLUMEDIRS; do
         LEAF=$(basename $volume)
         # if test folder exists
-        if [ -d "$DATAPATHTESTROOT/$LEAF" ]; then
-            # run nosetest for this volume folder
+        if [ -d "$VOLUMETESTROOT/$LEAF" ]; then
+            # run nosetest for this volume folder, which imports the
+            # plugin's modules directly
             echo "Found test folder for $LEAF"
+            PYTHONPATH=$MOCKSDIR:$volume \
+            coverage run -a --branch $(which nosetests) \
+                --with-xunit                \
+                --xunit-file=nosetests-$LEAF.xml  \
+                "$VOLUMETESTROOT/$LEAF"
         fi
     done
 
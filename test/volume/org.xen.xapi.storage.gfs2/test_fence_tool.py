@@ -0,0 +1,274 @@
+import os
+import errno
+import fcntl
+import mock
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+import fence_tool
+
+NODE_ID = 3
+
+
+class StopDaemon(Exception):
+    pass
+
+
+class FenceToolTestCase(unittest.TestCase):
+
+    """Gives each SR a temp file as its sbd device"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patches = [
+            mock.patch('fence_tool.SBD_DEVICE',
+                       os.path.join(self.dir, "%s.sbd")),
+            mock.patch('fence_tool.SBD_OPEN_FILE',
+                       os.path.join(self.dir, "%s.sbd-open")),
+            mock.patch('fence_tool.log')
+        ]
+        if not self.o_direct_supported():
+            # e.g. on tmpfs
+            patches.append(mock.patch('os.O_DIRECT', 0))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def o_direct_supported(self):
+        path = os.path.join(self.dir, "o_direct")
+        open(path, "w").close()
+        try:
+            os.close(os.open(path, os.O_RDONLY | os.O_DIRECT))
+            return True
+        except OSError as exc:
+            if exc.errno != errno.EINVAL:
+                raise
+            return False
+        finally:
+            os.unlink(path)
+
+    def make_sbd(self, key):
+        with open(fence_tool.SBD_DEVICE % key, "w") as f:
+            f.write("\0" * fence_tool.BLK_SIZE * 2 * (NODE_ID + 1))
+
+    def slot(self, key, node_id=NODE_ID, ack=False):
+        offset = fence_tool.BLK_SIZE * (2 * node_id + (1 if ack else 0))
+        with open(fence_tool.SBD_DEVICE % key) as f:
+            f.seek(offset)
+            return f.read(1)
+
+    def write_slot(self, key, msg, node_id=NODE_ID, ack=False):
+        offset = fence_tool.BLK_SIZE * (2 * node_id + (1 if ack else 0))
+        with open(fence_tool.SBD_DEVICE % key, "r+") as f:
+            f.seek(offset)
+            f.write(msg)
+
+    def is_open(self, key):
+        # The daemon holds a shared lock while it has the sbd open
+        with open(fence_tool.SBD_OPEN_FILE % key, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return False
+            except IOError:
+                return True
+
+
+class SbdDeviceTest(FenceToolTestCase):
+
+    def test_read_fence_write_ack(self):
+        self.make_sbd("sr1")
+        device = fence_tool.SbdDevice("sr1", NODE_ID)
+        try:
+            self.assertEquals(fence_tool.MSG_OK, device.read())
+
+            self.write_slot("sr1", fence_tool.MSG_FENCE)
+            self.assertEquals(fence_tool.MSG_FENCE, device.read())
+            self.assertFalse(device.acked())
+
+            device.write_ack()
+            self.assertEquals(fence_tool.MSG_FENCE_ACK,
+                              self.slot("sr1", ack=True))
+            device.read()
+            self.assertTrue(device.acked())
+            # Other nodes' slots are left alone
+            self.assertEquals("\0", self.slot("sr1", NODE_ID - 1, ack=True))
+        finally:
+            device.close()
+        self.assertFalse(self.is_open("sr1"))
+
+
+@mock.patch('fence_tool.demonize')
+@mock.patch('fence_tool.read_members')
+@mock.patch.object(fence_tool.fcntl, 'ioctl')
+class DaemonTest(FenceToolTestCase):
+
+    def setUp(self):
+        FenceToolTestCase.setUp(self)
+        self.watchdog = os.path.join(self.dir, "watchdog")
+        open(self.watchdog, "w").close()
+        patches = [
+            mock.patch('fence_tool.WATCHDOG_DEVICE', self.watchdog),
+            mock.patch('fence_tool.DAEMON_PID_FILE',
+                       os.path.join(self.dir, "daemon.pid"))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        for sig in [signal.SIGHUP, signal.SIGUSR1]:
+            self.addCleanup(signal.signal, sig, signal.getsignal(sig))
+
+    def run_daemon(self, heartbeats):
+        """Run the daemon, calling heartbeats[i]() in place of the i-th
+           sleep, until they run out"""
+        heartbeats = list(heartbeats)
+
+        def sleep(seconds):
+            if not heartbeats:
+                raise StopDaemon()
+            heartbeats.pop(0)()
+
+        with mock.patch('time.sleep', side_effect=sleep):
+            self.assertRaises(StopDaemon, fence_tool.dlm_fence_daemon,
+                              str(NODE_ID))
+
+    def test_fence_acked(self, ioctl, read_members, demonize):
+        read_members.return_value = ["sr1"]
+        self.make_sbd("sr1")
+        self.write_slot("sr1", fence_tool.MSG_FENCE)
+
+        self.run_daemon([])
+
+        self.assertEquals(fence_tool.MSG_FENCE_ACK,
+                          self.slot("sr1", ack=True))
+        # Watchdog timeout cut to a second, then kicked
+        self.assertEquals(1, ioctl.call_count)
+        with open(self.watchdog) as f:
+            self.assertEquals("w", f.read())
+        with open(fence_tool.DAEMON_PID_FILE) as f:
+            self.assertEquals(str(os.getpid()), f.read())
+
+    def test_new_member_after_sighup(self, ioctl, read_members, demonize):
+        read_members.side_effect = [["sr1"], ["sr1", "sr2"]]
+        self.make_sbd("sr1")
+        self.make_sbd("sr2")
+
+        def add_sr2():
+            self.write_slot("sr2", fence_tool.MSG_FENCE)
+            os.kill(os.getpid(), signal.SIGHUP)
+
+        opened = []
+        self.run_daemon([lambda: None, add_sr2,
+                         lambda: opened.append(self.is_open("sr2"))])
+
+        self.assertEquals(2, read_members.call_count)
+        self.assertEquals([True], opened)
+        self.assertEquals(fence_tool.MSG_FENCE_ACK,
+                          self.slot("sr2", ack=True))
+        self.assertEquals("\0", self.slot("sr1", ack=True))
+
+    def test_removed_member_closed(self, ioctl, read_members, demonize):
+        read_members.side_effect = [["sr1", "sr2"], ["sr2"]]
+        self.make_sbd("sr1")
+        self.make_sbd("sr2")
+
+        opened = []
+        self.run_daemon([
+            lambda: os.kill(os.getpid(), signal.SIGHUP),
+            lambda: opened.extend([self.is_open("sr1"), self.is_open("sr2")])
+        ])
+
+        self.assertEquals([False, True], opened)
+
+
+class WaitClosedTest(FenceToolTestCase):
+
+    def test_wait_closed(self):
+        self.make_sbd("sr1")
+        device = fence_tool.SbdDevice("sr1", NODE_ID)
+        waiter = threading.Thread(target=fence_tool.dlm_fence_wait_closed,
+                                  args=("sr1",))
+        waiter.start()
+
+        time.sleep(0.3)
+        self.assertTrue(waiter.is_alive())
+
+        device.close()
+        waiter.join(5)
+
+        self.assertFalse(waiter.is_alive())
+        self.assertFalse(
+            os.path.exists(fence_tool.SBD_OPEN_FILE % "sr1"))
+
+    @mock.patch('fence_tool.SBD_CLOSE_TIMEOUT', 0.2)
+    def test_wait_closed_gives_up(self):
+        self.make_sbd("sr1")
+        device = fence_tool.SbdDevice("sr1", NODE_ID)
+        try:
+            fence_tool.dlm_fence_wait_closed("sr1")
+        finally:
+            device.close()
+
+        self.assertTrue(fence_tool.log.error.called)
+
+
+@mock.patch('fence_tool.read_members')
+class FenceNodeTest(FenceToolTestCase):
+
+    def fence_node(self):
+        """Run dlm_fence_node, without its wait for the watchdog, and
+           return how long it took"""
+        start = time.time()
+        with mock.patch('time.sleep'):
+            fence_tool.dlm_fence_node(str(NODE_ID))
+        return time.time() - start
+
+    def assert_fenced(self):
+        self.assertTrue(any(["fenced after" in call[0][0] for call in
+                             fence_tool.log.debug.call_args_list]))
+
+    def test_first_ack_stops_other_srs(self, read_members):
+        read_members.return_value = ["sr1", "sr2", "sr3"]
+        for key in read_members.return_value:
+            self.make_sbd(key)
+        # The node only answers on sr2
+        self.write_slot("sr2", fence_tool.MSG_FENCE_ACK, ack=True)
+
+        elapsed = self.fence_node()
+
+        self.assertLess(elapsed, 5)
+        self.assert_fenced()
+        for key in read_members.return_value:
+            self.assertEquals(fence_tool.MSG_FENCE, self.slot(key))
+            # Every worker has finished with its device
+            self.assertFalse(self.is_open(key))
+
+    @mock.patch('fence_tool.FENCE_ACK_TIMEOUT', 0.3)
+    def test_no_ack_assumes_fenced(self, read_members):
+        read_members.return_value = ["sr1", "sr2"]
+        self.make_sbd("sr1")
+        self.make_sbd("sr2")
+
+        elapsed = self.fence_node()
+
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 0.3 + 2 * fence_tool.FENCE_POLL_SLOW)
+        self.assertTrue(any(["after TIMEOUT" in call[0][0] for call in
+                             fence_tool.log.debug.call_args_list]))
+        self.assertFalse(self.is_open("sr1"))
+
+    def test_unopenable_sbd_does_not_block(self, read_members):
+        read_members.return_value = ["sr1", "sr2"]
+        # sr1's sbd is missing, e.g. its LUN has gone
+        self.make_sbd("sr2")
+        self.write_slot("sr2", fence_tool.MSG_FENCE_ACK, ack=True)
+
+        elapsed = self.fence_node()
+
+        self.assertLess(elapsed, 5)
+        self.assert_fenced()
+        self.assertTrue(fence_tool.log.error.called)
@@ -51,7 +51,7 @@ class Implementation(xapi.storage.api.volume.Volume_skeleton):
         new_name = touch_file_unique(dbg, path, "")
 
         # both cp --reflink and cp may require that the image is quiesced
-        xapi.storage.libs.poolhelper.suspend_datapath_in_pool(dbg, path)
+        xapi.storage.libs.poolhelper.suspend_datapaths_in_pool(dbg, [path])
         try:
             code = subprocess.call(["cp", "--reflink=always", path, new_name])
             if code != 0:
@@ -60,7 +60,7 @@ class Implementation(xapi.storage.api.volume.Volume_skeleton):
                     os.unlink(new_name)
                     raise xapi.storage.api.volume.Unimplemented("Copy failed?")
         finally:
-            xapi.storage.libs.poolhelper.resume_datapath_in_pool(dbg, path)
+            xapi.storage.libs.poolhelper.resume_datapaths_in_pool(dbg, [path])
 
         key = os.path.basename(new_name)
         uuid_ = str(uuid.uuid4())
@@ -313,7 +313,7 @@ class Implementation(xapi.storage.api.volume.Volume_skeleton):
         new_name = touch_file_unique(dbg, path, "")
 
         # both cp --reflink and cp may require that the image is quiesced
-        xapi.storage.libs.poolhelper.suspend_datapath_in_pool(dbg, path)
+        xapi.storage.libs.poolhelper.suspend_datapaths_in_pool(dbg, [path])
         try:
             code = subprocess.call(["cp", "--reflink=always", path, new_name])
             if code != 0:
@@ -322,7 +322,7 @@ class Implementation(xapi.storage.api.volume.Volume_skeleton):
                     os.unlink(new_name)
                     raise xapi.storage.api.volume.Unimplemented("Copy failed?")
         finally:
-            xapi.storage.libs.poolhelper.resume_datapath_in_pool(dbg, path)
+            xapi.storage.libs.poolhelper.resume_datapaths_in_pool(dbg, [path])
 
         key = os.path.basename(new_name)
         uuid_ = str(uuid.uuid4())
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import os
+import io
 import sys
 import time
+import errno
+import threading
 from xapi.storage import log
 from xapi.storage.libs import util
 from xapi.storage.common import call
@@ -21,10 +24,42 @@ MSG_FENCE     = '\x01'
 MSG_FENCE_ACK = '\x02'
 
 WD_TIMEOUT = 60
+WATCHDOG_DEVICE = "/dev/watchdog"
+
+# The sbd volume of the SR with the given SCSI id
+SBD_DEVICE = "/dev/%s/sbd"
 
 DLMREF = "/var/run/sr-ref/dlmref"
 DLMREF_LOCK = "/var/run/sr-ref/dlmref.lock"
 
+# Written by the daemon once it handles SIGHUP, which tells it that the
+# SRs in DLMREF have changed
+DAEMON_PID_FILE = "/var/run/sr-ref/dlm_fence_daemon.pid"
+
+# The daemon holds a shared lock on this file for as long as it has the
+# sbd device of the SR open
+SBD_OPEN_FILE = "/var/run/sr-ref/%s.sbd-open"
+SBD_CLOSE_TIMEOUT = 30
+
+# How often the daemon reads its slots and kicks the watchdog
+HEARTBEAT_INTERVAL = 1
+
+# Reads of the sbd device slower than this are reported: the watchdog
+# fires when a heartbeat takes longer than WD_TIMEOUT
+SLOW_READ_WARNING = 5
+
+# Log the read latencies every this many heartbeats
+LATENCY_REPORT_HEARTBEATS = 300
+
+# dlm_fence_node polls for the ack every FENCE_POLL_FAST seconds for the
+# first FENCE_POLL_FAST_FOR seconds, when a live node answers, then
+# every FENCE_POLL_SLOW seconds until FENCE_ACK_TIMEOUT, after which the
+# node's watchdog must have fired
+FENCE_ACK_TIMEOUT = WD_TIMEOUT + 10
+FENCE_POLL_FAST = 0.1
+FENCE_POLL_FAST_FOR = 5
+FENCE_POLL_SLOW = 1
+
 IOCWD = 0xc0045706
 
 def demonize():
@@ -34,13 +69,6 @@ def demonize():
         except OSError:
             pass
 
-def block_read(bd, offset):
-    f = os.open(bd, os.O_RDONLY)
-    os.lseek(f, offset, os.SEEK_SET)
-    s = os.read(f, BLK_SIZE)
-    os.close(f)
-    return s[0]
-    
 def block_write(bd, offset, msg):
     f = os.open(bd, os.O_RDWR | os.O_DIRECT)
     os.lseek(f, offset, os.SEEK_SET)
@@ -49,10 +77,96 @@ def block_write(bd, offset, msg):
     os.write(f, m)
     os.close(f)
 
+class SbdDevice(object):
+
+    """The slots of node [node_id] on the sbd device of the SR
+       [scsi_id], kept open with O_DIRECT so that every read comes from
+       the LUN rather than the page cache"""
+
+    def __init__(self, scsi_id, node_id):
+        self.scsi_id = scsi_id
+        self.offset = BLK_SIZE * 2 * node_id
+        self.opened = open(SBD_OPEN_FILE % scsi_id, "a")
+        fcntl.flock(self.opened, fcntl.LOCK_SH)
+        try:
+            self.fd = os.open(SBD_DEVICE % scsi_id, os.O_RDWR | os.O_DIRECT)
+        except:
+            self.opened.close()
+            raise
+        self.file = io.FileIO(self.fd, "r+", closefd=False)
+        # Anonymous mmaps are page aligned, as O_DIRECT needs
+        self.slots = mmap.mmap(-1, 2 * BLK_SIZE)
+        self.out = mmap.mmap(-1, BLK_SIZE)
+        self.max_latency = 0
+        self.total_latency = 0
+        self.reads = 0
+
+    def read(self):
+        """Read the node's message and ack slots in a single read and
+           return the message"""
+        start = time.time()
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        self.file.readinto(self.slots)
+        latency = time.time() - start
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        self.reads += 1
+        if latency > SLOW_READ_WARNING:
+            log.error("dlm_fence_daemon: reading the sbd of %s took %.1fs" %
+                      (self.scsi_id, latency))
+        return self.slots[0]
+
+    def acked(self):
+        """Whether the node has acknowledged its fencing, as of the last
+           read()"""
+        return self.slots[BLK_SIZE] == MSG_FENCE_ACK
+
+    def _write(self, offset, msg):
+        self.out[0] = msg
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.file.write(self.out)
+
+    def write_fence(self):
+        self._write(self.offset, MSG_FENCE)
+
+    def write_ack(self):
+        self._write(self.offset + BLK_SIZE, MSG_FENCE_ACK)
+
+    def report_latency(self):
+        if self.reads:
+            log.debug("dlm_fence_daemon: sbd of %s: %d reads, "
+                      "average %.1fms, max %.1fms" %
+                      (self.scsi_id, self.reads,
+                       self.total_latency / self.reads * 1000,
+                       self.max_latency * 1000))
+        self.max_latency = 0
+        self.total_latency = 0
+        self.reads = 0
+
+    def close(self):
+        self.file.close()
+        os.close(self.fd)
+        self.slots.close()
+        self.out.close()
+        # Lets dlm_fence_wait_closed() know we are done
+        self.opened.close()
+
+
+def read_members():
+    f = util.lock_file("SSSS", DLMREF_LOCK, "r+")
+    try:
+        d = shelve.open(DLMREF)
+        klist = d.keys()
+        d.close()
+    finally:
+        util.unlock_file("SSSS", f)
+    return klist
+
+
 def dlm_fence_daemon(node_id):
     n = int(node_id)
     log.debug("Starting dlm_fence_daemon on node_id=%d" % n)
-    wd = os.open("/dev/watchdog", os.O_WRONLY)
+    wd = os.open(WATCHDOG_DEVICE, os.O_WRONLY)
     def dlm_fence_daemon_signal_handler(sig, frame):
         log.debug("dlm_fence_daemon_signal_handler")
         os.write(wd, "V")
@@ -60,14 +174,35 @@ def dlm_fence_daemon(node_id):
         log.debug("dlm_fence_daemon: exiting cleanly")
         exit(0)
     signal.signal(signal.SIGUSR1, dlm_fence_daemon_signal_handler)
+    changed = [True]
+    def dlm_fence_daemon_reload_handler(sig, frame):
+        changed[0] = True
+    signal.signal(signal.SIGHUP, dlm_fence_daemon_reload_handler)
+    # Restart the I/O it interrupts; time.sleep() still returns early
+    signal.siginterrupt(signal.SIGHUP, False)
+    with open(DAEMON_PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
     demonize()
+    devices = {}
+    heartbeats = 0
+    next_heartbeat = time.time()
     while True:
-        f = util.lock_file("SSSS", DLMREF_LOCK, "r+")
-        d = shelve.open(DLMREF)
-        klist = d.keys()
-        for key in klist:
-            bd = "/dev/" + key + "/sbd"
-            ret = block_read(bd, BLK_SIZE * 2 * n)
+        if changed[0]:
+            changed[0] = False
+            members = set(read_members())
+            for key in set(devices) - members:
+                log.debug("dlm_fence_daemon: closing the sbd of %s" % key)
+                devices.pop(key).close()
+        for key in members - set(devices):
+            try:
+                devices[key] = SbdDevice(key, n)
+                log.debug("dlm_fence_daemon: opened the sbd of %s" % key)
+            except (IOError, OSError) as e:
+                # Retried on every heartbeat
+                log.error("dlm_fence_daemon: cannot open the sbd of %s: %s"
+                          % (key, e))
+        for device in devices.values():
+            ret = device.read()
             if ret == MSG_OK:
                 pass
             elif ret == MSG_FENCE:
@@ -76,47 +211,90 @@ def dlm_fence_daemon(node_id):
                 s = struct.pack ("i", 1)
                 fcntl.ioctl(wd, 3221509894 , s)
                 log.debug("dlm_fence_daemon: writing MSG_FENCE_ACK")
-                ret = block_write(bd, BLK_SIZE * ((2 * n) + 1), MSG_FENCE_ACK)
+                device.write_ack()
                 log.debug("dlm_fence_daemon: MSG_FENCE_ACK sent")
                 # host will be fenced in 1 second
-        d.close()
-        util.unlock_file("SSSS", f)
         os.write(wd, "w")
-        time.sleep(1)
+        heartbeats += 1
+        if heartbeats % LATENCY_REPORT_HEARTBEATS == 0:
+            for device in devices.values():
+                device.report_latency()
+        # Keep to the schedule however long the reads took, and do not
+        # try to catch up on heartbeats missed altogether
+        next_heartbeat += HEARTBEAT_INTERVAL
+        now = time.time()
+        if next_heartbeat < now:
+            log.error("dlm_fence_daemon: heartbeat late by %.1fs" %
+                      (now - next_heartbeat))
+            next_heartbeat = now
+        else:
+            # Returns early on SIGHUP
+            time.sleep(next_heartbeat - now)
+
+def _fence_on_sr(n, key, acked, deadline):
+    """Ask node [n] to fence itself through the sbd of the SR [key] and
+       set [acked] once it acknowledges"""
+    device = SbdDevice(key, n)
+    try:
+        device.write_fence()
+        start = time.time()
+        while not acked.is_set():
+            device.read()
+            if device.acked():
+                log.debug("dlm_fence_node got MSG_FENCE_ACK for node_id=%d "
+                          "on %s" % (n, key))
+                acked.set()
+                break
+            now = time.time()
+            if now >= deadline:
+                break
+            if now - start < FENCE_POLL_FAST_FOR:
+                interval = FENCE_POLL_FAST
+            else:
+                interval = FENCE_POLL_SLOW
+            # Stops waiting as soon as another SR got the ack
+            acked.wait(min(interval, deadline - now))
+    finally:
+        device.close()
 
 def dlm_fence_node(node_id):
     n = int(node_id)
     log.debug("dlm_fence_node node_id=%d" % n)
-    f = util.lock_file("dlm_fence_node", DLMREF_LOCK, "r+")
-    d = shelve.open(DLMREF)
-    klist = d.keys()
-    for key in klist:
-        bd = "/dev/" + key + "/sbd"
-        ret = block_write(bd, BLK_SIZE * 2 * n, MSG_FENCE)
-    d.close()
-    util.unlock_file("dlm_fence_node", f)
-    # Wait for an ACK for WD_TIMEOUT + 10 seconds or assume 
+    start = time.time()
+    # Wait for an ACK for FENCE_ACK_TIMEOUT seconds or assume
     # node has been fenced
-    for i in range(1, WD_TIMEOUT + 10):
-        f = util.lock_file("dlm_fence_node", DLMREF_LOCK, "r+")
-        d = shelve.open(DLMREF)
-        klist = d.keys()
-        for key in klist:
-            bd = "/dev/" + key + "/sbd"
-            ret = block_read(bd, BLK_SIZE * ((2 * n) + 1))
-            if ret == MSG_FENCE_ACK:
-                log.debug("dlm_fence_node got MSG_FENCE_ACK for node_id=%d" % n)
-                time.sleep(2)
-                util.unlock_file("dlm_fence_node", f)
-                exit(0)
-        d.close()
-        util.unlock_file("dlm_fence_node", f)
-        time.sleep(1)
-    log.debug("dlm_fence_node ACKING FENCE after TIMEOUT for node_id=%d" % n)
+    deadline = start + FENCE_ACK_TIMEOUT
+    acked = threading.Event()
+
+    def worker(key):
+        try:
+            _fence_on_sr(n, key, acked, deadline)
+        except Exception as e:
+            log.error("dlm_fence_node: cannot fence node_id=%d through the "
+                      "sbd of %s: %s" % (n, key, e))
+
+    threads = []
+    for key in read_members():
+        thread = threading.Thread(target=worker, args=(key,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # Let them notice the deadline, but not wait on a hung device
+        thread.join(max(deadline - time.time(), 0) + FENCE_POLL_SLOW)
+
+    if acked.is_set():
+        # The node's watchdog fires 1 second after it acks
+        time.sleep(2)
+        log.debug("dlm_fence_node: node_id=%d fenced after %.1fs" %
+                  (n, time.time() - start))
+    else:
+        log.debug("dlm_fence_node ACKING FENCE after TIMEOUT for node_id=%d "
+                  "(%.1fs)" % (n, time.time() - start))
 
 def dlm_fence_clear_by_id(node_id, scsi_id):
     n = int(node_id)
-    bd = "/dev/" + scsi_id + "/sbd"
+    bd = SBD_DEVICE % scsi_id
     log.debug("dlm_fence_clear_by_id: clearing node_id=%d, scsi_id=%s" %
               (n, scsi_id))
     ret = block_write(bd, BLK_SIZE * 2 * n, MSG_OK)
@@ -128,8 +306,47 @@ def dlm_fence_daemon_stop(node_id):
     dlm_fence_daemon.send_signal(signal.SIGUSR1)
     dlm_fence_daemon.wait()
     os.unlink("/var/run/sr-ref/dlm_fence_daemon.pickle")
+    try:
+        os.unlink(DAEMON_PID_FILE)
+    except OSError:
+        pass
     return
 
+def dlm_fence_daemon_reload():
+    """Tell the daemon that the SRs in DLMREF have changed. A daemon which
+       has not written its pid yet will read them when it does."""
+    try:
+        with open(DAEMON_PID_FILE) as f:
+            pid = int(f.read())
+        # Make sure the pid has not been reused since the daemon died
+        with open("/proc/%d/cmdline" % pid) as f:
+            if "dlm_fence_daemon" not in f.read().split("\0"):
+                return
+        os.kill(pid, signal.SIGHUP)
+    except (IOError, OSError, ValueError) as e:
+        log.debug("dlm_fence_daemon_reload: %s" % e)
+
+def dlm_fence_wait_closed(scsi_id):
+    """Wait for the daemon to close the sbd device of the SR [scsi_id],
+       once it has been removed from DLMREF, so that it can be
+       deactivated"""
+    path = SBD_OPEN_FILE % scsi_id
+    with open(path, "a") as opened:
+        deadline = time.time() + SBD_CLOSE_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(opened, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() > deadline:
+                log.error("dlm_fence_wait_closed: the fence daemon still "
+                          "has the sbd of %s open" % scsi_id)
+                break
+            time.sleep(0.1)
+    os.unlink(path)
+
 def dlm_fence_daemon_start(node_id):
     import subprocess
     args = ['/usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.gfs2/fence_tool.py',
@@ -3,20 +3,82 @@ import errno
 import os
 import fcntl
 import json
+import xcp.environ
+from xapi.storage.common import call
 from xapi.storage import log
 
+VHD_BLOCK_SIZE = 2 * 1024 * 1024
+VHD_SECTOR_SIZE = 512
+
+# New volumes are created in a directory of their own under the shard of
+# the host creating them, HOSTS_DIR/<host uuid>, and reached through a
+# symlink <id> in the SR root. gfs2 allocates the blocks of a file close
+# to its directory, and top level directories far from each other, so
+# each host allocates in its own resource groups and directory rather
+# than all of them taking turns on the same DLM locks. Volumes created
+# before this are directories in the SR root.
+HOSTS_DIR = "hosts"
+
+_host_shard = None
+
+def get_host_shard():
+    global _host_shard
+    if _host_shard is None:
+        _host_shard = xcp.environ.readInventory().get("INSTALLATION_UUID")
+    return _host_shard
+
+def _volume_dir(opq, name):
+    """Return the directory holding the volume [name], resolving the
+       symlink in the SR root"""
+    link = os.path.join(opq, name)
+    if os.path.islink(link):
+        return os.path.join(opq, os.readlink(link))
+    return link
+
+def _makedirs(path):
+    try:
+        os.makedirs(path, mode=0755)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            pass
+        else:
+            raise
+
+def _force_unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            pass
+        else:
+            raise
+
+def get_fs_parameters(opq):
+    """Return the parameters of the profile the SR was created with"""
+    meta_path = os.path.join(opq, "meta.json")
+    with open(meta_path, "r") as fd:
+        meta = json.load(fd)
+    return meta.get("fs_parameters", {})
+
 class Callbacks():
     def volumeCreate(self, opq, name, size):
         log.debug("volumeCreate opq=%s name=%s size=%d" % (opq, name, size))
-        vol_dir = os.path.join(opq, name)
+        link = os.path.join(opq, name)
+        if os.path.islink(link) or os.path.isdir(link):
+            vol_dir = _volume_dir(opq, name)
+        else:
+            shard = os.path.join(HOSTS_DIR, get_host_shard())
+            _makedirs(os.path.join(opq, shard))
+            vol_dir = os.path.join(opq, shard, name)
+            _makedirs(vol_dir)
+            try:
+                os.symlink(os.path.join(shard, name), link)
+            except OSError as exc:
+                if exc.errno == errno.EEXIST:
+                    pass
+                else:
+                    raise
         vol_path = os.path.join(vol_dir, name)
-        try:
-            os.makedirs(vol_dir, mode=0755)
-        except OSError as exc:
-            if exc.errno == errno.EEXIST:
-                pass
-            else:
-                raise
         try:
             open(vol_path, 'a').close()
         except OSError as exc:
@@ -24,18 +86,39 @@ class Callbacks():
                 pass
             else:
                 raise
-        return vol_path
+        return os.path.join(opq, name, name)
+    def volumePreallocate(self, opq, name, size):
+        # The new VHD leaves a hole where its BAT will grow into on
+        # resize: allocate it now, while this host is the only one
+        # writing to the volume. With 'full' preallocation, also
+        # allocate every data block and its bitmap past the end of the
+        # VHD, so that guest writes never need to allocate space.
+        vol_path = os.path.join(_volume_dir(opq, name), name)
+        length = os.stat(vol_path).st_size
+        if get_fs_parameters(opq).get("preallocation") == "full":
+            blocks = (size + VHD_BLOCK_SIZE - 1) // VHD_BLOCK_SIZE
+            length += blocks * (VHD_BLOCK_SIZE + VHD_SECTOR_SIZE)
+        log.debug("volumePreallocate opq=%s name=%s length=%d" %
+                  (opq, name, length))
+        call("volumePreallocate",
+             ["/usr/bin/fallocate", "--keep-size", "--offset", "0",
+              "--length", str(length), vol_path])
+    def volumePoolConfig(self, opq):
+        # How many empty volumes of what virtual size in bytes
+        # VHDVolume.fill_pool keeps ready, from the SR's meta.json.
+        # The pool is only refilled by the stats collector of the host
+        # holding the SR's "stats" lock, a few batches per reading: a
+        # burst of creates drains it and the rest of them create their
+        # VHDs as if there were no pool until it has caught up.
+        meta_path = os.path.join(opq, "meta.json")
+        with open(meta_path, "r") as fd:
+            pool = json.load(fd).get("volume_pool", {})
+        return (pool.get("count", 0), pool.get("vsize_mib", 0) * 1024 * 1024)
     def volumeDestroy(self, opq, name):
         log.debug("volumeDestroy opq=%s name=%s" % (opq, name))
-        vol_dir = os.path.join(opq, name)
+        vol_dir = _volume_dir(opq, name)
         vol_path = os.path.join(vol_dir, name)
-        try:
-            os.unlink(vol_path)
-        except OSError as exc:
-            if exc.errno == errno.ENOENT:
-                pass
-            else:
-                raise
+        _force_unlink(vol_path)
         try:
             os.rmdir(vol_dir)
         except OSError as exc:
@@ -43,6 +126,9 @@ class Callbacks():
                 pass
             else:
                 raise
+        link = os.path.join(opq, name)
+        if os.path.islink(link):
+            _force_unlink(link)
     def volumeGetPath(self, opq, name):
         log.debug("volumeGetPath opq=%s name=%s" % (opq, name))
         return os.path.join(opq, name, name)
@@ -52,15 +138,25 @@ class Callbacks():
         pass
     def volumeRename(self, opq, old_name, new_name):
         log.debug("volumeRename opq=%s old=%s new=%s" % (opq, old_name, new_name))
-        os.rename(os.path.join(opq, old_name),
-                  os.path.join(opq, new_name))
-        os.rename(os.path.join(opq, new_name, old_name),
-                  os.path.join(opq, new_name, new_name))
+        old_link = os.path.join(opq, old_name)
+        if os.path.islink(old_link):
+            # Stays in the shard it was created in
+            shard = os.path.dirname(os.readlink(old_link))
+            os.rename(os.path.join(opq, shard, old_name),
+                      os.path.join(opq, shard, new_name))
+            os.symlink(os.path.join(shard, new_name),
+                       os.path.join(opq, new_name))
+            os.unlink(old_link)
+        else:
+            os.rename(old_link, os.path.join(opq, new_name))
+        vol_dir = _volume_dir(opq, new_name)
+        os.rename(os.path.join(vol_dir, old_name),
+                  os.path.join(vol_dir, new_name))
         return os.path.join(opq, new_name, new_name)
     def volumeResize(self, opq, name, new_size):
         pass
     def volumeGetPhysSize(self, opq, name):
-        stat = os.stat(os.path.join(opq, name, name))
+        stat = os.stat(os.path.join(_volume_dir(opq, name), name))
         return stat.st_blocks * 512
     def volumeStartOperations(self, sr, mode):
         return urlparse.urlparse(sr).path
@@ -77,6 +173,11 @@ class Callbacks():
             meta = json.load(fd)
             value = meta["unique_id"]
         return value
+    def volumeReadCaching(self, opq):
+        meta_path = os.path.join(opq, "meta.json")
+        with open(meta_path, "r") as fd:
+            meta = json.load(fd)
+        return meta.get("read_caching", False)
     def volumeLock(self, opq, name):
         log.debug("volumeLock opq=%s name=%s" % (opq, name))
         vol_path = os.path.join(opq, name)
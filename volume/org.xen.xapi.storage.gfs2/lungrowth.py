@@ -0,0 +1,108 @@
+from __future__ import division
+import os
+import json
+import urlparse
+
+from xapi.storage.common import call
+from xapi.storage.libs import blkinfo
+from xapi.storage.libs import poolhelper
+from xapi.storage.libs import scsiutil
+from xapi.storage.libs import util
+from xapi.storage import log
+
+"""
+Growing a gfs2 SR when its LUN has been grown on the storage array.
+
+The stats collector runs a LunMonitor for each SR it reports, which
+cheaply rescans the LUN's size through sysfs and only runs the grow
+sequence (pvresize, lvextend, a refresh on the other hosts, gfs2_grow)
+when the LUN has actually grown.
+"""
+
+VG_FREE_SPACE_THRESHOLD = 0
+
+
+def vg_stats(dbg, vg_name):
+    try:
+        cmd = ["/usr/sbin/vgs", "--noheadings", "--nosuffix", "--units", "b", vg_name]
+        output = call(dbg, cmd)
+        stats = {}
+        text = output.split()
+        size = long(text[5])
+        freespace = long(text[6])
+        utilisation = size - freespace
+        stats['physical_size'] = size
+        stats['physical_utilisation'] = utilisation
+        stats['freespace'] = freespace
+
+    except Exception,e:
+        log.debug("Error in getting vg stats %s, vgs output: %s" %(str(e), output))
+    finally:
+        return stats
+
+
+def grow(dbg, sr, mnt_path, pv_name, vg_name):
+    """Grow the PV, LV and file system of the SR [sr], mounted at
+       [mnt_path], to fill its LUN"""
+    lv_name = "/dev/" + vg_name + "/gfs2"
+
+    # Does not matter if LUN is resized or not, go ahead and resize pv,
+    # incase if LUN is resized pv size will get updated
+    call(dbg, ["/usr/sbin/pvresize", pv_name, "--config", "global{metadata_read_only=0}"])
+
+    # if pv was expanded, this will reflect as freespace
+    # in the associated volume group, only then we need to expand gfs2 lv
+    stats = vg_stats(dbg, vg_name)
+    if stats.get('freespace', 0) <= VG_FREE_SPACE_THRESHOLD:
+        log.debug("%s: No free space detected in VG %s" % (dbg, vg_name))
+        return
+
+    log.debug("%s: Free space (%s) detected in VG %s, expanding gfs2 LV." %
+              (dbg, str(stats['freespace']), vg_name))
+    gl = os.path.join(urlparse.urlparse(sr).path, "gl")
+    f = util.lock_file(dbg, gl, "w+")
+    try:
+        # extend lv
+        call(dbg, ["lvextend", "-l+100%FREE", lv_name, "--config", "global{metadata_read_only=0}"])
+
+        # inform the other hosts about the LUN resize; refreshDM
+        # returns "" and only fails by raising
+        poolhelper.call_plugin_in_pool(
+            dbg, "gfs2setup", "refreshDM",
+            {'lv_name': lv_name, 'unique_id': vg_name,
+             'pv_dev': os.path.basename(pv_name)},
+            expected=None)
+
+        # grow gfs2
+        call(dbg, ["gfs2_grow", mnt_path])
+    finally:
+        util.unlock_file(dbg, f)
+
+
+class LunMonitor(object):
+
+    """Watches the size of the LUN of the SR [sr], mounted at
+       [mnt_path], and grows the SR when the LUN grows"""
+
+    def __init__(self, dbg, sr, mnt_path):
+        with open(os.path.join(urlparse.urlparse(sr).path,
+                               "meta.json")) as f:
+            meta = json.load(f)
+        self.sr = sr
+        self.mnt_path = mnt_path
+        self.pv_name = os.path.realpath(
+            blkinfo.get_device_path(dbg, meta["uri"]))
+        self.vg_name = meta["unique_id"]
+        # None until the first check, which also catches up with any
+        # growth that happened while nobody was watching
+        self.size = None
+
+    def check(self, dbg):
+        size = scsiutil.rescan(dbg, self.pv_name)
+        if self.size is not None and size <= self.size:
+            return
+        if self.size is not None:
+            log.debug("%s: LUN %s of %s has grown from %d to %d bytes" %
+                      (dbg, self.pv_name, self.sr, self.size, size))
+        grow(dbg, self.sr, self.mnt_path, self.pv_name, self.vg_name)
+        self.size = size
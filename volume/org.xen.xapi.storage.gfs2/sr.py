@@ -14,50 +14,100 @@ import xapi.storage.api.volume
 from xapi.storage.common import call
 from xapi.storage.libs.libvhd import VHDVolume, VHDCoalesce
 from xapi.storage.libs import libiscsi
+from xapi.storage.libs import multipath
+from xapi.storage.libs import poolhelper
 from xapi.storage.libs import blkinfo
 from xapi.storage.libs import util
 from xapi.storage import log
-import XenAPI
 
 import gfs2
 import fence_tool
+import stats
+import statcache
 import time
 
 # For a block device /a/b/c, we will mount it at <mountpoint_root>/a/b/c
 mountpoint_root = "/var/run/sr-mount/"
 DLM_REFDIR = "/var/run/sr-ref"
-VG_FREE_SPACE_THRESHOLD = 0
 
-def vg_stats(dbg, vg_name):
-    try:
-        cmd = ["/usr/sbin/vgs", "--noheadings", "--nosuffix", "--units", "b", vg_name]
-        output = call(dbg, cmd)
-        stats = {}
-        text = output.split()
-        size = long(text[5])
-        freespace = long(text[6])
-        utilisation = size - freespace
-        stats['physical_size'] = size
-        stats['physical_utilisation'] = utilisation
-        stats['freespace'] = freespace
-
-    except Exception,e:
-        log.debug("Error in getting vg stats %s, vgs output: %s" %(str(e), output))
-    finally:
-        return stats
-
-def getPVName(dbg, sr):
-    try:
-        uri = getFromSRMetadata(dbg, sr, 'uri')
-        dev_path = blkinfo.get_device_path(dbg, uri)
-        cmd = ["readlink", "-f", dev_path]
-        output = call(dbg, cmd)
-        return output.rstrip()
-    except Exception,e:
-        log.debug("Exception raised in getting PV name: %s" %str(e))
+# File system profiles, selected with the 'fs_profile' SR configuration
+# key at SR.create and recorded in the SR's meta.json. 'rgsize_mib',
+# 'journals' and 'journal_size_mib' are passed to mkfs.gfs2; every host
+# mounting the SR needs a journal of its own. 'preallocation' is either
+# 'sparse' or 'full', see gfs2.Callbacks.volumePreallocate.
+DEFAULT_FS_PROFILE = 'default'
+FS_PROFILES = {
+    # What SR.create always used to do
+    'default': {
+        'rgsize_mib': 2048,
+        'journals': 16,
+        'journal_size_mib': 128,
+        'preallocation': 'sparse'
+    },
+    # Many small, thin-provisioned desktop VDIs written from every host
+    # at once: small resource groups spread allocations over more
+    # resource group locks
+    'vdi-desktop': {
+        'rgsize_mib': 256,
+        'journals': 16,
+        'journal_size_mib': 64,
+        'preallocation': 'sparse'
+    },
+    # Few large VDIs: allocate new volumes in full up front so that guest
+    # writes never allocate
+    'large-vm': {
+        'rgsize_mib': 2048,
+        'journals': 16,
+        'journal_size_mib': 128,
+        'preallocation': 'full'
+    },
+    # Pools of up to 64 hosts, with smaller journals to keep their total
+    # size down
+    'many-hosts': {
+        'rgsize_mib': 1024,
+        'journals': 64,
+        'journal_size_mib': 32,
+        'preallocation': 'sparse'
+    }
+}
+
+# Pooled volumes are claimed by any VDI.create at least as large and
+# grown to size, so by default they are as small as a volume can be.
+# 'volume_pool_count' (0 by default) sets how many there are.
+DEFAULT_VOLUME_POOL_VSIZE_MIB = 1
+
+def join_cluster(dbg):
+    """Add this host to the corosync configuration of every online host
+       and reload corosync on all of them, this host last"""
+    this_uuid = xcp.environ.readInventory().get("INSTALLATION_UUID")
+    # We may have only just joined the pool
+    directory = poolhelper.with_session(
+        dbg, lambda session: poolhelper.get_host_directory(
+            dbg, session, refresh=True))
+    names = dict([(host["ref"], name) for (name, host)
+                  in directory.iteritems()])
+    this_host = [host["ref"] for host in directory.itervalues()
+                 if host["uuid"] == this_uuid]
+    other_hosts = [host["ref"] for host in directory.itervalues()
+                   if host["live"] and host["uuid"] != this_uuid]
 
-def getVGName(dbg, sr):
-    return getFromSRMetadata(dbg, sr, "unique_id")
+    try:
+        # The gfs2setup functions return the cluster name, or "" when
+        # there is nothing to do: only an exception is a failure
+        poolhelper.call_plugin_in_waves(
+            dbg, [other_hosts + this_host], "gfs2setup", "gfs2UpdateConf",
+            {}, expected=None)
+        poolhelper.call_plugin_in_waves(
+            dbg, [other_hosts, this_host], "gfs2setup", "gfs2Reload", {},
+            expected=None)
+    except poolhelper.PoolPluginCallFailed as e:
+        log.error("%s: cluster bring-up succeeded on %s but failed on %s" %
+                  (dbg, sorted([names.get(ref, ref) for ref in e.succeeded]),
+                   sorted([names.get(ref, ref) for ref in e.failures])))
+        raise
+    log.debug("%s: cluster bring-up succeeded on %s" %
+              (dbg, sorted(names.get(ref, ref)
+                           for ref in other_hosts + this_host)))
 
 def getSRMountPath(dbg, dev_path, check=True):
     mnt_path = os.path.abspath(mountpoint_root + dev_path)
@@ -91,7 +141,10 @@ def getFromSRMetadata(dbg, sr, key):
 
 def get_unique_id_from_dev_path(dev_path):
     # This is basically just returning scsi-id
-    # it is removing "/dev/disk/by-id/scsi-" from dev_path
+    # multipath maps are named after it: "/dev/mapper/<scsi-id>"
+    if dev_path.startswith(multipath.MAPPER_ROOT):
+        return dev_path[len(multipath.MAPPER_ROOT):]
+    # otherwise it is removing "/dev/disk/by-id/scsi-" from dev_path
     return dev_path[21:]
 
 def sanitise_name(dbg, name):
@@ -155,10 +208,10 @@ def umount(dbg, mnt_path):
     cmd = ["/usr/bin/umount", mnt_path]
     call(dbg, cmd)
 
-def plug_device(dbg, uri):
+def plug_device(dbg, uri, tuning_profile=None):
     u = urlparse.urlparse(uri)     
     if u.scheme == 'iscsi':
-        dev_path = libiscsi.zoneInLUN(dbg, uri)
+        dev_path = libiscsi.zoneInLUN(dbg, uri, tuning_profile)
     else: 
         # Assume it's a local block device
         dev_path = blkinfo.get_device_path(dbg, uri)
@@ -196,7 +249,15 @@ def find_if_gfs2(impl, dbg, uri):
             # stat takes sr_path which is 
             # file://<mnt_path>
             sr_path = "file://%s" % mnt_path
-            srs.append(impl.stat(dbg, sr_path))
+            sr_stat = impl.stat(dbg, sr_path)
+            # Report how the SR was built; SRs which predate the
+            # profiles were all built the 'default' way
+            with open(os.path.join(mnt_path, "meta.json"), "r") as fd:
+                meta = json.load(fd)
+            sr_stat["fs_profile"] = meta.get("fs_profile", DEFAULT_FS_PROFILE)
+            sr_stat["fs_parameters"] = meta.get(
+                "fs_parameters", FS_PROFILES[DEFAULT_FS_PROFILE])
+            srs.append(sr_stat)
             if mount == True:
                 umount(dbg, mnt_path)
                 # deactivate gfs2 LV
@@ -215,6 +276,8 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
     def probe(self, dbg, uri):
         uris = []
         srs = []
+        tuning = None
+        path_stats = None
         u = urlparse.urlparse(uri)
         if u.scheme == None:
             raise xapi.storage.api.volume.SR_does_not_exist(
@@ -258,6 +321,10 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
                 try: 
                     libiscsi.login(dbg, probe_uuid, keys)
                     srs = find_if_gfs2(self, dbg, uri)
+                    # Report what the LUN is actually running with
+                    tuning = libiscsi.getTuning(dbg, keys)
+                    # and how its I/O is spread over the paths to it
+                    path_stats = libiscsi.getPathStats(dbg, uri)
                 finally: 
                     libiscsi.logout(dbg, probe_uuid, keys['iqn'])
                     
@@ -269,10 +336,15 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
             #HBA transport
             srs = find_if_gfs2(self, dbg, uri)
 
-        return {
+        result = {
             "srs": srs,
             "uris": uris
         }
+        if tuning is not None:
+            result["tuning"] = tuning
+        if path_stats:
+            result["path_stats"] = path_stats
+        return result
 
 
     def attach(self, dbg, uri):
@@ -288,6 +360,7 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         try:
             if os.path.ismount(tmp_mnt_check):
                 log.debug("%s: SR.attach: uri=%s ALREADY ATTACHED" % (dbg, uri))
+                stats.start_stats(dbg, "file://" + tmp_mnt_check)
                 return "file://" + tmp_mnt_check
         except:
             log.debug("%s: SR.attach: uri=%s NOT ATTACHED YET" % (dbg, uri))
@@ -303,28 +376,7 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
 
         if output != "active":
             # Notify other pool members we have arrived
-            inventory = xcp.environ.readInventory()
-            session = XenAPI.xapi_local()
-            session.xenapi.login_with_password("root", "")
-            this_host = session.xenapi.host.get_by_uuid(
-                inventory.get("INSTALLATION_UUID"))
-            # FIXME: Do not notify offline hosts
-            # FIXME: See ffs.call_plugin_in_pool()
-            for host in session.xenapi.host.get_all():
-                log.debug("%s: refresh host %s config file" % (dbg, session.xenapi.host.get_name_label(host)))
-                session.xenapi.host.call_plugin(
-                    host, "gfs2setup", "gfs2UpdateConf", {})
-
-            for host in session.xenapi.host.get_all():
-                if host != this_host:
-                    log.debug("%s: setup host %s" % (dbg, session.xenapi.host.get_name_label(host)))
-                    session.xenapi.host.call_plugin(
-                        host, "gfs2setup", "gfs2Reload", {})
-
-            # this_host will reload last
-            log.debug("%s: refresh host %s" % (dbg, session.xenapi.host.get_name_label(this_host)))
-            session.xenapi.host.call_plugin(
-                this_host, "gfs2setup", "gfs2Reload", {})
+            join_cluster(dbg)
 
         else:
 
@@ -374,6 +426,9 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
             # start dlm
             cmd = ["/usr/bin/systemctl", "start", "dlm"]
             call(dbg, cmd)
+        else:
+            # Have the fencing daemon watch this SR's sbd too
+            fence_tool.dlm_fence_daemon_reload()
 
         util.unlock_file(dbg, f)
 
@@ -387,14 +442,60 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
 
         sr = "file://" + mnt_path
 
+        # zoneInLUN applied the tuning profile given in the URI or
+        # recorded in the pool. SRs created before profiles were
+        # recorded in the pool only have theirs in meta.json: record it
+        # for the next login, and apply what can be applied now.
+        u = urlparse.urlparse(uri)
+        if u.scheme == 'iscsi' and \
+           'tuning_profile' not in urlparse.parse_qs(u.query):
+            with open(os.path.join(mnt_path, "meta.json"), "r") as fd:
+                profile = json.load(fd).get("tuning_profile")
+            scsiid = libiscsi.decomposeISCSIuri(dbg, u)['scsiid']
+            if profile and profile != libiscsi.DEFAULT_TUNING_PROFILE and \
+               libiscsi.getPoolTuningProfile(dbg, scsiid) is None:
+                log.debug("%s: applying tuning profile %s" % (dbg, profile))
+                libiscsi.setPoolTuningProfile(dbg, scsiid, profile)
+                libiscsi.applyTuning(dbg, uri, profile)
+
         # Start GC for this host
         # VHDCoalesce.start_gc(dbg, "gfs2", sr)
 
+        stats.start_stats(dbg, sr)
+
         return sr
 
     def create(self, dbg, uri, name, description, configuration):
         log.debug("%s: SR.create: uri=%s, config=%s" % (dbg, uri, configuration))
 
+        tuning_profile = configuration.get(
+            'tuning_profile', libiscsi.DEFAULT_TUNING_PROFILE)
+        if tuning_profile not in libiscsi.TUNING_PROFILES:
+            raise xapi.storage.api.volume.Unimplemented(
+                "Unknown tuning_profile '%s'" % tuning_profile)
+
+        fs_profile = configuration.get('fs_profile', DEFAULT_FS_PROFILE)
+        if fs_profile not in FS_PROFILES:
+            raise xapi.storage.api.volume.Unimplemented(
+                "Unknown fs_profile '%s'; please use one of %s" %
+                (fs_profile, ", ".join(sorted(FS_PROFILES))))
+        fs_parameters = FS_PROFILES[fs_profile]
+
+        # Empty volumes kept ready for VDI.create by the stats collector
+        try:
+            volume_pool = {
+                "count": int(configuration.get('volume_pool_count', 0)),
+                "vsize_mib": int(configuration.get(
+                    'volume_pool_vsize_mib', DEFAULT_VOLUME_POOL_VSIZE_MIB))
+            }
+        except ValueError:
+            raise xapi.storage.api.volume.Unimplemented(
+                "volume_pool_count and volume_pool_vsize_mib must be integers")
+        if volume_pool["count"] < 0 or volume_pool["vsize_mib"] < 1:
+            raise xapi.storage.api.volume.Unimplemented(
+                "volume_pool_count must be at least 0 and "
+                "volume_pool_vsize_mib at least 1")
+
         cmd = ["/usr/sbin/corosync-cmapctl", "totem.cluster_name"]
         out = call(dbg, cmd).rstrip()
         # Cluster id is quite limited in size
@@ -405,8 +506,13 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         sr_name = str(uuid.uuid4())[0:16]
         fsname = "%s:%s" % (cluster_name, sr_name)
 
-        # Zone-in the LUN
-        dev_path = plug_device(dbg, uri)
+        # Zone-in the LUN, tuned as every host will tune it
+        u = urlparse.urlparse(uri)
+        if u.scheme == 'iscsi':
+            libiscsi.setPoolTuningProfile(
+                dbg, libiscsi.decomposeISCSIuri(dbg, u)['scsiid'],
+                tuning_profile)
+        dev_path = plug_device(dbg, uri, tuning_profile)
         log.debug("%s: dev_path = %s" % (dbg, dev_path))
 
         cmd = ["/usr/bin/dd", "if=/dev/zero", "of=%s" % dev_path, "bs=1M",
@@ -445,10 +551,10 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         cmd = ["/usr/sbin/mkfs.gfs2",
                "-t", fsname,
                "-p", "lock_dlm",
-               "-r", "2048",
-               "-J", "128",
+               "-r", str(fs_parameters['rgsize_mib']),
+               "-J", str(fs_parameters['journal_size_mib']),
                "-O",
-               "-j", "16",
+               "-j", str(fs_parameters['journals']),
                gfs2_dev_path]
         call(dbg, cmd)
 
@@ -470,6 +576,10 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
             "unique_id": unique_id,
             "fsname": fsname,
             "read_caching": read_caching,
+            "tuning_profile": tuning_profile,
+            "fs_profile": fs_profile,
+            "fs_parameters": fs_parameters,
+            "volume_pool": volume_pool,
             "keys": {}
         }
         metapath = mnt_path + "/meta.json"
@@ -507,6 +617,8 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         except:
             log.debug("GC already stopped")
 
+        stats.stop_stats(dbg, sr)
+
         # Unmount the FS
         mnt_path = urlparse.urlparse(sr).path
         umount(dbg, mnt_path)
@@ -529,6 +641,8 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
             node_id = get_node_id(dbg)
             log.debug("Calling dlm_fence_daemon_stop: node_id=%d" % node_id)
             fence_tool.dlm_fence_daemon_stop(node_id)
+        else:
+            fence_tool.dlm_fence_daemon_reload()
 
         util.unlock_file(dbg, f)
 
@@ -536,8 +650,8 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         cmd = ["/usr/sbin/lvchange", "-an", unique_id + "/gfs2"]
         call(dbg, cmd)
 
-        # Fixme: kill fencing daemon
-        # deactivate sbd LV
+        # deactivate sbd LV, once the fencing daemon has let go of it
+        fence_tool.dlm_fence_wait_closed(unique_id)
         cmd = ["/usr/sbin/lvchange", "-an", unique_id + "/sbd"]
         call(dbg, cmd)
 
@@ -545,61 +659,9 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         unplug_device(dbg, uri)
 
     def ls(self, dbg, sr):
-        pv_name = getPVName(dbg,sr)
-        vg_name = getVGName(dbg,sr)
-        lv_name = "/dev/" + vg_name +"/gfs2"
-
-        try:
-            # refresh iscsi connection to reflect LUN's new size
-            call(dbg, ["/usr/sbin/iscsiadm", "-m", "node", "-R"])
-
-            # Does not matter if LUN is resized or not, go ahead and resize pv,
-            # incase if LUN is resized pv size will get updated
-            call(dbg, ["/usr/sbin/pvresize" , pv_name, "--config", "global{metadata_read_only=0}"])
-
-            # if pv was expanded, this will reflect as freespace
-            # in the associated volume group, only then we need to expand gfs2 lv
-
-            stats = vg_stats(dbg,vg_name)
-            if stats['freespace'] > VG_FREE_SPACE_THRESHOLD:
-                log.debug("Free space (%s) detected in VG, expanding gfs2 LV." %str(stats['freespace']))
-                opq = urlparse.urlparse(sr).path
-                try:
-                    gl = os.path.join(opq, "gl")
-                    f = util.lock_file(dbg, gl, "w+")
-                    # extend lv
-                    call(dbg, ["lvextend", "-l+100%FREE", lv_name, "--config", "global{metadata_read_only=0}"])
-
-                    #inform other node about LUN resize
-                    inventory = xcp.environ.readInventory()
-                    session = XenAPI.xapi_local()
-                    session.xenapi.login_with_password("root", "")
-                    this_host = session.xenapi.host.get_by_uuid(
-                        inventory.get("INSTALLATION_UUID"))
-
-                    for host in session.xenapi.host.get_all():
-                        if host != this_host:
-                            log.debug("%s: setup host %s" % (dbg, session.xenapi.host.get_name_label(host)))
-                            session.xenapi.host.call_plugin(
-                                host, "gfs2setup", "refreshDM", {'lv_name': lv_name, 'pv_dev': pv_name.split('/')[2]})
-
-                    # grow gfs2
-                    call(dbg, ["gfs2_grow", mountpoint_root + "dev/" + vg_name +"/gfs2"])
-
-                except Exception, e:
-                    raise e
-
-                finally:
-                    if f:
-                        util.unlock_file(dbg,f)
-            else:
-                log.debug("No free space detected in VG")
-
-        except Exception, e:
-                log.debug("Exception in SR.ls: %s" %str(e))
-
-        finally:
-            return VHDVolume.ls(dbg, sr, gfs2.Callbacks())
+        # LUN growth is picked up in the background by the stats
+        # collector, see lungrowth.py
+        return VHDVolume.ls(dbg, sr, gfs2.Callbacks())
 
     def stat(self, dbg, sr):
         # SR path (sr) is file://<mnt_path>
@@ -610,14 +672,23 @@ class Implementation(xapi.storage.api.volume.SR_skeleton):
         if not(os.path.isdir(mnt_path)) or not(os.path.ismount(mnt_path)):
             raise xapi.storage.api.volume.Sr_not_attached(mnt_path)
 
-        # Get the filesystem size
-        statvfs = os.statvfs(mnt_path)
-        psize = statvfs.f_blocks * statvfs.f_frsize
-        fsize = statvfs.f_bfree * statvfs.f_frsize
-        log.debug("%s: statvfs says psize = %Ld" % (dbg, psize))
+        snapshot = statcache.get(dbg, sr, statcache.get_ttl(dbg))
+        if snapshot is None:
+            # Get the filesystem size
+            statvfs = os.statvfs(mnt_path)
+            psize = statvfs.f_blocks * statvfs.f_frsize
+            fsize = statvfs.f_bfree * statvfs.f_frsize
+            log.debug("%s: statvfs says psize = %Ld" % (dbg, psize))
+
+            provisioned_size = \
+                VHDVolume.get_sr_provisioned_size(sr, gfs2.Callbacks())
+            statcache.put(dbg, sr, psize, fsize, provisioned_size)
+        else:
+            psize = snapshot["total_space"]
+            fsize = snapshot["free_space"]
+            provisioned_size = snapshot["provisioned_size"]
 
-        overprovision = \
-             VHDVolume.get_sr_provisioned_size(sr, gfs2.Callbacks()) / psize
+        overprovision = provisioned_size / psize
 
         return {
             "sr": sr,
@@ -0,0 +1,127 @@
+import os
+import re
+import sys
+import json
+import time
+import errno
+
+from xapi.storage.libs import util
+from xapi.storage import log
+
+"""
+Host-local cache of the SR.stat snapshot of each attached gfs2 SR.
+
+Computing an SR's provisioned size reads every volume in the metabase,
+and statvfs of the cluster file system may wait on other hosts. SR.stat
+answers from a snapshot of both which the stats collector refreshes on
+every reading, and only computes one itself when there is no snapshot or
+it is older than the TTL, e.g. when the collector is not running.
+
+Volume operations on this host invalidate the snapshot or, when they
+know by how much, adjust its provisioned size in place; those on other
+hosts are only seen once the collector refreshes it.
+"""
+
+CONFIG_FILE = "/etc/sysconfig/xapi-storage-gfs2-stats"
+DEFAULT_TTL = 30
+
+CACHE_DIR = "/var/run/nonpersistent/xapi-storage-gfs2-stat-cache"
+CACHE_SUFFIX = ".json"
+
+
+def get_ttl(dbg):
+    """Return how long, in seconds, a snapshot may be used for; set by
+       STAT_CACHE_TTL in CONFIG_FILE. 0 disables the cache."""
+    config = util.read_sysconfig(CONFIG_FILE)
+    try:
+        ttl = float(config.get("STAT_CACHE_TTL", DEFAULT_TTL))
+    except ValueError:
+        log.error("%s: invalid STAT_CACHE_TTL in %s, using %d seconds" %
+                  (dbg, CONFIG_FILE, DEFAULT_TTL))
+        ttl = DEFAULT_TTL
+    return max(ttl, 0)
+
+
+def _path(sr):
+    return os.path.join(CACHE_DIR,
+                        re.sub(r'[^a-zA-Z0-9-]', '_', sr) + CACHE_SUFFIX)
+
+
+def _lock(dbg, sr):
+    try:
+        os.makedirs(CACHE_DIR, mode=0755)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return util.lock_file(dbg, _path(sr) + ".lock")
+
+
+def _read(sr):
+    try:
+        with open(_path(sr)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write(sr, snapshot):
+    tmp_path = _path(sr) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.rename(tmp_path, _path(sr))
+
+
+def get(dbg, sr, ttl):
+    """Return the snapshot of the SR [sr] if it is younger than [ttl]
+       seconds, else None"""
+    snapshot = _read(sr)
+    if snapshot is None:
+        return None
+    age = time.time() - snapshot["time"]
+    if age < 0 or age >= ttl:
+        return None
+    return snapshot
+
+
+def put(dbg, sr, total_space, free_space, provisioned_size):
+    """Record a snapshot of the SR [sr] taken now"""
+    try:
+        f = _lock(dbg, sr)
+        try:
+            _write(sr, {
+                "time": time.time(),
+                "total_space": total_space,
+                "free_space": free_space,
+                "provisioned_size": provisioned_size
+            })
+        finally:
+            util.unlock_file(dbg, f)
+    except (IOError, OSError):
+        log.error("%s: cannot cache the stats of %s: %s" %
+                  (dbg, sr, sys.exc_info()[1]))
+
+
+def adjust(dbg, sr, provisioned_delta):
+    """Add [provisioned_delta] bytes to the provisioned size in the
+       snapshot of the SR [sr], if any, without making it any younger"""
+    try:
+        f = _lock(dbg, sr)
+        try:
+            snapshot = _read(sr)
+            if snapshot is not None:
+                snapshot["provisioned_size"] += provisioned_delta
+                _write(sr, snapshot)
+        finally:
+            util.unlock_file(dbg, f)
+    except (IOError, OSError):
+        invalidate(dbg, sr)
+
+
+def invalidate(dbg, sr):
+    """Forget the snapshot of the SR [sr]"""
+    try:
+        os.unlink(_path(sr))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.error("%s: cannot invalidate the cached stats of %s: %s" %
+                      (dbg, sr, e))
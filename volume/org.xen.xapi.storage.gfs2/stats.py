@@ -1,20 +1,72 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from time import sleep
+import os
+import re
+import sys
 import errno
+import fcntl
+import time
+import struct
+import urlparse
+import subprocess
 
 from xapi.storage.libs.rrddlib import Datasource, PluginControl
-from xapi.storage.libs.libvhdi.lock import Lock
-from xapi.storage.libs.vhd_coalesce import touch
-from sr import Implementation
+from xapi.storage.libs.libvhd import VHDVolume
+from xapi.storage.libs.libvhd.metabase import VHDMetabase
 from xapi.storage import log
 
-def force_unlink(path):
-    from os import unlink
+import lungrowth
+import statcache
+
+"""
+Host-level collector of the statistics of every gfs2 SR attached to
+this host, published to xcp-rrdd through a single plugin.
+
+SR.attach registers the SR with start_stats(), which also starts the
+collector unless it is already running, and SR.detach deregisters it
+with stop_stats(). The collector keeps each SR's metabase open and only
+recomputes an SR's provisioned size when the metabase has changed. The
+host reporting an SR also watches its LUN and grows the SR when the LUN
+grows, and keeps its pool of empty volumes (VHDVolume.fill_pool) full.
+Every host's collector also keeps the SR.stat cache of its SRs
+(statcache.py) fresh. The collector exits once no SR has been registered
+for a while.
+"""
+
+PLUGIN_NAME = 'sr_stats'
+
+# One file per registered SR, named after its SCSI id and holding its
+# uri. The collector holds a shared lock on ".<SCSI id>.active" for as
+# long as it has files of the SR open.
+REGISTRATION_DIR = "/var/run/nonpersistent/xapi-storage-gfs2-stats"
+LOCK_FILE = os.path.join(REGISTRATION_DIR, ".lock")
+
+# How long stop_stats() waits for the collector to let go of the SR
+STOP_TIMEOUT = 30
+
+# Exit after this many readings in a row without a registered SR
+IDLE_READINGS = 12
+
+# Check for LUN growth every this many readings (about a minute)
+GROWTH_CHECK_READINGS = 12
+
+# Create or destroy at most this many pooled volumes per reading, and
+# look for changes to the pool's size at least every this many readings
+POOL_FILL_BATCH = 2
+POOL_CHECK_READINGS = 12
+
+# Offset of the file change counter in the header of an sqlite database,
+# which every committed write transaction increments
+SQLITE_CHANGE_COUNTER_OFFSET = 24
 
+# Debug string
+STATS = 'gfs2-stats'
+
+
+def force_unlink(path):
     try:
-        unlink(path)
+        os.unlink(path)
     except OSError as exc:
         if exc.errno != errno.ENOENT:
             raise
@@ -80,91 +132,281 @@ get_reading = {
     'overprovision': _get_overprovision,
 }
 
-def run_stats(uri):
-    demonize()
-
-    cb = get_gfs2_callbacks()
-    opq = cb.volumeStartOperations(uri, 'w')
-    scsi_id = cb.getUniqueIdentifier(opq).split('/')[-1]
-
-    with Lock(opq, "stats", cb):
-        sr_stats_plugin = PluginControl(
-            'sr_stats_' + scsi_id,
-            'Local',
-            'Five_seconds',
-            0.5
-        )
-
-        sr_impl = Implementation()
-        ds_dict = create_datasource_dict(sr_impl.stat('', uri), scsi_id)
-
-        # Calling full_update() is mandatory the first time
-        # Creates memory mapped file and does all related prep work
-        sr_stats_plugin.full_update(ds_dict)
-
-        while True:
-            # Wait 0.5 seconds before xcp-rrdd
-            # is going to read the output file
-            sr_stats_plugin.wake_up_before_next_reading()
 
-            # Collect measurements
-            # ---------------------- PUT CODE HERE ----------------------
-            stats_dict = sr_impl.stat('', uri)
+def metabase_version(meta_path):
+    """Return a value which changes whenever a write to the metabase at
+       [meta_path] is committed, from any host"""
+    with open(meta_path, "rb") as f:
+        f.seek(SQLITE_CHANGE_COUNTER_OFFSET)
+        (counter,) = struct.unpack(">I", f.read(4))
+        return (os.fstat(f.fileno()).st_ino, counter)
+
+
+def _active_path(scsi_id):
+    return os.path.join(REGISTRATION_DIR, "." + scsi_id + ".active")
+
+
+class SRStats(object):
+
+    """What the collector keeps about one registered SR"""
+
+    def __init__(self, scsi_id, uri):
+        self.active = open(_active_path(scsi_id), "a")
+        fcntl.flock(self.active, fcntl.LOCK_SH)
+        self.uri = uri
+        self.cb = get_gfs2_callbacks()
+        self.opq = self.cb.volumeStartOperations(uri, 'r')
+        u = urlparse.urlparse(uri)
+        self.mnt_path = "/%s/%s" % (u.netloc, u.path)
+        self.meta_path = self.cb.volumeMetadataGetPath(self.opq)
+        self.scsi_id = scsi_id
+        self.db = None
+        # Only one host in the cluster reports an SR: the one holding
+        # its "stats" lock
+        self.lock = None
+        self.version = None
+        self.provisioned_size = None
+        self.lun = None
+        self.readings = 0
+        # The metabase version at which the pool was last found full
+        self.pool_version = None
+
+    def try_lock(self):
+        if self.lock is None:
+            self.lock = self.cb.volumeTryLock(self.opq, "stats")
+        return self.lock is not None
+
+    def check_growth(self, dbg):
+        if self.readings % GROWTH_CHECK_READINGS != 1:
+            return
+        if self.lun is None:
+            self.lun = lungrowth.LunMonitor(dbg, self.uri, self.mnt_path)
+        self.lun.check(dbg)
+
+    def fill_pool(self, dbg):
+        # The pool can only have been drained, or changed size, by a
+        # write to the metabase, but a write to the SR's meta.json is
+        # only noticed at the next periodic check
+        if (self.version == self.pool_version and
+                self.readings % POOL_CHECK_READINGS != 1):
+            return
+        changed = VHDVolume.fill_pool(dbg, self.uri, self.cb, self.db,
+                                      POOL_FILL_BATCH)
+        if changed:
+            log.debug("%s: created or destroyed %d pooled volumes in %s" %
+                      (dbg, changed, self.uri))
+        if changed < POOL_FILL_BATCH:
+            self.pool_version = metabase_version(self.meta_path)
+        else:
+            self.pool_version = None
+
+    def stat(self):
+        self.readings += 1
+        statvfs = os.statvfs(self.mnt_path)
+        psize = statvfs.f_blocks * statvfs.f_frsize
+        fsize = statvfs.f_bfree * statvfs.f_frsize
+
+        version = metabase_version(self.meta_path)
+        if version != self.version:
+            if self.db is None:
+                self.db = VHDMetabase(self.meta_path)
+            self.provisioned_size = VHDVolume.get_sr_provisioned_size(
+                self.uri, self.cb, self.db)
+            self.version = version
+
+        statcache.put(STATS, self.uri, psize, fsize, self.provisioned_size)
+        return {
+            "total_space": psize,
+            "free_space": fsize,
+            "overprovision": self.provisioned_size / psize
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        if self.lock is not None:
+            self.cb.volumeUnlock(self.opq, self.lock)
+            self.lock = None
+        # Lets stop_stats() know we are done with the SR
+        self.active.close()
+
+
+def registered_srs():
+    """Return {scsi id: uri} for the SRs registered on this host"""
+    srs = {}
+    try:
+        names = os.listdir(REGISTRATION_DIR)
+    except OSError:
+        return srs
+    for name in names:
+        if name.startswith("."):
+            continue
+        try:
+            with open(os.path.join(REGISTRATION_DIR, name)) as f:
+                srs[name] = f.read().strip()
+        except IOError:
+            # Deregistered under our feet
+            pass
+    return srs
 
-            for stat in ds_dict:
-                ds_dict[stat].set_value(get_reading[stat](stats_dict))
 
-            # -----------------------------------------------------------
+def run_stats(dbg):
+    sr_stats_plugin = PluginControl(
+        PLUGIN_NAME,
+        'Local',
+        'Five_seconds',
+        0.5
+    )
 
+    srs = {}
+    ds_dict = None
+    idle = 0
+    while idle < IDLE_READINGS:
+        # Wait 0.5 seconds before xcp-rrdd
+        # is going to read the output file
+        sr_stats_plugin.wake_up_before_next_reading()
+
+        registered = registered_srs()
+        idle = idle + 1 if not registered else 0
+        for scsi_id in set(srs) - set(registered):
+            log.debug("%s: SR %s deregistered" % (dbg, scsi_id))
+            srs.pop(scsi_id).close()
+        for (scsi_id, uri) in registered.iteritems():
+            if scsi_id not in srs:
+                log.debug("%s: SR %s registered as %s" % (dbg, scsi_id, uri))
+                try:
+                    srs[scsi_id] = SRStats(scsi_id, uri)
+                except Exception:
+                    log.error("%s: cannot collect stats of %s: %s" %
+                              (dbg, uri, sys.exc_info()[1]))
+
+        # Collect measurements
+        stats = {}
+        for (scsi_id, sr) in srs.iteritems():
+            try:
+                # Every host refreshes its SR.stat cache, but only one
+                # reports the SR
+                stats_dict = sr.stat()
+                if not sr.try_lock():
+                    continue
+                stats[scsi_id] = stats_dict
+            except Exception:
+                log.error("%s: cannot stat %s: %s" %
+                          (dbg, sr.uri, sys.exc_info()[1]))
+                continue
+            try:
+                sr.check_growth(dbg)
+            except Exception:
+                log.error("%s: cannot check %s for LUN growth: %s" %
+                          (dbg, sr.uri, sys.exc_info()[1]))
+            try:
+                sr.fill_pool(dbg)
+            except Exception:
+                log.error("%s: cannot fill the volume pool of %s: %s" %
+                          (dbg, sr.uri, sys.exc_info()[1]))
+
+        new_ds_dict = {}
+        for (scsi_id, stats_dict) in stats.iteritems():
+            for (stat, ds) in \
+                    create_datasource_dict(stats_dict, scsi_id).iteritems():
+                new_ds_dict[(scsi_id, stat)] = ds
+
+        # Only rewrite the metadata when the datasources change
+        if ds_dict is None or set(ds_dict) != set(new_ds_dict):
+            log.debug("%s: now reporting SRs %s" % (dbg, sorted(stats)))
+            ds_dict = new_ds_dict
+            for ((scsi_id, stat), ds) in ds_dict.iteritems():
+                ds.set_value(get_reading[stat](stats[scsi_id]))
+            sr_stats_plugin.full_update(ds_dict)
+        else:
+            for ((scsi_id, stat), ds) in ds_dict.iteritems():
+                ds.set_value(get_reading[stat](stats[scsi_id]))
             # As long as the datasources remain the same
             # (apart from their values) call fast_update()
             sr_stats_plugin.fast_update(ds_dict)
 
-def start_stats(uri):
-    import subprocess
-    from pickle import dump as pickle_dump
-    from os.path import join as path_join
-
-    args = ['/usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.gfs2/stats.py', uri]
-    proc = subprocess.Popen(args)
-
-    cb = get_gfs2_callbacks()
-    opq = cb.volumeStartOperations(uri, 'w')
-
-    stats_obj = path_join(
-        "/var/run/sr-private",
-        cb.getUniqueIdentifier(opq),
-        'stats.obj'
-    )
-
-    touch(stats_obj)
-    with open(stats_obj, 'w') as f:
-        pickle_dump(proc, f)
-
+    for sr in srs.values():
+        sr.close()
+    log.debug("%s: no SRs left, exiting" % dbg)
 
-def stop_stats(uri):
-    from pickle import load as pickle_load
-    from os.path import join as path_join
 
-    cb = get_gfs2_callbacks()
-    opq = cb.volumeStartOperations(uri, 'w')
-
-    stats_obj = path_join(
-        "/var/run/sr-private",
-        cb.getUniqueIdentifier(opq),
-        'stats.obj'
-    )
-
-    proc = None
+def _ensure_running(dbg):
+    try:
+        with open(LOCK_FILE, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Get the command to run, need to replace pyc with py as __file__
+        # will be the byte compiled file
+        args = [os.path.abspath(re.sub("pyc$", "py", __file__))]
+        subprocess.Popen(args, close_fds=True)
+        log.debug("%s: started the SR stats collector" % dbg)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
 
-    with open(stats_obj, 'r') as f:
-        proc = pickle_load(f)
 
-    proc.kill()
-    force_unlink(stats_obj)
+def start_stats(dbg, uri):
+    """Have the host's collector report the stats of the SR [uri]"""
+    try:
+        cb = get_gfs2_callbacks()
+        opq = cb.volumeStartOperations(uri, 'w')
+        scsi_id = cb.getUniqueIdentifier(opq).split('/')[-1]
+        try:
+            os.makedirs(REGISTRATION_DIR, mode=0755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = os.path.join(REGISTRATION_DIR, "." + scsi_id + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(uri)
+        os.rename(tmp_path, os.path.join(REGISTRATION_DIR, scsi_id))
+        _ensure_running(dbg)
+    except (IOError, OSError):
+        # Statistics must never stop an SR from attaching
+        log.error("%s: cannot start the stats of %s: %s" %
+                  (dbg, uri, sys.exc_info()[1]))
+
+
+def stop_stats(dbg, uri):
+    """Stop reporting the stats of the SR [uri], and wait for the
+       collector to close the SR's files so that it can be unmounted"""
+    try:
+        cb = get_gfs2_callbacks()
+        opq = cb.volumeStartOperations(uri, 'w')
+        scsi_id = cb.getUniqueIdentifier(opq).split('/')[-1]
+        force_unlink(os.path.join(REGISTRATION_DIR, scsi_id))
+        with open(_active_path(scsi_id), "a") as active:
+            deadline = time.time() + STOP_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(active, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() > deadline:
+                    log.error("%s: the stats collector still has %s open" %
+                              (dbg, uri))
+                    break
+                time.sleep(0.5)
+        force_unlink(_active_path(scsi_id))
+        statcache.invalidate(dbg, uri)
+    except (IOError, OSError):
+        log.error("%s: cannot stop the stats of %s: %s" %
+                  (dbg, uri, sys.exc_info()[1]))
 
 
 if __name__ == "__main__":
-    from sys import argv
-    uri = argv[1]
-    run_stats(uri)
+    try:
+        demonize()
+        with open(LOCK_FILE, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Somebody else beat us to it
+                sys.exit(0)
+            run_stats(STATS)
+    except SystemExit:
+        raise
+    except:
+        log.error("gfs2 stats: error {}".format(sys.exc_info()))
@@ -6,17 +6,24 @@ import xapi.storage.api.volume
 from xapi.storage import log
 from xapi.storage.libs.libvhd import VHDVolume
 import gfs2
+import statcache
 
 class Implementation(xapi.storage.api.volume.Volume_skeleton):
 
     def clone(self, dbg, sr, key):
-        return VHDVolume.clone(dbg, sr, key, gfs2.Callbacks())
+        try:
+            return VHDVolume.clone(dbg, sr, key, gfs2.Callbacks())
+        finally:
+            statcache.invalidate(dbg, sr)
 
     def snapshot(self, dbg, sr, key):
-        return VHDVolume.clone(dbg, sr, key, gfs2.Callbacks())
+        try:
+            return VHDVolume.clone(dbg, sr, key, gfs2.Callbacks())
+        finally:
+            statcache.invalidate(dbg, sr)
 
     def create(self, dbg, sr, name, description, size):
-        return VHDVolume.create(
+        volume = VHDVolume.create(
             dbg,
             sr,
             name,
@@ -24,18 +31,26 @@ class Implementation(xapi.storage.api.volume.Volume_skeleton):
             size,
             gfs2.Callbacks()
         )
+        statcache.adjust(dbg, sr, volume['virtual_size'])
+        return volume
 
     def destroy(self, dbg, sr, key):
-        return VHDVolume.destroy(dbg, sr, key, gfs2.Callbacks())
+        try:
+            return VHDVolume.destroy(dbg, sr, key, gfs2.Callbacks())
+        finally:
+            statcache.invalidate(dbg, sr)
 
     def resize(self, dbg, sr, key, new_size):
-        return VHDVolume.resize(
-            dbg,
-            sr,
-            key,
-            new_size,
-            gfs2.Callbacks()
-        )
+        try:
+            return VHDVolume.resize(
+                dbg,
+                sr,
+                key,
+                new_size,
+                gfs2.Callbacks()
+            )
+        finally:
+            statcache.invalidate(dbg, sr)
 
     def set(self, dbg, sr, key, k, v):
         VHDVolume.set(dbg, sr, key, k, v, gfs2.Callbacks())